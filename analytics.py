@@ -0,0 +1,315 @@
+import asyncio
+import calendar
+import csv
+import fcntl
+import glob
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сбор событий просмотра для аналитики реферальных ссылок.
+# Обработчики только добавляют событие в ограниченный буфер в памяти;
+# фоновая задача раз в flush_interval секунд пишет пачку событий и
+# накопленные с прошлого сброса агрегаты (просмотры карт по дням,
+# уникальные пользователи на каждом шаге воронки) в хранилище.
+
+START = "start"
+BANK_LIST = "bank_list"
+BANK_VIEW = "bank_view"
+TYPE_VIEW = "type_view"
+CARD_VIEW = "card_view"
+REF_EXPOSURE = "ref_exposure"
+REF_CLICK = "ref_click"
+ALL_CARDS_VIEW = "all_cards_view"
+
+# Шаги воронки по порядку
+FUNNEL = (START, BANK_LIST, BANK_VIEW, TYPE_VIEW, CARD_VIEW)
+
+
+class Event(NamedTuple):
+    ts: float
+    kind: str
+    user_id: int
+    bank: Optional[str]
+    card_type: Optional[str]
+    card: Optional[str]
+
+
+def _day(ts: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def card_key(bank: str, card_type: str, card: str) -> str:
+    return f"{bank}/{card_type}/{card}"
+
+
+# Пользователи по шагам воронки из пар (шаг, user_id)
+def _funnel_users(rows: Iterable[Tuple[str, int]]) -> Dict[str, Set[int]]:
+    users: Dict[str, Set[int]] = {}
+    for kind, user_id in rows:
+        if kind in FUNNEL:
+            users.setdefault(kind, set()).add(int(user_id))
+    return users
+
+
+class SqliteEventSink:
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " ts REAL NOT NULL, kind TEXT NOT NULL, user_id INTEGER NOT NULL,"
+            " bank TEXT, card_type TEXT, card TEXT);"
+            "CREATE TABLE IF NOT EXISTS card_daily ("
+            " day TEXT NOT NULL, card TEXT NOT NULL, kind TEXT NOT NULL, count INTEGER NOT NULL,"
+            " PRIMARY KEY (day, card, kind));"
+            "CREATE TABLE IF NOT EXISTS funnel_daily ("
+            " day TEXT NOT NULL, stage TEXT NOT NULL, users INTEGER NOT NULL,"
+            " PRIMARY KEY (day, stage));"
+            "CREATE INDEX IF NOT EXISTS events_ts ON events (ts);"
+        )
+        self._db.commit()
+
+    def write(self, events: List[Event], cards: Counter, funnel: Counter) -> None:
+        with self._db:
+            self._db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", events)
+            self._db.executemany(
+                "INSERT INTO card_daily (day, card, kind, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (day, card, kind) DO UPDATE SET count = count + excluded.count",
+                [(day, card, kind, count) for (day, card, kind), count in cards.items()],
+            )
+            self._db.executemany(
+                "INSERT INTO funnel_daily (day, stage, users) VALUES (?, ?, ?) "
+                "ON CONFLICT (day, stage) DO UPDATE SET users = users + excluded.users",
+                [(day, stage, users) for (day, stage), users in funnel.items()],
+            )
+
+    def card_views(self, day: str) -> Dict[str, int]:
+        rows = self._db.execute(
+            "SELECT card, count FROM card_daily WHERE day = ? AND kind = ?", (day, CARD_VIEW)
+        ).fetchall()
+        return dict(rows)
+
+    def funnel(self, day: str) -> Dict[str, int]:
+        rows = self._db.execute("SELECT stage, users FROM funnel_daily WHERE day = ?", (day,)).fetchall()
+        return dict(rows)
+
+    # Пользователи, уже учтённые в воронке за сутки day
+    def funnel_users(self, day: str) -> Dict[str, Set[int]]:
+        start = calendar.timegm(time.strptime(day, "%Y-%m-%d"))
+        placeholders = ", ".join("?" * len(FUNNEL))
+        rows = self._db.execute(
+            f"SELECT kind, user_id FROM events WHERE ts >= ? AND ts < ? AND kind IN ({placeholders})",
+            (start, start + 86400, *FUNNEL),
+        )
+        return _funnel_users(rows)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+# Сырые события в CSV-файлах по дням (с ротацией по размеру),
+# агрегаты — в JSON-файле рядом, перезаписываемом атомарно. В каталог пишут
+# все процессы бота (рабочие и входной), поэтому запись идёт под файловой
+# блокировкой, а агрегаты перед слиянием перечитываются с диска.
+class CsvEventSink:
+    def __init__(self, directory: str, max_file_size: int = 64 << 20):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        os.makedirs(directory, exist_ok=True)
+        self._rollup_path = os.path.join(directory, "rollups.json")
+        self._lock_path = os.path.join(directory, "rollups.lock")
+
+    def _rollups(self) -> dict:
+        try:
+            with open(self._rollup_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"card_daily": {}, "funnel_daily": {}}
+
+    def _event_file(self, day: str) -> str:
+        part = 0
+        while True:
+            path = os.path.join(self.directory, f"events-{day}.{part}.csv")
+            if not os.path.exists(path) or os.path.getsize(path) < self.max_file_size:
+                return path
+            part += 1
+
+    def write(self, events: List[Event], cards: Counter, funnel: Counter) -> None:
+        by_day: Dict[str, List[Event]] = {}
+        for event in events:
+            by_day.setdefault(_day(event.ts), []).append(event)
+        # Блокировка снимается при закрытии файла
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            for day, day_events in by_day.items():
+                with open(self._event_file(day), "a", newline="", encoding="utf-8") as f:
+                    csv.writer(f).writerows(day_events)
+
+            rollups = self._rollups()
+            card_daily = rollups["card_daily"]
+            for (day, card, kind), count in cards.items():
+                counts = card_daily.setdefault(day, {}).setdefault(card, {})
+                counts[kind] = counts.get(kind, 0) + count
+            funnel_daily = rollups["funnel_daily"]
+            for (day, stage), users in funnel.items():
+                stages = funnel_daily.setdefault(day, {})
+                stages[stage] = stages.get(stage, 0) + users
+
+            tmp_path = self._rollup_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(rollups, f, ensure_ascii=False)
+            os.replace(tmp_path, self._rollup_path)
+
+    def card_views(self, day: str) -> Dict[str, int]:
+        return {
+            card: counts.get(CARD_VIEW, 0)
+            for card, counts in self._rollups()["card_daily"].get(day, {}).items()
+        }
+
+    def funnel(self, day: str) -> Dict[str, int]:
+        return dict(self._rollups()["funnel_daily"].get(day, {}))
+
+    def funnel_users(self, day: str) -> Dict[str, Set[int]]:
+        rows = []
+        for path in glob.glob(os.path.join(glob.escape(self.directory), f"events-{day}.*.csv")):
+            with open(path, newline="", encoding="utf-8") as f:
+                rows.extend((row[1], row[2]) for row in csv.reader(f) if len(row) > 2)
+        return _funnel_users(rows)
+
+    def close(self) -> None:
+        pass
+
+
+class Analytics:
+    def __init__(self, sink=None, flush_interval: float = 10.0, max_buffer: int = 100000):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self.written = 0
+        self._buffer: List[Event] = []
+        self._cards: Counter = Counter()
+        self._funnel: Counter = Counter()
+        # Пользователи, уже учтённые в воронке за текущие сутки
+        self._funnel_day: Optional[str] = None
+        self._funnel_seen: Dict[str, Set[int]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analytics")
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sink is not None
+
+    # Горячий путь обработчиков: без ввода-вывода и без ожидания
+    def emit(
+        self,
+        kind: str,
+        user_id: int,
+        bank: Optional[str] = None,
+        card_type: Optional[str] = None,
+        card: Optional[str] = None,
+    ) -> None:
+        if self.sink is None:
+            return
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        event = Event(time.time(), kind, user_id, bank, card_type, card)
+        self._buffer.append(event)
+        self._rollup(event)
+
+    def _rollup(self, event: Event) -> None:
+        day = _day(event.ts)
+        if event.card is not None:
+            self._cards[(day, card_key(event.bank, event.card_type, event.card), event.kind)] += 1
+        if event.kind in FUNNEL:
+            if day != self._funnel_day:
+                self._funnel_day = day
+                self._funnel_seen = {}
+            seen = self._funnel_seen.setdefault(event.kind, set())
+            if event.user_id not in seen:
+                seen.add(event.user_id)
+                self._funnel[(day, event.kind)] += 1
+
+    async def flush(self) -> None:
+        if self.sink is None or not self._buffer and not self._cards and not self._funnel:
+            return
+        events, cards, funnel = self._buffer, self._cards, self._funnel
+        self._buffer, self._cards, self._funnel = [], Counter(), Counter()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self.sink.write, events, cards, funnel)
+            self.written += len(events)
+        except Exception:
+            logger.exception("Не удалось записать %s событий аналитики", len(events))
+            self.dropped += len(events)
+
+    # Пользователи, учтённые в воронке до перезапуска, берутся из
+    # сегодняшних событий хранилища, иначе после перезапуска они
+    # считались бы за сутки второй раз
+    async def _restore_funnel(self) -> None:
+        day = _day(time.time())
+        loop = asyncio.get_running_loop()
+        try:
+            restored = await loop.run_in_executor(self._executor, self.sink.funnel_users, day)
+        except Exception:
+            logger.exception("Не удалось прочитать пользователей воронки за %s", day)
+            return
+        if self._funnel_day not in (None, day):
+            return
+        self._funnel_day = day
+        for stage, users in restored.items():
+            seen = self._funnel_seen.setdefault(stage, set())
+            # Учтённые с момента запуска, но уже бывшие в воронке сегодня
+            repeated = len(seen & users)
+            if repeated:
+                self._funnel[(day, stage)] -= repeated
+                if self._funnel[(day, stage)] <= 0:
+                    del self._funnel[(day, stage)]
+            seen |= users
+
+    async def _flush_loop(self) -> None:
+        await self._restore_funnel()
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self) -> None:
+        if self.sink is not None and self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    # Остановка фоновой задачи; текущая запись не прерывается,
+    # оставшийся буфер записывается последней пачкой
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+# Создание по строке вида "sqlite:analytics.db" или "csv:analytics"
+def create_analytics(url: str, flush_interval: float) -> Analytics:
+    if not url:
+        return Analytics()
+    kind, _, path = url.partition(":")
+    if kind == "sqlite":
+        sink = SqliteEventSink(path or "analytics.db")
+    elif kind == "csv":
+        sink = CsvEventSink(path or "analytics")
+    else:
+        raise ValueError(f"Неизвестное хранилище аналитики: {url!r}")
+    return Analytics(sink, flush_interval)
@@ -0,0 +1,200 @@
+import functools
+import itertools
+import math
+import operator
+import re
+from array import array
+from typing import AbstractSet, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# Числовые характеристики карт для сравнения и рейтингов.
+# Тексты преимуществ разбираются один раз при загрузке каталога в таблицу
+# по столбцам: на характеристику — array('d') по ID карты, отсутствующее
+# значение — NaN. Для каждой характеристики заранее построен порядок ID от
+# лучшего значения к худшему, поэтому рейтинг — это фильтрация готового
+# порядка байтовой маской возраста и типа карты, без сортировки и без
+# обхода словарей на запрос.
+
+
+class Attribute(NamedTuple):
+    key: str
+    # Заголовок рейтинга и подпись кнопки
+    title: str
+    button: str
+    # True — чем больше, тем лучше
+    descending: bool
+    unit: str
+
+
+GRACE_PERIOD = Attribute("grace", "Самый длинный льготный период", "⏳ Льготный период", True, "дн.")
+CREDIT_LIMIT = Attribute("limit", "Самый высокий кредитный лимит", "💰 Кредитный лимит", True, "₽")
+CASHBACK = Attribute("cashback", "Самый высокий кэшбэк", "🎁 Кэшбэк", True, "%")
+INTEREST_RATE = Attribute("rate", "Самая низкая ставка после льготного периода", "📉 Ставка", False, "% годовых")
+FEE = Attribute("fee", "Самое дешёвое обслуживание", "🆓 Обслуживание", False, "₽ в месяц")
+
+ATTRIBUTES: Tuple[Attribute, ...] = (GRACE_PERIOD, CREDIT_LIMIT, CASHBACK, INTEREST_RATE, FEE)
+_DESCENDING = {attribute.key: attribute.descending for attribute in ATTRIBUTES}
+
+_NUMBER = r"(\d[\d \u00a0\u202f]*(?:[.,]\d+)?)"
+_GRACE_RE = re.compile(_NUMBER + r"\s*дн\w*\s+без\s+процентов")
+_LIMIT_RE = re.compile(r"кредитный\s+лимит\W*(?:до\s+)?" + _NUMBER + r"\s*(?:руб|₽)")
+_RATE_RE = re.compile(r"ставка\s+(?:от\s+)?" + _NUMBER + r"\s*%")
+_PERCENT_RE = re.compile(_NUMBER + r"\s*%(?!\s*годовых)")
+# Проценты, которые не являются кэшбэком: ставки, рассрочка, доход на остаток
+_NOT_CASHBACK_RE = re.compile(r"ставк|рассрочк|годовых|остат")
+_FEE_RE = re.compile(_NUMBER + r"\s*(?:руб\w*|₽)(?:\s+в\s+(месяц|год))?")
+_FEE_OTHERWISE_RE = re.compile(r"иначе\W*" + _FEE_RE.pattern)
+_FEE_YEARLY_RE = re.compile(r"(?:от\s+[\d \u00a0\u202f]+\s+)?до\s+" + _NUMBER + r"\s*(?:руб\w*|₽)\s+в\s+год")
+
+
+def _number(text: str) -> float:
+    return float(re.sub(r"[ \u00a0\u202f]", "", text).replace(",", "."))
+
+
+def _monthly(amount: str, period: Optional[str]) -> float:
+    value = _number(amount)
+    return value / 12 if period == "год" else value
+
+
+# Значения характеристик из одной строки преимуществ: пары (ключ, значение).
+# Строки повторяются от карты к карте, поэтому результат кэшируется.
+@functools.lru_cache(maxsize=1 << 14)
+def _parse_line(advantage: str) -> Tuple[Tuple[str, float], ...]:
+    text = advantage.lower().replace("ё", "е")
+    found: List[Tuple[str, float]] = []
+    if "без процентов" in text:
+        found.extend((GRACE_PERIOD.key, _number(match.group(1))) for match in _GRACE_RE.finditer(text))
+    if "лимит" in text:
+        found.extend((CREDIT_LIMIT.key, _number(match.group(1))) for match in _LIMIT_RE.finditer(text))
+    if "%" in text:
+        found.extend((INTEREST_RATE.key, _number(match.group(1))) for match in _RATE_RE.finditer(text))
+        if not _NOT_CASHBACK_RE.search(text):
+            found.extend((CASHBACK.key, _number(match.group(1))) for match in _PERCENT_RE.finditer(text))
+
+    if "обслуживан" in text:
+        match = _FEE_OTHERWISE_RE.search(text)
+        if match is not None:
+            found.append((FEE.key, _monthly(match.group(1), match.group(2))))
+        elif text.startswith("бесплатное обслуживание") and "при " not in text:
+            found.append((FEE.key, 0.0))
+    elif "в год" in text:
+        match = _FEE_YEARLY_RE.search(text)
+        if match is not None:
+            found.append((FEE.key, _number(match.group(1)) / 12))
+    return tuple(found)
+
+
+# Значения характеристик по текстам преимуществ одной карты; характеристика,
+# не упомянутая в тексте, отсутствует. Из нескольких упоминаний берётся
+# лучшее, для обслуживания — худший случай: плата в месяц, если условия
+# бесплатного обслуживания не выполнены.
+def parse_advantages(advantages: Iterable[str]) -> Dict[str, float]:
+    values: Dict[str, float] = {}
+    for advantage in advantages:
+        for key, value in _parse_line(advantage):
+            current = values.get(key)
+            if current is None:
+                values[key] = value
+            elif key == FEE.key:
+                values[key] = max(current, value)
+            else:
+                values[key] = max(current, value) if _DESCENDING[key] else min(current, value)
+    return values
+
+
+class CardTable:
+    # cards — кортеж карт снимка, индекс в нём совпадает с Card.id;
+    # скрытые карты в рейтинги не попадают
+    def __init__(self, cards: Sequence, hidden: AbstractSet[int] = frozenset()):
+        self.cards = cards
+        # Байт на карту: 1, если карта не скрыта
+        self.visible = bytes(card.id not in hidden for card in cards)
+        nan = math.nan
+        self.columns: Dict[str, array] = {attribute.key: array("d") for attribute in ATTRIBUTES}
+        self.age_limits = array("H")
+        types: Dict[str, int] = {}
+        self.type_ids = array("H")
+        for card in cards:
+            values = parse_advantages(card.advantages)
+            for key, column in self.columns.items():
+                column.append(values.get(key, nan))
+            self.age_limits.append(card.age_limit)
+            self.type_ids.append(types.setdefault(card.card_type, len(types)))
+        self._type_ids = types
+
+        # Характеристика -> ID карт со значением, от лучшего к худшему; при
+        # равенстве — в порядке каталога
+        self.orders: Dict[str, array] = {}
+        for attribute in ATTRIBUTES:
+            column = self.columns[attribute.key]
+            present = itertools.compress(range(len(column)), map(operator.eq, column, column))
+            if attribute.descending:
+                order = sorted(present, key=lambda card_id, column=column: -column[card_id])
+            else:
+                order = sorted(present, key=column.__getitem__)
+            self.orders[attribute.key] = array("L", order)
+
+        # (возраст, тип карты) -> байт на карту: 1, если карта подходит
+        self._masks: Dict[Tuple[int, Optional[str]], bytes] = {}
+
+    def __len__(self) -> int:
+        return len(self.cards)
+
+    # Состояние таблицы для файла снимка каталога (snapshot.py): массивы
+    # в байтах, чтобы их сериализовал marshal
+    def state(self) -> tuple:
+        return (
+            self.visible,
+            {key: column.tobytes() for key, column in self.columns.items()},
+            self.age_limits.tobytes(),
+            self.type_ids.tobytes(),
+            self._type_ids,
+            {key: order.tobytes() for key, order in self.orders.items()},
+        )
+
+    # Таблица из сохранённого состояния, без разбора текстов преимуществ
+    @classmethod
+    def restore(cls, cards: Sequence, state: tuple) -> "CardTable":
+        table = cls.__new__(cls)
+        table.cards = cards
+        visible, columns, age_limits, type_ids, table._type_ids, orders = state
+        table.visible = visible
+        table.columns = {key: array("d", column) for key, column in columns.items()}
+        table.age_limits = array("H", age_limits)
+        table.type_ids = array("H", type_ids)
+        table.orders = {key: array("L", order) for key, order in orders.items()}
+        table._masks = {}
+        return table
+
+    def _mask(self, age: int, card_type: Optional[str]) -> bytes:
+        mask = self._masks.get((age, card_type))
+        if mask is None:
+            mask = bytes(map(operator.and_, map(age.__ge__, self.age_limits), self.visible))
+            if card_type is not None:
+                type_id = self._type_ids.get(card_type, -1)
+                mask = bytes(map(operator.and_, mask, map(type_id.__eq__, self.type_ids)))
+            self._masks[(age, card_type)] = mask
+        return mask
+
+    def value(self, attribute: Attribute, card_id: int) -> Optional[float]:
+        value = self.columns[attribute.key][card_id]
+        return None if value != value else value
+
+    # Лучшие по характеристике карты, доступные в возрасте age
+    def top(self, attribute: Attribute, age: int, card_type: Optional[str] = None, limit: int = 10) -> List:
+        order = self.orders[attribute.key]
+        mask = self._mask(age, card_type)
+        eligible = itertools.compress(order, map(mask.__getitem__, order))
+        return [self.cards[card_id] for card_id in itertools.islice(eligible, limit)]
+
+
+def format_value(attribute: Attribute, value: float) -> str:
+    if attribute is CREDIT_LIMIT or attribute is FEE:
+        # Разряды через неразрывный пробел
+        number = f"{value:,.0f}".replace(",", "\u00a0")
+    elif value == int(value):
+        number = f"{value:.0f}"
+    else:
+        number = f"{value:g}".replace(".", ",")
+    # «30%», «11,9% годовых», но «180 дн.»
+    separator = "" if attribute.unit.startswith("%") else " "
+    return f"{number}{separator}{attribute.unit}"
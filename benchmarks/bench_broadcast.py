@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Bot
+
+from broadcast import DONE, BroadcastStore, Broadcaster
+from fake_telegram import FakeTelegramRequest
+
+# Рассылка через локальную заглушку Bot API: --recipients подписчиков,
+# каждый --blocked-every-й заблокировал бота (ответ 403), каждый
+# --flood-every-й запрос получает 429 с retry_after. На --crash-at доле
+# рассылки процесс «падает» (задачи отменяются без сохранения прогресса),
+# после чего новый Broadcaster продолжает с последней контрольной точки.
+# В конце проверяется, что каждый доступный получатель получил сообщение,
+# и считаются повторные отправки.
+#
+#   python benchmarks/bench_broadcast.py --recipients 1000000
+
+FIRST_USER_ID = 10 ** 6
+
+
+class BroadcastFakeRequest(FakeTelegramRequest):
+    def __init__(self, recipients: int, blocked_every: int, flood_every: int):
+        super().__init__()
+        self.blocked_every = blocked_every
+        self.flood_every = flood_every
+        # Число доставленных сообщений по получателю
+        self.delivered = bytearray(recipients)
+        self.requests = 0
+
+    def blocked(self, chat_id: int) -> bool:
+        return self.blocked_every > 0 and chat_id % self.blocked_every == 0
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint != "sendMessage":
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+        self.requests += 1
+        chat_id = int(request_data.parameters["chat_id"])
+        if self.flood_every and self.requests % self.flood_every == 0:
+            body = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1}}
+            return 429, json.dumps(body).encode("utf-8")
+        if self.blocked(chat_id):
+            body = {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            return 403, json.dumps(body).encode("utf-8")
+        index = chat_id - FIRST_USER_ID
+        self.delivered[index] = min(self.delivered[index] + 1, 255)
+        message = {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "."}
+        return 200, json.dumps({"ok": True, "result": message}).encode("utf-8")
+
+
+def fill(store: BroadcastStore, recipients: int) -> None:
+    chunk = 100000
+    for start in range(0, recipients, chunk):
+        store.add_subscribers(list(range(FIRST_USER_ID + start, FIRST_USER_ID + min(start + chunk, recipients))))
+
+
+async def run(args) -> dict:
+    directory = tempfile.mkdtemp(prefix="bench_broadcast_")
+    path = os.path.join(directory, "broadcast.db")
+    store = BroadcastStore(path)
+    started = time.perf_counter()
+    fill(store, args.recipients)
+    fill_seconds = time.perf_counter() - started
+
+    fake = BroadcastFakeRequest(args.recipients, args.blocked_every, args.flood_every)
+    bot = Bot("123456:BROADCAST", request=fake, get_updates_request=FakeTelegramRequest())
+    await bot.initialize()
+
+    async def send(chat_id: int, text: str) -> None:
+        await bot.send_message(chat_id, text)
+
+    def make_broadcaster() -> Broadcaster:
+        return Broadcaster(store, send, rate=args.rate, workers=args.workers, report_interval=args.report_interval)
+
+    broadcaster = make_broadcaster()
+    broadcaster.start()
+    job_id, recipients = await broadcaster.enqueue("📣 Новая карта в каталоге!")
+
+    started = time.perf_counter()
+    crash_after = int(recipients * args.crash_at) if args.crash_at > 0 else None
+    crashed = False
+    while True:
+        await asyncio.sleep(0.2)
+        job = store.get(job_id)
+        if job.status == DONE:
+            break
+        progress = broadcaster.progress
+        if crash_after is not None and not crashed and progress is not None and progress.processed >= crash_after:
+            # Аварийное завершение: без stop() и без последней контрольной точки
+            for task in broadcaster._tasks:
+                task.cancel()
+            await asyncio.gather(*broadcaster._tasks, return_exceptions=True)
+            broadcaster._lock_file.close()
+            crashed = True
+            logging.info("Сбой после %s отправок, курсор в базе: %s", fake.requests, store.get(job_id).cursor)
+            broadcaster = make_broadcaster()
+            broadcaster.start()
+    elapsed = time.perf_counter() - started
+    await broadcaster.stop()
+    await bot.shutdown()
+
+    job = store.get(job_id)
+    reachable = [i for i in range(args.recipients) if not fake.blocked(FIRST_USER_ID + i)]
+    missing = sum(1 for i in reachable if fake.delivered[i] == 0)
+    duplicates = sum(fake.delivered[i] - 1 for i in reachable if fake.delivered[i] > 1)
+    remaining_subscribers = store.subscriber_count()
+    store.close()
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+    processed = job.sent + job.blocked + job.failed
+    return {
+        "recipients": args.recipients,
+        "fill_seconds": fill_seconds,
+        "elapsed_seconds": elapsed,
+        "messages_per_second": processed / elapsed,
+        "sent": job.sent,
+        "blocked_pruned": job.blocked,
+        "failed": job.failed,
+        "subscribers_left": remaining_subscribers,
+        "crashed_and_resumed": crashed,
+        "missing": missing,
+        "duplicates": duplicates,
+        "send_requests": fake.requests,
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipients", type=int, default=100000)
+    parser.add_argument("--rate", type=float, default=1e6, help="лимит отправок в секунду")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--blocked-every", type=int, default=20)
+    parser.add_argument("--flood-every", type=int, default=200000)
+    parser.add_argument("--crash-at", type=float, default=0.5, help="доля рассылки до сбоя; 0 — без сбоя")
+    parser.add_argument("--report-interval", type=float, default=10.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import load_catalog
+
+# Время загрузки и память снимка каталога на синтетическом каталоге.
+# Экраны не строятся: измеряется разбор файла и построение индексов.
+
+CARDS = int(os.getenv("BENCH_CARDS", "10000"))
+BANKS = 100
+TYPES = ("Кредитные карты", "Дебетовые карты")
+
+
+def synthetic_catalog(cards: int) -> dict:
+    banks = {}
+    for i in range(cards):
+        bank = f"Банк {i % BANKS}"
+        card_type = TYPES[i % len(TYPES)]
+        banks.setdefault(bank, {}).setdefault(card_type, {})[f"Карта {i}"] = {
+            "age_limit": 14 if i % 5 == 0 else 18,
+            "advantages": [
+                f"До {i % 200} дней без процентов",
+                f"Кредитный лимит: до {(i % 100) * 10000} рублей",
+                f"Кэшбэк до {i % 15}%",
+            ],
+            "ref_link": f"https://example.com/card_{i}",
+        }
+    return {"version": 1, "banks": banks}
+
+
+def main():
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False, encoding="utf-8") as f:
+        json.dump(synthetic_catalog(CARDS), f, ensure_ascii=False)
+        path = f.name
+    try:
+        size = os.path.getsize(path)
+        load_catalog(path)
+
+        timings = []
+        for _ in range(5):
+            started = time.perf_counter()
+            load_catalog(path)
+            timings.append(time.perf_counter() - started)
+
+        tracemalloc.start()
+        catalog = load_catalog(path)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"cards:            {len(catalog)} ({size / 1024:.0f} KiB JSON)")
+        print(f"reload (best/avg): {min(timings) * 1e3:.1f} / {sum(timings) / len(timings) * 1e3:.1f} ms")
+        print(f"snapshot memory:  {current / 1024 / 1024:.1f} MiB (peak during load {peak / 1024 / 1024:.1f} MiB)")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
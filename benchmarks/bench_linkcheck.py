@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from http import HTTPStatus
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_catalog import synthetic_catalog
+from catalog import CatalogStore
+from linkcheck import LinkChecker, LinkStore
+from render import build_screens
+from webserver import HttpServer, Request, Response
+
+# Проверка реферальных ссылок против локальных серверов-заменителей
+# партнёров: --hosts серверов на разных портах (разные хосты для лимита),
+# каталог из --cards карт со своей ссылкой у каждой. Среди ссылок есть
+# рабочие (часть через редирект), несуществующие (404), зависающие дольше
+# таймаута и перегруженные (503). Проверяется:
+#   первый круг — скорость, нерабочие карты скрыты из меню, перегруженные нет,
+#     частота запросов к каждому хосту не выше лимита, соединения переиспользуются;
+#   второй круг — рабочие страницы отвечают 304 по ETag без тела;
+#   третий круг — починенные ссылки возвращают карты в меню.
+#
+#   python benchmarks/bench_linkcheck.py --cards 5000 --hosts 50
+
+
+class PartnerServer(HttpServer):
+    def __init__(self, page_size: int, slow: float):
+        super().__init__("127.0.0.1", 0, max_connections=1000)
+        self.page = b"x" * page_size
+        self.slow = slow
+        self.connections = 0
+        self.statuses: Counter = Counter()
+        self.body_bytes = 0
+        # Время запросов к ссылкам каталога (без переходов по редиректам)
+        self.arrivals = []
+        self.fixed = False
+        self.route("GET", "/_stats", self.handle_stats)
+        self.route("POST", "/_fix", self.handle_fix)
+        self.route("GET", "/", self.handle, prefix=True)
+
+    async def _handle_connection(self, reader, writer) -> None:
+        self.connections += 1
+        await super()._handle_connection(reader, writer)
+
+    async def handle(self, request: Request) -> Response:
+        kind, _, number = request.path.strip("/").partition("/")
+        if kind != "ok":
+            self.arrivals.append(asyncio.get_running_loop().time())
+        if kind == "dead" and self.fixed:
+            kind = "ok"
+        if kind == "ok":
+            etag = f'"v1-{number}"'
+            if request.headers.get("if-none-match") == etag:
+                return self._count(Response(HTTPStatus.NOT_MODIFIED, headers=(("ETag", etag),)))
+            return self._count(Response(HTTPStatus.OK, self.page, "text/html", (("ETag", etag),)))
+        if kind == "go":
+            return self._count(Response(HTTPStatus.FOUND, headers=(("Location", f"/ok/{number}"),)))
+        if kind == "slow":
+            await asyncio.sleep(self.slow)
+        if kind == "busy":
+            return self._count(Response(HTTPStatus.SERVICE_UNAVAILABLE))
+        return self._count(Response(HTTPStatus.NOT_FOUND))
+
+    def _count(self, response: Response) -> Response:
+        self.statuses[response.status] += 1
+        self.body_bytes += len(response.body)
+        return response
+
+    # Счётчики с прошлого запроса; соединение самого запроса не считается
+    async def handle_stats(self, request: Request) -> Response:
+        stats = {
+            "statuses": self.statuses,
+            "body_bytes": self.body_bytes,
+            "peak_rate": peak_rate(self.arrivals),
+            "connections": self.connections - 1,
+        }
+        self.statuses = Counter()
+        self.body_bytes = 0
+        self.arrivals = []
+        self.connections = 0
+        return Response(HTTPStatus.OK, json.dumps(stats).encode("utf-8"), "application/json", (("Connection", "close"),))
+
+    async def handle_fix(self, request: Request) -> Response:
+        self.fixed = True
+        return Response(HTTPStatus.NO_CONTENT)
+
+
+# Наибольшее число запросов к хосту за любую секунду
+def peak_rate(arrivals) -> int:
+    window = deque()
+    peak = 0
+    for moment in sorted(arrivals):
+        window.append(moment)
+        while window[0] <= moment - 1.0:
+            window.popleft()
+        peak = max(peak, len(window))
+    return peak
+
+
+# Серверы партнёров работают в отдельном процессе, чтобы не делить
+# процессор с проверкой; порты передаются родителю через pipe
+def serve(hosts: int, page_size: int, slow: float, pipe) -> None:
+    async def main() -> None:
+        servers = [PartnerServer(page_size, slow) for _ in range(hosts)]
+        for server in servers:
+            await server.start()
+        pipe.send([server.port for server in servers])
+        await asyncio.Event().wait()
+
+    logging.getLogger("webserver").setLevel(logging.WARNING)
+    asyncio.run(main())
+
+
+def build_catalog(directory: str, cards: int, ports) -> dict:
+    rng = random.Random(1)
+    catalog = synthetic_catalog(cards)
+    kinds = Counter()
+    index = 0
+    for types in catalog["banks"].values():
+        for bank_cards in types.values():
+            for info in bank_cards.values():
+                roll = rng.random()
+                kind = "dead" if roll < 0.05 else "slow" if roll < 0.07 else "busy" if roll < 0.1 else \
+                    "go" if roll < 0.5 else "ok"
+                kinds[kind] += 1
+                info["ref_link"] = f"http://127.0.0.1:{ports[index % len(ports)]}/{kind}/{index}"
+                index += 1
+    path = os.path.join(directory, "catalog.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    return {"path": path, "kinds": kinds}
+
+
+def visible_cards(catalog_store: CatalogStore) -> int:
+    return len(catalog_store.current.screens.by_age[18].cards)
+
+
+async def server_stats(ports) -> dict:
+    async with httpx.AsyncClient() as client:
+        responses = await asyncio.gather(*(client.get(f"http://127.0.0.1:{port}/_stats") for port in ports))
+    stats = [response.json() for response in responses]
+    statuses = sum((Counter(item["statuses"]) for item in stats), Counter())
+    return {
+        "statuses": dict(sorted(statuses.items())),
+        "body_mib": sum(item["body_bytes"] for item in stats) / 2 ** 20,
+        "peak_host_rate": max(item["peak_rate"] for item in stats),
+        "connections": sum(item["connections"] for item in stats),
+    }
+
+
+async def check_round(checker: LinkChecker, ports) -> dict:
+    await server_stats(ports)
+    started = time.perf_counter()
+    failing = await checker.check_catalog()
+    seconds = time.perf_counter() - started
+    await checker.apply(failing)
+    result = {
+        "seconds": seconds,
+        "links_per_minute": len(checker.catalog_store.current.cards) / seconds * 60,
+        "hidden_cards": len(checker.catalog_store.current.hidden),
+        "visible_cards": visible_cards(checker.catalog_store),
+    }
+    result.update(await server_stats(ports))
+    return result
+
+
+async def run(args, ports) -> dict:
+    directory = tempfile.mkdtemp(prefix="bench_linkcheck_")
+    try:
+        catalog = build_catalog(directory, args.cards, ports)
+        kinds = catalog["kinds"]
+        catalog_store = CatalogStore(catalog["path"], renderer=build_screens)
+        catalog_store.load()
+        total = visible_cards(catalog_store)
+        checker = LinkChecker(
+            LinkStore(os.path.join(directory, "links.db")),
+            catalog_store,
+            interval=0,
+            concurrency=args.concurrency,
+            host_rate=args.host_rate,
+            failures=1,
+            timeout=args.timeout,
+        )
+        checker.start()
+        # Цикл проверки в фоне здесь не нужен: круги запускаются вручную
+        checker._task.cancel()
+
+        result = {"cards": args.cards, "hosts": args.hosts, "links": dict(kinds), "visible_before": total}
+        first = result["first"] = await check_round(checker, ports)
+        assert first["hidden_cards"] == kinds["dead"] + kinds["slow"], first
+        assert first["peak_host_rate"] <= args.host_rate + 1, first
+        redirected = [state for state in checker._states.values() if "/go/" in state.url]
+        assert all(state.final_url.replace("/ok/", "/go/") == state.url for state in redirected)
+        # Не больше пула каждого хоста, плюс новые после таймаутов зависающих ссылок
+        assert first["connections"] <= args.hosts * checker.host_connections + kinds["slow"], first
+
+        second = result["second"] = await check_round(checker, ports)
+        assert second["statuses"].get("304") == kinds["ok"] + kinds["go"], second
+
+        async with httpx.AsyncClient() as client:
+            await asyncio.gather(*(client.post(f"http://127.0.0.1:{port}/_fix") for port in ports))
+        third = result["third"] = await check_round(checker, ports)
+        assert third["hidden_cards"] == kinds["slow"], third
+        await checker.stop()
+        checker.store.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cards", type=int, default=5000)
+    parser.add_argument("--hosts", type=int, default=50)
+    parser.add_argument("--page-kb", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--host-rate", type=float, default=5)
+    parser.add_argument("--timeout", type=float, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    logging.getLogger("linkcheck").setLevel(logging.ERROR)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parent, child = multiprocessing.Pipe()
+    partners = multiprocessing.Process(
+        target=serve, args=(args.hosts, args.page_kb * 1024, args.timeout + 1, child), daemon=True
+    )
+    partners.start()
+    try:
+        result = asyncio.run(run(args, parent.recv()))
+    finally:
+        partners.terminate()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_catalog import synthetic_catalog
+
+# Картинки карт через локальную заглушку Bot API. Каталог из --cards карт,
+# у каждой картинка из --images файлов по --image-kb КиБ (одинаковые
+# картинки у нескольких карт). Этапы:
+#   прогрев — загрузка картинок в служебный чат, не больше
+#     MEDIA_WARMUP_CONCURRENCY отправок одновременно, каждая картинка один раз;
+#   показы — --users пользователей листают карты (карта → другая карта →
+#     назад к списку), картинки отправляются по file_id без байтов;
+#   перезапуск — новый процесс берёт file_id из базы и ничего не загружает;
+#   замена картинки — изменённый файл после перезагрузки каталога
+#     загружается заново, остальные нет.
+#
+#   python benchmarks/bench_media.py --cards 2000 --images 300 --users 500
+
+
+def build_catalog(directory: str, cards: int, images: int, image_kb: int) -> str:
+    os.makedirs(os.path.join(directory, "images"))
+    rng = random.Random(1)
+    for i in range(images):
+        with open(os.path.join(directory, "images", f"card_{i}.jpg"), "wb") as f:
+            f.write(rng.randbytes(image_kb * 1024))
+    catalog = synthetic_catalog(cards)
+    index = 0
+    for types in catalog["banks"].values():
+        for bank_cards in types.values():
+            for info in bank_cards.values():
+                info["image"] = f"images/card_{index % images}.jpg"
+                index += 1
+    path = os.path.join(directory, "catalog.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    return path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cards", type=int, default=2000)
+    parser.add_argument("--images", type=int, default=300)
+    parser.add_argument("--image-kb", type=int, default=100)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа Bot API, с")
+    return parser.parse_args()
+
+
+args = parse_args()
+directory = tempfile.mkdtemp(prefix="bench_media_")
+os.environ.update({
+    "BOT_TOKEN": "123456:MEDIA",
+    "CATALOG_PATH": build_catalog(directory, args.cards, args.images, args.image_kb),
+    "CATALOG_RELOAD_INTERVAL": "0",
+    "MEDIA_STORE": os.path.join(directory, "media.db"),
+    "MEDIA_WARMUP_CHAT_ID": "-100",
+    "MEDIA_WARMUP_CONCURRENCY": str(args.concurrency),
+    "METRICS_PATH": "",
+    "RATE_LIMIT_GLOBAL": "0",
+    "UPDATE_JOURNAL": "",
+})
+
+import bot
+from callback_codec import PREFIX
+from fake_telegram import FakeTelegramRequest
+from loadtest import Simulation, percentile
+
+FIRST_USER_ID = 10 ** 6
+
+
+async def start(latency: float):
+    fake = FakeTelegramRequest(latency)
+    application = bot.build_application(request=fake)
+    await application.initialize()
+    await bot.post_init(application)
+    started = time.perf_counter()
+    await asyncio.gather(*bot.card_media._tasks)
+    return application, fake, time.perf_counter() - started
+
+
+async def stop(application) -> None:
+    await bot.post_shutdown(application)
+    await application.shutdown()
+
+
+# Пользователь открывает карту, затем другую карту из того же списка,
+# возвращается к списку и открывает третью
+async def browse(simulation: Simulation, user_id: int, views: list) -> None:
+    await simulation.send_command(user_id, "/start")
+    await simulation.tap(user_id, "age_18_plus")
+    await simulation.tap(user_id, simulation.pick(user_id, "main_menu"))
+    await simulation.tap(user_id, simulation.pick(user_id, "main_menu"))
+    cards = list(simulation.fake.keyboards.get(user_id, ()))
+    for step in range(3):
+        if step == 2:
+            await simulation.tap(user_id, "back_to_cards")
+        data = simulation.random.choice([data for _, data in cards if data.startswith(PREFIX)])
+        started = time.perf_counter()
+        await simulation.tap(user_id, data)
+        views.append(time.perf_counter() - started)
+
+
+async def run() -> dict:
+    result = {"cards": args.cards, "images": args.images, "image_kb": args.image_kb}
+
+    application, fake, seconds = await start(args.latency)
+    result["warmup"] = {
+        "seconds": seconds,
+        "uploads": fake.uploads,
+        "uploaded_mib": fake.uploaded_bytes / 2 ** 20,
+        "max_concurrent_uploads": fake.max_photo_requests,
+    }
+    assert fake.uploads == args.images, fake.uploads
+    assert fake.max_photo_requests <= args.concurrency, fake.max_photo_requests
+
+    uploads = fake.uploads
+    simulation = Simulation(application, fake, seed=1)
+    views = []
+    started = time.perf_counter()
+    await asyncio.gather(*(browse(simulation, FIRST_USER_ID + i, views) for i in range(args.users)))
+    result["views"] = {
+        "count": len(views),
+        "seconds": time.perf_counter() - started,
+        "p50_ms": percentile(views, 0.5) * 1e3,
+        "p99_ms": percentile(views, 0.99) * 1e3,
+        "uploads": fake.uploads - uploads,
+        # Без отправок прогрева в служебный чат
+        "send_photo": fake.calls["sendPhoto"] - uploads,
+        "edit_media": fake.calls["editMessageMedia"],
+        "deleted": fake.calls["deleteMessage"] - uploads,
+    }
+    assert fake.uploads == uploads, fake.uploads
+    await stop(application)
+
+    application, fake, seconds = await start(args.latency)
+    result["restart"] = {"seconds": seconds, "uploads": fake.uploads}
+    assert fake.uploads == 0, fake.uploads
+
+    with open(os.path.join(directory, "images", "card_0.jpg"), "ab") as f:
+        f.write(b"\0")
+    await bot.catalog_store.reload()
+    started = time.perf_counter()
+    await asyncio.gather(*bot.card_media._tasks)
+    result["changed_image"] = {"seconds": time.perf_counter() - started, "uploads": fake.uploads}
+    assert fake.uploads == 1, fake.uploads
+    await stop(application)
+    return result
+
+
+def main() -> None:
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    logging.getLogger("media").setLevel(logging.INFO)
+    try:
+        result = asyncio.run(run())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
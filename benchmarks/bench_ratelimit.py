@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import BACKGROUND, OutboundScheduler
+
+# Интерактивный трафик во время рассылки: планировщик с общим лимитом
+# --rate, рассылка --broadcast-rate сообщений в секунду через
+# --broadcast-workers одновременных отправок (как Broadcaster), и нажатия
+# кнопок --clicks в секунду — каждое даёт answerCallbackQuery и правку
+# сообщения в своём чате. Сравниваются задержки нажатий, когда рассылка
+# идёт обычными запросами и фоновыми (rate_limit_args=BACKGROUND).
+#
+#   python benchmarks/bench_ratelimit.py --seconds 10
+
+
+async def run(args, background: bool) -> dict:
+    scheduler = OutboundScheduler(global_rate=args.rate, global_burst=args.rate)
+    await scheduler.initialize()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + args.seconds
+    sent = {"broadcast": 0, "interactive": 0}
+
+    async def call(kind: str) -> bool:
+        sent[kind] += 1
+        return True
+
+    async def broadcast_worker(worker: int) -> None:
+        chat_id = 10 ** 6 + worker
+        interval = args.broadcast_workers / args.broadcast_rate
+        while loop.time() < deadline:
+            started = loop.time()
+            await scheduler.process_request(
+                call, ("broadcast",), {}, "sendMessage", {"chat_id": chat_id},
+                BACKGROUND if background else None,
+            )
+            chat_id += args.broadcast_workers
+            await asyncio.sleep(max(0.0, interval - (loop.time() - started)))
+
+    latencies = []
+
+    async def click(number: int) -> None:
+        started = loop.time()
+        await scheduler.process_request(
+            call, ("interactive",), {}, "answerCallbackQuery", {"callback_query_id": str(number)}, None
+        )
+        await scheduler.process_request(
+            call, ("interactive",), {}, "editMessageText", {"chat_id": number, "message_id": 1}, None
+        )
+        latencies.append(loop.time() - started)
+
+    async def clicks() -> None:
+        number = 0
+        tasks = []
+        while loop.time() < deadline:
+            number += 1
+            tasks.append(asyncio.create_task(click(number)))
+            await asyncio.sleep(1 / args.clicks)
+        await asyncio.gather(*tasks)
+
+    await asyncio.gather(clicks(), *(broadcast_worker(worker) for worker in range(args.broadcast_workers)))
+    await scheduler.shutdown()
+    latencies.sort()
+    return {
+        "broadcast_per_second": sent["broadcast"] / args.seconds,
+        "click_p50_ms": latencies[len(latencies) // 2] * 1e3,
+        "click_p99_ms": latencies[int(len(latencies) * 0.99)] * 1e3,
+        "click_max_ms": latencies[-1] * 1e3,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--rate", type=float, default=30.0)
+    parser.add_argument("--broadcast-rate", type=float, default=25.0)
+    parser.add_argument("--broadcast-workers", type=int, default=8)
+    parser.add_argument("--clicks", type=float, default=5.0, help="нажатий кнопок в секунду")
+    args = parser.parse_args()
+
+    results = {
+        "same_lane": asyncio.run(run(args, background=False)),
+        "background_lane": asyncio.run(run(args, background=True)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_catalog import synthetic_catalog
+from catalog import CatalogStore
+from shortlinks import ShortLinks, make_redirect_handler, slug_for
+from webserver import HttpServer, Request
+
+# Переходы по коротким ссылкам: время обработчика (разрешение slug и
+# ответ 302) и сквозная пропускная способность HTTP сервера на одном
+# ядре. Клиенты — keep-alive соединения в том же цикле событий, что и
+# сервер, так что цифры пропускной способности занижены.
+#
+#   python benchmarks/bench_redirect.py --cards 10000 --connections 50 --requests 200
+
+PREFIX = "/r/"
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def bench_handler(handler, slugs, iterations: int) -> float:
+    requests = [Request("GET", PREFIX + random.choice(slugs), {}, {}, b"") for _ in range(iterations)]
+    started = time.perf_counter()
+    for request in requests:
+        await handler(request)
+    return (time.perf_counter() - started) / iterations
+
+
+async def client(port: int, slugs, count: int, latencies) -> None:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        for _ in range(count):
+            request = f"GET {PREFIX}{random.choice(slugs)} HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            started = time.perf_counter()
+            writer.write(request.encode("ascii"))
+            head = await reader.readuntil(b"\r\n\r\n")
+            latencies.append(time.perf_counter() - started)
+            if not head.startswith(b"HTTP/1.1 302"):
+                raise RuntimeError(head.decode("latin-1"))
+    finally:
+        writer.close()
+
+
+async def run(cards: int, connections: int, requests: int) -> dict:
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False, encoding="utf-8") as f:
+        json.dump(synthetic_catalog(cards), f, ensure_ascii=False)
+        path = f.name
+    try:
+        store = CatalogStore(path)
+        store.load()
+    finally:
+        os.unlink(path)
+
+    links = ShortLinks(store)
+    slugs = [slug_for(card) for card in store.current.cards]
+    handler = make_redirect_handler(links, PREFIX)
+    handler_seconds = await bench_handler(handler, slugs, 200000)
+
+    server = HttpServer("127.0.0.1", 0, max_connections=connections)
+    server.route("GET", PREFIX, handler, prefix=True)
+    await server.start()
+    latencies = []
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(server.port, slugs, requests, latencies) for _ in range(connections)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await server.stop()
+
+    return {
+        "cards": cards,
+        "handler_us": handler_seconds * 1e6,
+        "requests": len(latencies),
+        "redirects_per_second": len(latencies) / elapsed,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1e3,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1e3,
+        "clicks": sum(links.clicks.values()),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cards", type=int, default=10000)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200, help="запросов на соединение")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.cards, args.connections, args.requests))
+    print(f"Обработчик: {result['handler_us']:.2f} мкс на переход")
+    print(
+        f"HTTP: {result['redirects_per_second']:.0f} переходов/с, "
+        f"p50 {result['latency_p50_ms']:.2f} мс, p99 {result['latency_p99_ms']:.2f} мс "
+        f"({result['requests']} запросов, {args.connections} соединений)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import bot
+from catalog import load_catalog
+from render import build_screens
+
+# Сравнение CPU-времени на одно обновление: построение экранов на каждый
+# тап (как раньше) против выборки из предварительно построенного кэша.
+
+ITERATIONS = int(os.getenv("BENCH_ITERATIONS", "2000"))
+
+
+# Прежняя реализация: экран собирается заново на каждое обновление
+def legacy_render(banks, bank, card_type, card):
+    InlineKeyboardMarkup(
+        [[InlineKeyboardButton(b, callback_data=f"bank_{b}")] for b in banks]
+        + [[InlineKeyboardButton("📋 Все карты", callback_data="show_all_cards")],
+           [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
+    )
+    InlineKeyboardMarkup(
+        [[InlineKeyboardButton("Кредитные карты", callback_data="credit_cards")],
+         [InlineKeyboardButton("Дебетовые карты", callback_data="debit_cards")],
+         [InlineKeyboardButton("🔙 Назад", callback_data="back_to_banks")],
+         [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
+    )
+    InlineKeyboardMarkup(
+        [[InlineKeyboardButton(c, callback_data=f"card_{c}")] for c in banks[bank][card_type]]
+        + [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_card_type")],
+           [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
+    )
+    info = banks[bank][card_type][card]
+    text = f"🏦 <b>{bank}</b> - <b>{card}</b>\n\n"
+    text += "🔥 <b>Преимущества:</b>\n" + "\n".join(f"• {adv}" for adv in info["advantages"])
+    text += f"\n\n🔗 <a href='{info['ref_link']}'>Ссылка на карту</a>"
+    text = "📋 <b>Все доступные карты:</b>\n\n"
+    for b, types in banks.items():
+        text += f"🏦 <b>{b}</b>:\n"
+        for t, cards in types.items():
+            text += f"  <b>{t}:</b>\n"
+            for c, i in cards.items():
+                text += f"    • {c} ({i['age_limit']}+)\n"
+
+
+def cached_render(catalog, bank, card_type, card):
+    screens = catalog.screens.for_age(18)
+    screens.bank_selection
+    screens.card_type(bank)
+    screens.card_list(bank, card_type)
+    screens.card(bank, card_type, card)
+    screens.all_cards
+
+
+def measure(func, *args):
+    started = time.process_time()
+    for _ in range(ITERATIONS):
+        func(*args)
+    return (time.process_time() - started) / ITERATIONS
+
+
+def main():
+    with open(bot.CATALOG_PATH, encoding="utf-8") as f:
+        banks = json.load(f)["banks"]
+    bank = next(iter(banks))
+    card_type = next(iter(banks[bank]))
+    card = next(iter(banks[bank][card_type]))
+
+    started = time.process_time()
+    catalog = load_catalog(bot.CATALOG_PATH)
+    catalog.screens = build_screens(catalog)
+    build_time = time.process_time() - started
+
+    legacy = measure(legacy_render, banks, bank, card_type, card)
+    cached = measure(cached_render, catalog, bank, card_type, card)
+
+    print(f"catalog load + screens (once): {build_time * 1e3:.3f} ms")
+    print(f"legacy per update:   {legacy * 1e6:.1f} us")
+    print(f"cached per update:   {cached * 1e6:.1f} us")
+    print(f"speedup:             {legacy / cached:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import CallbackQuery, Update, User
+from telegram.ext import CallbackQueryHandler
+
+from callback_codec import CallbackDataError
+from catalog import load_catalog
+from render import ALL_CARDS_PAGE_PREFIX, TOP_CARDS_PREFIX
+from routing import (
+    ACTION_AGE, ACTION_ALL_CARDS_PAGE, ACTION_BACK_TO_BANKS, ACTION_BACK_TO_CARD_TYPE, ACTION_BACK_TO_CARDS,
+    ACTION_BANK, ACTION_CARD, ACTION_CARD_TYPE, ACTION_MAIN_MENU, ACTION_NAMES, ACTION_SHOW_ALL_CARDS,
+    ACTION_SHOW_TOP_CARDS, ACTION_TOP_CARDS, CallbackRouter, parse_callback,
+)
+
+# Выбор обработчика нажатия кнопки: прежняя цепочка (CallbackQueryHandler
+# с регулярными выражениями в каждом состоянии, затем сравнения query.data
+# внутри обработчика и попытка расшифровать данные как кнопку каталога)
+# против таблицы маршрутов routing.py. Меряется путь от Update до
+# выбранного обработчика, включая проверку точки входа (allow_reentry) и
+# расшифровку кнопок каталога; сами обработчики не выполняются.
+#
+#   python benchmarks/bench_routing.py
+
+REPEATS = int(os.getenv("BENCH_REPEATS", "20000"))
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "catalog.json")
+
+MAIN_MENU, BANK_SELECTION, CARD_TYPE_SELECTION, CARD_SELECTION, ALL_CARDS_VIEW, TOP_CARDS_VIEW = range(6)
+STATE_NAMES = ("MAIN_MENU", "BANK_SELECTION", "CARD_TYPE_SELECTION", "CARD_SELECTION", "ALL_CARDS_VIEW", "TOP_CARDS_VIEW")
+
+
+def legacy_handlers(ids):
+    def decode(kind, data):
+        try:
+            getattr(ids, "decode_" + kind)(data)
+            return kind
+        except CallbackDataError:
+            return "main_menu"
+
+    def age(data):
+        return "age"
+
+    def bank_selection(data):
+        if data == "show_all_cards":
+            return "show_all_cards"
+        if data == "show_top_cards":
+            return "show_top_cards"
+        if data == "main_menu":
+            return "main_menu"
+        return decode("bank", data)
+
+    def card_type_selection(data):
+        if data == "back_to_banks":
+            return "back_to_banks"
+        if data == "main_menu":
+            return "main_menu"
+        return decode("type", data)
+
+    def card_selection(data):
+        return decode("card", data)
+
+    def navigation(data):
+        if data == "main_menu":
+            return "main_menu"
+        if data == "back_to_banks":
+            return "back_to_banks"
+        if data == "back_to_card_type":
+            return "back_to_card_type"
+        if data == "back_to_cards":
+            return "back_to_cards"
+        return None
+
+    def all_cards_page(data):
+        int(data[len(ALL_CARDS_PAGE_PREFIX):])
+        return "all_cards_page"
+
+    def top_cards(data):
+        if data == "show_top_cards":
+            return "show_top_cards"
+        if data == "back_to_banks":
+            return "back_to_banks"
+        if data == "main_menu":
+            return "main_menu"
+        if not data.startswith(TOP_CARDS_PREFIX):
+            return card_selection(data)
+        return "top_cards"
+
+    entry = CallbackQueryHandler(age, pattern="^age_")
+    states = {
+        MAIN_MENU: [CallbackQueryHandler(age)],
+        BANK_SELECTION: [CallbackQueryHandler(bank_selection), CallbackQueryHandler(navigation, pattern="^main_menu$")],
+        CARD_TYPE_SELECTION: [
+            CallbackQueryHandler(card_type_selection), CallbackQueryHandler(navigation, pattern="^main_menu$"),
+        ],
+        CARD_SELECTION: [CallbackQueryHandler(card_selection), CallbackQueryHandler(navigation, pattern="^main_menu$")],
+        ALL_CARDS_VIEW: [
+            CallbackQueryHandler(all_cards_page, pattern=f"^{ALL_CARDS_PAGE_PREFIX}\\d+$"),
+            CallbackQueryHandler(navigation, pattern="^main_menu$"),
+        ],
+        TOP_CARDS_VIEW: [CallbackQueryHandler(top_cards)],
+    }
+
+    def resolve(state, update):
+        handlers = states[state]
+        if entry.check_update(update):
+            handlers = [entry]
+        for handler in handlers:
+            if handler.check_update(update):
+                return handler.callback(update.callback_query.data)
+        return None
+
+    return resolve
+
+
+def router_resolver(ids):
+    def named(name):
+        async def route(query, context, argument):
+            return name
+        route.__name__ = name
+        return route
+
+    def decoded(kind):
+        decode = getattr(ids, "decode_" + kind)
+
+        def resolve(data):
+            try:
+                decode(data)
+                return kind
+            except CallbackDataError:
+                return "main_menu"
+        return resolve
+
+    router = CallbackRouter(range(len(STATE_NAMES)), on_unknown=named("unknown"))
+    router.add(ACTION_AGE, named("age"))
+    for action in (ACTION_MAIN_MENU, ACTION_SHOW_ALL_CARDS, ACTION_SHOW_TOP_CARDS, ACTION_BACK_TO_BANKS):
+        router.add(action, named(ACTION_NAMES[action]))
+    router.add(ACTION_BANK, named("bank"), BANK_SELECTION)
+    router.add(ACTION_CARD_TYPE, named("type"), CARD_TYPE_SELECTION)
+    router.add(ACTION_BACK_TO_CARD_TYPE, named("back_to_card_type"), CARD_SELECTION)
+    router.add(ACTION_CARD, named("card"), CARD_SELECTION, TOP_CARDS_VIEW)
+    router.add(ACTION_BACK_TO_CARDS, named("back_to_cards"), CARD_SELECTION)
+    router.add(ACTION_ALL_CARDS_PAGE, named("all_cards_page"), ALL_CARDS_VIEW)
+    router.add(ACTION_TOP_CARDS, named("top_cards"), TOP_CARDS_VIEW)
+    table = router.table()
+    entry = CallbackQueryHandler(None, pattern=router.accepts(ACTION_AGE))
+    # Кнопки каталога расшифровываются обработчиком, как и в прежней цепочке
+    decoders = {ACTION_BANK: decoded("bank"), ACTION_CARD_TYPE: decoded("type"), ACTION_CARD: decoded("card")}
+
+    def resolve(state, update):
+        entry.check_update(update)
+        action, argument = parse_callback(update.callback_query.data)
+        route = table[state][action]
+        if route is None:
+            return "unknown"
+        decoder = decoders.get(action)
+        return decoder(argument) if decoder is not None else route.__name__
+
+    return resolve
+
+
+def make_update(data: str) -> Update:
+    user = User(1, "u", False)
+    return Update(1, callback_query=CallbackQuery("1", user, chat_instance="1", data=data))
+
+
+def main():
+    catalog = load_catalog(CATALOG_PATH)
+    ids = catalog.ids
+    bank = ids.encode_bank(ids.banks[0])
+    card_type = ids.encode_type(ids.types[0])
+    card = ids.encode_card(*ids.cards[0])
+    # Типичные нажатия в каждом состоянии
+    cases = {
+        MAIN_MENU: ["age_18_plus", "age_14_17"],
+        BANK_SELECTION: [bank, "show_all_cards", "show_top_cards", "main_menu"],
+        CARD_TYPE_SELECTION: [card_type, "back_to_banks", "main_menu"],
+        CARD_SELECTION: [card, "back_to_cards", "back_to_card_type", "main_menu"],
+        ALL_CARDS_VIEW: [f"{ALL_CARDS_PAGE_PREFIX}1", "back_to_banks", "main_menu"],
+        TOP_CARDS_VIEW: [f"{TOP_CARDS_PREFIX}grace", card, "show_top_cards", "back_to_banks"],
+    }
+    resolvers = (("цепочка", legacy_handlers(ids)), ("таблица", router_resolver(ids)))
+    print(f"{'состояние':22}{'callback_data':22}" + "".join(f"{name:>12}" for name, _ in resolvers) + "   ускорение")
+    totals = {name: 0.0 for name, _ in resolvers}
+    for state, datas in cases.items():
+        for data in datas:
+            update = make_update(data)
+            timings = []
+            for name, resolve in resolvers:
+                started = time.perf_counter()
+                for _ in range(REPEATS):
+                    resolve(state, update)
+                seconds = (time.perf_counter() - started) / REPEATS
+                totals[name] += seconds
+                timings.append(seconds)
+            label = data if len(data) < 20 else data[:17] + "..."
+            print(
+                f"{STATE_NAMES[state]:22}{label:22}"
+                + "".join(f"{seconds * 1e6:10.2f}мкс" for seconds in timings)
+                + f"   x{timings[0] / timings[1]:.1f}"
+            )
+    count = sum(len(datas) for datas in cases.values())
+    legacy, routed = (totals[name] / count for name, _ in resolvers)
+    print(f"В среднем: цепочка {legacy * 1e6:.2f} мкс, таблица {routed * 1e6:.2f} мкс, x{legacy / routed:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_catalog import synthetic_catalog
+from catalog import load_catalog
+from search import SearchIndex, terms
+
+# Время inline-поиска по синтетическому каталогу: построение индекса,
+# его память и задержка запроса для разных видов запросов. Запросы, слово
+# которых раскрывается в несколько основ, дополнительно сверяются с полным
+# перебором по catalog.json: в синтетическом каталоге у всех карт одни и
+# те же основы, и ошибки слияния основ там не видны.
+
+CARDS = int(os.getenv("BENCH_CARDS", "10000"))
+REPEATS = int(os.getenv("BENCH_REPEATS", "200"))
+
+QUERIES = (
+    "",
+    "кэшбэк",
+    "кэшб",
+    "кредитная карта",
+    "банк 42",
+    "карта 9999",
+    "без процентов 120",
+    "дебетовые кэшбэк 7",
+    "ки",
+    "несуществующее",
+)
+
+# Запросы catalog.json, слово которых раскрывается в несколько основ
+EXPANDED_QUERIES = ("карт", "сбер", "бес", "к", "кредитная бес")
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "catalog.json")
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# Выдача полным перебором: вес слова — лучший вес его основ у карты
+def reference_search(index: SearchIndex, query: str, age: int) -> list:
+    query_terms = list(dict.fromkeys(terms(query)))
+    last = len(query_terms) - 1
+    expansions = [index._expand(term, position == last) for position, term in enumerate(query_terms)]
+    scored = []
+    for card in index.cards:
+        if card.age_limit > age or card.id in index.hidden:
+            continue
+        weights = [max(index._postings[term].get(card.id, 0) for term in expansion) for expansion in expansions]
+        if all(weights):
+            scored.append((-sum(weights), card.id))
+    return [index.cards[card_id] for _, card_id in sorted(scored)]
+
+
+def check_expanded_queries() -> None:
+    catalog = load_catalog(CATALOG_PATH)
+    for query in EXPANDED_QUERIES:
+        for age in (14, 18):
+            expected = reference_search(catalog.search, query, age)
+            actual = catalog.search.search(query, age, limit=len(catalog.cards))
+            assert actual == expected, (query, age, [card.id for card in actual], [card.id for card in expected])
+    print(f"Запросы с несколькими основами совпадают с перебором: {', '.join(EXPANDED_QUERIES)}")
+
+
+def main():
+    check_expanded_queries()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False, encoding="utf-8") as f:
+        json.dump(synthetic_catalog(CARDS), f, ensure_ascii=False)
+        path = f.name
+    try:
+        catalog = load_catalog(path)
+    finally:
+        os.unlink(path)
+
+    started = time.perf_counter()
+    SearchIndex(catalog.cards)
+    build_seconds = time.perf_counter() - started
+    tracemalloc.start()
+    index = SearchIndex(catalog.cards)
+    index_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Карт: {CARDS}, индекс: {build_seconds * 1e3:.0f} мс, {index_bytes / 2**20:.1f} МиБ")
+
+    for query in QUERIES:
+        for age in (14, 18):
+            timings = []
+            for _ in range(REPEATS):
+                started = time.perf_counter()
+                results = index.search(query, age)
+                timings.append(time.perf_counter() - started)
+            print(
+                f"  {query!r:24} {age}+: {len(results):>3} карт, "
+                f"p50 {percentile(timings, 0.5) * 1e6:6.0f} мкс, p99 {percentile(timings, 0.99) * 1e6:6.0f} мкс"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sessions import Session, SessionCache
+
+# Память на сессии: user_data в виде словаря на пользователя (как в PTB
+# по умолчанию) против объектов со слотами в SessionCache. В обоих случаях
+# учитывается и запись состояния диалога ConversationHandler — ключ
+# (chat_id, user_id) и состояние. Строки банка и типа карты общие для всех
+# пользователей, как ссылки на строки каталога в боте.
+#
+#   python benchmarks/bench_sessions.py --users 100000
+
+BANKS = [f"Банк {i}" for i in range(20)]
+TYPES = ["Кредитные карты", "Дебетовые карты"]
+FIRST_USER_ID = 10 ** 9
+
+
+def fill(user_data, conversations, users: int, first_id: int = FIRST_USER_ID) -> None:
+    for i in range(users):
+        user_id = first_id + i
+        data = user_data(user_id)
+        data["age"] = 18
+        data["current_bank"] = BANKS[i % len(BANKS)]
+        data["card_type"] = TYPES[i % len(TYPES)]
+        conversations[(user_id, user_id)] = 3
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    keep = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del keep
+    return size
+
+
+def before(users: int):
+    store = defaultdict(dict)
+    conversations = {}
+    fill(store.__getitem__, conversations, users)
+    return store, conversations
+
+
+def after(users: int, max_sessions: int):
+    conversations = {}
+    cache = SessionCache(max_sessions=max_sessions, on_evict=lambda user_id, chat_id: conversations.pop((chat_id, user_id), None))
+    fill(lambda user_id: cache.get(user_id, user_id), conversations, users)
+    return cache, conversations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100000)
+    args = parser.parse_args()
+    users = args.users
+
+    dict_bytes = measure(lambda: before(users))
+    slots_bytes = measure(lambda: after(users, users))
+    # Десятикратный поток пользователей при лимите users сессий
+    capped_bytes = measure(lambda: after(users * 10, users))
+
+    print(f"Сессий: {users}")
+    print(f"  dict на пользователя:   {dict_bytes / 2**20:7.1f} МиБ, {dict_bytes / users:5.0f} байт/сессия")
+    print(f"  Session со слотами:     {slots_bytes / 2**20:7.1f} МиБ, {slots_bytes / users:5.0f} байт/сессия")
+    print(f"  {users * 10} пользователей при лимите {users}: {capped_bytes / 2**20:.1f} МиБ")
+    print(f"  sys.getsizeof: dict с 3 ключами {sys.getsizeof({'age': 18, 'current_bank': '', 'card_type': ''})} байт, "
+          f"Session {sys.getsizeof(Session(None, 0.0))} байт")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import functools
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Время запуска бота до готовности принимать обновления (time-to-ready):
+# от старта процесса до начала polling через локальную заглушку Bot API.
+# Каждый запуск — новый процесс, как при перезапуске или добавлении
+# экземпляра. Каталоги: catalog.json репозитория и синтетический на --cards
+# карт; режимы:
+#   json — каталог собирается из JSON при каждом запуске (без снимка);
+#   первый запуск — снимка ещё нет, каталог собирается и снимок записывается;
+#   снимок — каталог читается из готового снимка.
+# Медиана времени запуска со снимком сравнивается с бюджетом --budget.
+#
+#   python benchmarks/bench_startup.py --cards 10000 --runs 5 --budget 1
+
+
+def child(latency: float) -> None:
+    import asyncio
+    import signal
+
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    from fake_telegram import FakeTelegramRequest
+    from lifecycle import run_polling
+
+    async def serve() -> dict:
+        build = functools.partial(bot.build_application, request=FakeTelegramRequest(latency))
+        polling = asyncio.create_task(run_polling(build, 1, None, bot.startup))
+        while "polling" not in bot.startup.phases and not polling.done():
+            await asyncio.sleep(0.001)
+        ready_at = time.time()
+        os.kill(os.getpid(), signal.SIGTERM)
+        await polling
+        return {
+            "ready_at": ready_at,
+            "phases": bot.startup.phases,
+            "from_snapshot": bot.catalog_store.from_snapshot,
+            "cards": len(bot.catalog_store.current),
+        }
+
+    print(json.dumps(asyncio.run(serve())))
+
+
+# Запуск процесса бота; total — от старта процесса до готовности, секунды
+def boot(env: dict, latency: float) -> dict:
+    started = time.time()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", "--latency", str(latency)],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["total"] = result.pop("ready_at") - started
+    return result
+
+
+def summarize(results: list) -> dict:
+    summary = {"total_ms": statistics.median(result["total"] for result in results) * 1e3}
+    for phase in results[0]["phases"]:
+        summary[f"{phase}_ms"] = statistics.median(result["phases"][phase] for result in results) * 1e3
+    return {key: round(value, 1) for key, value in summary.items()}
+
+
+def run_case(directory: str, catalog_path: str, runs: int, latency: float) -> dict:
+    snapshot_path = os.path.join(directory, "catalog.snapshot")
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:STARTUP",
+        CATALOG_PATH=catalog_path,
+        CATALOG_RELOAD_INTERVAL="0",
+        UPDATE_JOURNAL="",
+        PORT="0",
+    )
+    json_env = dict(env, CATALOG_SNAPSHOT="")
+    snapshot_env = dict(env, CATALOG_SNAPSHOT=snapshot_path)
+    # Прогрев кэша страниц и байткода, чтобы сравнивались только режимы
+    boot(json_env, latency)
+
+    first = boot(snapshot_env, latency)
+    assert not first["from_snapshot"] and os.path.exists(snapshot_path), first
+    # Режимы чередуются, чтобы фоновая нагрузка машины делилась между ними поровну
+    json_runs, snapshot_runs = [], []
+    for _ in range(runs):
+        json_runs.append(boot(json_env, latency))
+        snapshot_runs.append(boot(snapshot_env, latency))
+    assert all(run["from_snapshot"] for run in snapshot_runs), snapshot_runs
+    return {
+        "cards": first["cards"],
+        "snapshot_kib": round(os.path.getsize(snapshot_path) / 1024),
+        "json": summarize(json_runs),
+        "first_run": summarize([first]),
+        "snapshot": summarize(snapshot_runs),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cards", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа Bot API, с")
+    parser.add_argument("--budget", type=float, default=1.0, help="бюджет времени запуска со снимком, с")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.latency)
+        return
+
+    from bench_catalog import synthetic_catalog
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix="bench_startup_")
+    try:
+        repo_dir = os.path.join(directory, "repo")
+        os.makedirs(repo_dir)
+        repo_catalog = shutil.copy(os.path.join(ROOT, "catalog.json"), repo_dir)
+        results["catalog.json"] = run_case(repo_dir, repo_catalog, args.runs, args.latency)
+
+        synthetic_dir = os.path.join(directory, "synthetic")
+        os.makedirs(synthetic_dir)
+        synthetic_path = os.path.join(synthetic_dir, "catalog.json")
+        with open(synthetic_path, "w", encoding="utf-8") as f:
+            json.dump(synthetic_catalog(args.cards), f, ensure_ascii=False)
+        results["synthetic"] = run_case(synthetic_dir, synthetic_path, args.runs, args.latency)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    over = {
+        name: result["snapshot"]["total_ms"] for name, result in results.items()
+        if result["snapshot"]["total_ms"] > args.budget * 1e3
+    }
+    if over:
+        sys.exit(f"Запуск со снимком дольше бюджета {args.budget} с: {over}")
+
+
+if __name__ == "__main__":
+    main()
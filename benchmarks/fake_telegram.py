@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+# Локальная замена Bot API для стендов: принимает запросы PTB, отвечает
+# правдоподобными результатами и запоминает последнюю клавиатуру в каждом
+# чате, чтобы имитируемый пользователь мог «нажимать» кнопки.
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "RefBot", "username": "refbot"}
+# Служебные методы, не входящие в лимиты отправки Telegram
+_SERVICE_ENDPOINTS = frozenset(("getMe", "getUpdates", "setWebhook", "deleteWebhook"))
+
+
+class FakeTelegramRequest(BaseRequest):
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.keyboards: Dict[int, List[Tuple[str, str]]] = {}
+        self._message_ids: Dict[int, int] = {}
+        # Фото последнего сообщения в чате, если оно с фото
+        self._photos: Dict[int, List[dict]] = {}
+        # Загруженные файлы: отправки фото с байтами и их объём
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        # Сколько отправок фото выполняется одновременно и максимум за всё время
+        self.photo_requests = 0
+        self.max_photo_requests = 0
+        # Время (time.time) каждого запроса, кроме служебных
+        self.sent_at: List[float] = []
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def last_message_id(self, chat_id: int) -> int:
+        return self._message_ids.get(chat_id, 1)
+
+    def last_photo(self, chat_id: int) -> Optional[List[dict]]:
+        return self._photos.get(chat_id)
+
+    def _message(self, chat_id: int, params: dict, message_id: Optional[int] = None) -> dict:
+        if message_id is None:
+            message_id = self._message_ids.get(chat_id, 0) + 1
+            self._message_ids[chat_id] = message_id
+        self._photos.pop(chat_id, None)
+        markup = params.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if markup is not None:
+            self.keyboards[chat_id] = [
+                (button["text"], button.get("callback_data", ""))
+                for row in markup.get("inline_keyboard", ())
+                for button in row
+            ]
+        message = {
+            "message_id": message_id,
+            "from": BOT_USER,
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+            "text": params.get("text", ""),
+        }
+        if markup is not None:
+            message["reply_markup"] = markup
+        return message
+
+    # file_id фото: переданный строкой или выданный за загруженные байты
+    def _photo(self, photo, files: dict) -> List[dict]:
+        if isinstance(photo, str) and photo.startswith("attach://"):
+            photo = files.get(photo[len("attach://"):])
+        if isinstance(photo, tuple):
+            content = photo[1]
+            self.uploads += 1
+            self.uploaded_bytes += len(content)
+            photo = "photo-" + hashlib.blake2b(content, digest_size=8).hexdigest()
+        return [{"file_id": photo, "file_unique_id": photo, "width": 320, "height": 200}]
+
+    def _photo_message(self, chat_id: int, params: dict, photo: List[dict], message_id: Optional[int] = None) -> dict:
+        message = self._message(chat_id, params, message_id)
+        del message["text"]
+        message["photo"] = self._photos[chat_id] = photo
+        if params.get("caption"):
+            message["caption"] = params["caption"]
+        return message
+
+    def respond(self, endpoint: str, params: dict, files: Optional[dict] = None):
+        files = files or {}
+        if endpoint == "sendPhoto":
+            photo = self._photo(params.get("photo") or files.get("photo"), files)
+            return self._photo_message(int(params["chat_id"]), params, photo)
+        if endpoint == "editMessageMedia":
+            media = params["media"]
+            if isinstance(media, str):
+                media = json.loads(media)
+            photo = self._photo(media["media"], files)
+            if "inline_message_id" in params:
+                return True
+            return self._photo_message(int(params["chat_id"]), dict(params, caption=media.get("caption")), photo, int(params["message_id"]))
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint == "getUpdates":
+            return []
+        if endpoint == "sendMessage":
+            return self._message(int(params["chat_id"]), params)
+        if endpoint.startswith("editMessage"):
+            if "inline_message_id" in params:
+                return True
+            return self._message(int(params["chat_id"]), params, int(params["message_id"]))
+        return True
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if endpoint not in _SERVICE_ENDPOINTS:
+            self.sent_at.append(time.time())
+        photo = endpoint in ("sendPhoto", "editMessageMedia")
+        if photo:
+            self.photo_requests += 1
+            self.max_photo_requests = max(self.max_photo_requests, self.photo_requests)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        finally:
+            if photo:
+                self.photo_requests -= 1
+        params = request_data.parameters if request_data is not None else {}
+        files = request_data.multipart_data if request_data is not None and request_data.contains_files else None
+        result = self.respond(endpoint, params, files)
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("RATE_LIMIT_GLOBAL", "0")
+os.environ.setdefault("CATALOG_RELOAD_INTERVAL", "0")
+
+from telegram import Update
+
+import bot
+from callback_codec import PREFIX
+from fake_telegram import BOT_USER, FakeTelegramRequest
+
+# Нагрузочный стенд без Telegram: синтетические Update подаются прямо в
+# Application из bot.build_application(), Bot API заменён локальной
+# заглушкой. Каждый пользователь проходит сценарий
+# /start → возраст → банк → тип → карта → назад → главное меню,
+# нажимая кнопки из последней присланной ему клавиатуры.
+#
+#   python benchmarks/loadtest.py --users 1000 10000 100000 --output loadtest.json
+#
+# С --workers N пользователи делятся по user_id между N процессами, как
+# между рабочими процессами супервизора, и у каждого процесса свой
+# планировщик с BOT_WORKERS=N и RATE_LIMIT_GLOBAL=--rate-limit. Отправки
+# всех процессов сводятся по времени и сравниваются с общим лимитом.
+#
+#   python benchmarks/loadtest.py --users 1000 --workers 4 --rate-limit 200
+
+
+class Simulation:
+    def __init__(self, application, fake: FakeTelegramRequest, seed: int):
+        self.application = application
+        self.fake = fake
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.latencies = []
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+    async def _process(self, data: dict) -> None:
+        update = Update.de_json(data, self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies.append(time.perf_counter() - started)
+
+    async def send_command(self, user_id: int, text: str) -> None:
+        await self._process({
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.update_ids),
+                "from": self._user(user_id),
+                "chat": {"id": user_id, "type": "private"},
+                "date": int(time.time()),
+                "text": text,
+                "entities": [{"offset": 0, "length": len(text), "type": "bot_command"}],
+            },
+        })
+
+    async def tap(self, user_id: int, data: str) -> None:
+        message = {
+            "message_id": self.fake.last_message_id(user_id),
+            "from": BOT_USER,
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+        }
+        photo = self.fake.last_photo(user_id)
+        if photo is not None:
+            message["photo"] = photo
+        else:
+            message["text"] = "…"
+        await self._process({
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": f"{user_id}-{next(self.update_ids)}",
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": message,
+            },
+        })
+
+    # Случайная кнопка каталога из последней клавиатуры, иначе служебная
+    def pick(self, user_id: int, fallback: str) -> str:
+        options = [data for _, data in self.fake.keyboards.get(user_id, ()) if data.startswith(PREFIX)]
+        return self.random.choice(options) if options else fallback
+
+    async def user_flow(self, user_id: int) -> None:
+        await self.send_command(user_id, "/start")
+        await self.tap(user_id, "age_18_plus")
+        await self.tap(user_id, self.pick(user_id, "main_menu"))
+        await self.tap(user_id, self.pick(user_id, "main_menu"))
+        await self.tap(user_id, self.pick(user_id, "main_menu"))
+        await self.tap(user_id, "back_to_cards")
+        await self.tap(user_id, "main_menu")
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(users: int, latency: float, seed: int, alloc_sample: int) -> dict:
+    fake = FakeTelegramRequest(latency=latency)
+    application = bot.build_application(request=fake)
+    await application.initialize()
+    try:
+        simulation = Simulation(application, fake, seed)
+        skipped, not_modified = bot.rendered_messages.skipped, bot.rendered_messages.not_modified
+        started = time.perf_counter()
+        await asyncio.gather(*(simulation.user_flow(user_id) for user_id in range(1, users + 1)))
+        elapsed = time.perf_counter() - started
+        latencies = simulation.latencies
+        skipped = bot.rendered_messages.skipped - skipped
+        not_modified = bot.rendered_messages.not_modified - not_modified
+
+        # Отдельный прогон на выборке пользователей под tracemalloc
+        sample = Simulation(application, fake, seed)
+        blocks_before = sys.getallocatedblocks()
+        tracemalloc.start()
+        for user_id in range(users + 1, users + 1 + alloc_sample):
+            await sample.user_flow(user_id)
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sample_updates = max(len(sample.latencies), 1)
+        retained_blocks = sys.getallocatedblocks() - blocks_before
+    finally:
+        await application.shutdown()
+
+    return {
+        "users": users,
+        "updates": len(latencies),
+        "api_latency_seconds": latency,
+        "elapsed_seconds": elapsed,
+        "updates_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1e3,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1e3,
+        "latency_max_ms": max(latencies) * 1e3 if latencies else 0.0,
+        "traced_peak_bytes_per_update": traced_peak / sample_updates,
+        "retained_blocks_per_update": retained_blocks / sample_updates,
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "api_calls": dict(fake.calls),
+        "edits_skipped": skipped,
+        "edits_not_modified": not_modified,
+    }
+
+
+# Доля пользователей одного процесса; времена запросов к Bot API — в results
+def rate_worker(index: int, workers: int, users: int, latency: float, seed: int, results) -> None:
+    async def serve() -> list:
+        fake = FakeTelegramRequest(latency=latency)
+        application = bot.build_application(request=fake)
+        await application.initialize()
+        try:
+            simulation = Simulation(application, fake, seed + index)
+            await asyncio.gather(*(
+                simulation.user_flow(user_id) for user_id in range(1, users + 1) if user_id % workers == index
+            ))
+        finally:
+            await application.shutdown()
+        return fake.sent_at
+
+    results.put(asyncio.run(serve()))
+
+
+# Наибольшее число запросов в скользящем окне window секунд
+def max_in_window(times: list, window: float) -> int:
+    best = start = 0
+    for end, moment in enumerate(times):
+        while moment - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def run_workers(users: int, workers: int, rate_limit: float, latency: float, seed: int) -> dict:
+    # Дочерние процессы импортируют bot заново, уже с этими настройками
+    os.environ["BOT_WORKERS"] = str(workers)
+    os.environ["RATE_LIMIT_GLOBAL"] = str(rate_limit)
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [
+        context.Process(target=rate_worker, args=(index, workers, users, latency, seed, results))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    times = sorted(itertools.chain.from_iterable(results.get() for _ in processes))
+    for process in processes:
+        process.join()
+    # Первая секунда — стартовый запас bucket'ов, дальше устойчивая скорость
+    steady = [moment for moment in times if moment >= times[0] + 1.0]
+    steady_seconds = steady[-1] - steady[0] if len(steady) > 1 else 0.0
+    return {
+        "users": users,
+        "workers": workers,
+        "rate_limit": rate_limit,
+        "requests": len(times),
+        "elapsed_seconds": times[-1] - times[0] if times else 0.0,
+        "max_per_second": max_in_window(times, 1.0),
+        "steady_max_per_second": max_in_window(steady, 1.0),
+        "steady_per_second": (len(steady) - 1) / steady_seconds if steady_seconds else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[1000])
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа заглушки Bot API, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--alloc-sample", type=int, default=200)
+    parser.add_argument("--output", default="loadtest.json")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов с отдельными планировщиками")
+    parser.add_argument("--rate-limit", type=float, default=30.0, help="RATE_LIMIT_GLOBAL при --workers > 1")
+    args = parser.parse_args()
+
+    results = []
+    if args.workers > 1:
+        for users in args.users:
+            result = run_workers(users, args.workers, args.rate_limit, args.latency, args.seed)
+            results.append(result)
+            print(
+                f"{users:>7} users, {args.workers} workers: {result['requests']} requests, "
+                f"steady {result['steady_per_second']:.1f}/s (max {result['steady_max_per_second']}/s), "
+                f"first second {result['max_per_second']}/s "
+                f"at limit {args.rate_limit:g}/s"
+            )
+        # Те же гарантии, что у одного процесса: средняя скорость не выше
+        # лимита, а в любую секунду — не больше лимита плюс запас bucket'ов,
+        # в сумме по процессам тоже равный лимиту
+        over = [
+            result for result in results
+            if result["steady_per_second"] > args.rate_limit * 1.05
+            or max(result["max_per_second"], result["steady_max_per_second"]) > 2 * args.rate_limit + args.workers
+        ]
+    for users in args.users if args.workers <= 1 else ():
+        result = asyncio.run(run(users, args.latency, args.seed, args.alloc_sample))
+        results.append(result)
+        print(
+            f"{users:>7} users: {result['updates_per_second']:>8.0f} upd/s  "
+            f"p50 {result['latency_p50_ms']:.3f} ms  p99 {result['latency_p99_ms']:.3f} ms  "
+            f"rss {result['peak_rss_mib']:.0f} MiB  "
+            f"edits skipped {result['edits_skipped']}, not modified {result['edits_not_modified']}"
+        )
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {args.output}")
+    if args.workers > 1 and over:
+        sys.exit(f"Общая скорость отправки выше лимита {args.rate_limit:g}/с: {over}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,49 @@
+import time
+
+# Отсчёт времени запуска — до импорта остальных модулей
+STARTUP_STARTED = time.perf_counter()
+
 import logging
 import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from typing import TYPE_CHECKING, Optional
+from telegram import InlineQueryResultArticle, InlineQueryResultsButton, InputMediaPhoto, InputTextMessageContent, Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ConversationHandler, ContextTypes
+from telegram.error import BadRequest, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ConversationHandler, ContextTypes, InlineQueryHandler, filters
 from dotenv import load_dotenv
 import asyncio
+import functools
+from urllib.parse import urlsplit
+
+import analytics
+import metrics
+from callback_codec import CallbackDataError, payload_generation
+from catalog import Catalog, CatalogStore
+from edit_cache import RenderedMessages
+from lifecycle import StartupTimer, TrackedApplication, UpdateJournal, run_polling
+from persistence import SessionContext, create_persistence
+from sessions import SESSION_BYTES, SessionCache
+from ratelimit import BACKGROUND, OutboundScheduler
+from render import AgeScreens, Screen, build_screens
+from routing import (
+    ACTION_AGE, ACTION_ALL_CARDS_PAGE, ACTION_BACK_TO_BANKS, ACTION_BACK_TO_CARD_TYPE, ACTION_BACK_TO_CARDS,
+    ACTION_BANK, ACTION_CARD, ACTION_CARD_TYPE, ACTION_MAIN_MENU, ACTION_SHOW_ALL_CARDS, ACTION_SHOW_TOP_CARDS,
+    ACTION_TOP_CARDS, CallbackRouter,
+)
+from snapshot import CatalogSnapshot
+from webserver import HttpServer
+
+# Модули выключенных возможностей не загружаются: их импорт — там, где
+# возможность включается; здесь — только для аннотаций
+if TYPE_CHECKING:
+    from broadcast import Broadcaster
+    from linkcheck import LinkChecker
+    from media import CardMedia
 
 # Logging setup
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levellevelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
@@ -17,590 +52,868 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Число рабочих процессов; больше 1 включает режим супервизора
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Хранилище сессий: "sqlite:sessions.db", "aof:sessions.log" или пусто (только память)
+SESSION_STORE = os.getenv("SESSION_STORE", "")
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+# Сессии в памяти без SESSION_STORE: срок простоя, секунды, и лимит памяти, МиБ
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "86400"))
+SESSION_MEMORY_LIMIT_MB = float(os.getenv("SESSION_MEMORY_LIMIT_MB", "64"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+# Лимиты исходящих запросов к Bot API, запросов в секунду (0 — без ограничений)
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))
+RATE_LIMIT_CHAT = float(os.getenv("RATE_LIMIT_CHAT", "1"))
+# Сколько сообщений помнить для пропуска правок без изменений
+RENDERED_MESSAGES_CACHE = int(os.getenv("RENDERED_MESSAGES_CACHE", "50000"))
+# Хранилище событий аналитики: "sqlite:analytics.db", "csv:analytics" или пусто (выключено)
+ANALYTICS_STORE = os.getenv("ANALYTICS_STORE", "")
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "10"))
+# Базовый адрес коротких ссылок на карты, например https://example.com/r/;
+# пусто — в сообщениях исходные реферальные ссылки
+SHORTLINK_BASE_URL = os.getenv("SHORTLINK_BASE_URL", "")
+SHORTLINK_TTL = float(os.getenv("SHORTLINK_TTL", "60"))
+# Путь эндпоинта метрик Prometheus на HTTP сервере бота; пусто — метрики не собираются
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+# Порог медленного обновления, секунды (0 — замер выключен) и доля
+# обновлений, обрабатываемых под сэмплирующим профайлером
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", "0"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.05"))
+SLOW_UPDATE_BUFFER = int(os.getenv("SLOW_UPDATE_BUFFER", "50"))
+SLOW_UPDATES_PATH = "/debug/slow-updates"
+# Токен в заголовке X-Debug-Token для SLOW_UPDATES_PATH; без него буфер
+# медленных обновлений по HTTP не отдаётся
+SLOW_UPDATES_TOKEN = os.getenv("SLOW_UPDATES_TOKEN", "")
+# Сколько секунд Telegram может кэшировать ответ на inline-запрос
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_RESULTS_LIMIT = 50
+# Рассылки: файл SQLite с подписчиками и очередью рассылок (пусто — выключены),
+# лимит отправок в секунду и число одновременных отправок
+BROADCAST_STORE = os.getenv("BROADCAST_STORE", "")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+# Картинки карт: файл SQLite с file_id загруженных картинок (пусто — карты
+# без картинок), служебный чат для прогрева (0 — картинки загружаются при
+# первом показе) и число одновременных загрузок при прогреве
+MEDIA_STORE = os.getenv("MEDIA_STORE", "")
+MEDIA_WARMUP_CHAT_ID = int(os.getenv("MEDIA_WARMUP_CHAT_ID", "0"))
+MEDIA_WARMUP_CONCURRENCY = int(os.getenv("MEDIA_WARMUP_CONCURRENCY", "4"))
+# Проверка реферальных ссылок: файл SQLite с результатами (пусто — выключена),
+# период повторной проверки, число одновременных запросов, лимит запросов в
+# секунду к одному хосту, сколько ошибок подряд скрывают карту и таймаут запроса
+LINKCHECK_STORE = os.getenv("LINKCHECK_STORE", "")
+LINKCHECK_INTERVAL = float(os.getenv("LINKCHECK_INTERVAL", "600"))
+LINKCHECK_CONCURRENCY = int(os.getenv("LINKCHECK_CONCURRENCY", "32"))
+LINKCHECK_HOST_RATE = float(os.getenv("LINKCHECK_HOST_RATE", "2"))
+LINKCHECK_FAILURES = int(os.getenv("LINKCHECK_FAILURES", "3"))
+LINKCHECK_TIMEOUT = float(os.getenv("LINKCHECK_TIMEOUT", "10"))
+# user_id администраторов через запятую: им доступны команды рассылок
+ADMIN_IDS = [int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id]
+# Дедлайн дочитки очереди обновлений при остановке, секунды
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "10"))
+# Журнал обработанных и переданных при перезапуске обновлений (пусто — выключен)
+UPDATE_JOURNAL = os.getenv(
+    "UPDATE_JOURNAL", os.path.join(os.path.dirname(os.path.abspath(__file__)), "updates.journal")
+)
+# Бюджет времени запуска, секунды: при превышении — предупреждение в логе
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "5"))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8443"))
+
 # Dialog states
-MAIN_MENU, BANK_SELECTION, CARD_TYPE_SELECTION, CARD_SELECTION, ALL_CARDS_VIEW = range(5)
+MAIN_MENU, BANK_SELECTION, CARD_TYPE_SELECTION, CARD_SELECTION, ALL_CARDS_VIEW, TOP_CARDS_VIEW = range(6)
+STATE_NAMES = ("MAIN_MENU", "BANK_SELECTION", "CARD_TYPE_SELECTION", "CARD_SELECTION", "ALL_CARDS_VIEW", "TOP_CARDS_VIEW")
 
 # Data about banks and cards
-banks = {
-    "Газпромбанк": {
-        "Кредитные карты": {
-            "Кредитная карта 180 дней": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 180 дней без процентов на покупки и снятие наличных",
-                    "Кредитный лимит: до 600 000 рублей",
-                    "Кэшбэк до 10% у партнеров банка",
-                    "Процентная ставка от 11,9% годовых после льготного периода",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц, иначе — 199 рублей в месяц",
-                    "Оформление онлайн и бесплатная доставка карты"
-                ],
-                "ref_link": "https://example.com/gazprombank_180"
-            },
-            "Кредитная карта 180 дней (для блогеров и соц. сетей)": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 180 дней без процентов на покупки и снятие наличных",
-                    "Кредитный лимит: до 600 000 рублей",
-                    "Повышенный кэшбэк для категорий, связанных с деятельностью в соцсетях и блогинге",
-                    "Процентная ставка от 11,9% годовых после льготного периода",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц, иначе — 199 рублей в месяц",
-                    "Специальные условия и бонусы для активных пользователей соцсетей"
-                ],
-                "ref_link": "https://example.com/gazprombank_bloggers"
-            }
-        },
-        "Дебетовые карты": {
-            "Премиум МИР Supreme": {
-                "age_limit": 18,
-                "advantages": [
-                    "1,5% на все покупки",
-                    "До 20% у партнеров банка",
-                    "До 5% годовых на остаток средств",
-                    "Бесплатное снятие наличных в банкоматах Газпромбанка",
-                    "До 100 000 рублей в месяц без комиссии в банкоматах других банков",
-                    "Бесплатные переводы через СБП до 100 000 рублей в месяц",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатное обслуживание при среднемесячном остатке от 100 000 рублей или тратах от 30 000 рублей в месяц, иначе — 199 рублей в месяц",
-                    "Премиальная карта с выгодными условиями для активных пользователей"
-                ],
-                "ref_link": "https://example.com/gazprombank_premium_supreme"
-            },
-            "Дебетовая карта «Мир»": {
-                "age_limit": 18,
-                "advantages": [
-                    "1% на все покупки",
-                    "До 15% у партнеров банка",
-                    "До 4% годовых на остаток средств",
-                    "Бесплатное снятие наличных в банкоматах Газпромбанка",
-                    "До 50 000 рублей в месяц без комиссии в банкоматах других банков",
-                    "Бесплатные переводы через СБП до 100 000 рублей в месяц",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц, иначе — 99 рублей в месяц",
-                    "Оптимальный выбор для повседневных расходов с выгодным кэшбэком"
-                ],
-                "ref_link": "https://example.com/gazprombank_mir"
-            }
-        }
-    },
-    "Банк Зенит": {
-        "Кредитные карты": {
-            "Кредитная карта с кешбэком": {
-                "age_limit": 18,
-                "advantages": [
-                    "Кэшбэк 1% на все покупки",
-                    "5% в выбранных категориях",
-                    "До 100 дней без процентов",
-                    "Кредитный лимит: до 500 000 рублей",
-                    "Процентная ставка от 12,5% годовых после льготного периода",
-                    "Бесплатное обслуживание при тратах от 10 000 рублей в месяц, иначе — 149 рублей в месяц",
-                    "Быстрое оформление и удобное мобильное приложение"
-                ],
-                "ref_link": "https://example.com/zenit_cashback"
-            }
-        }
-    },
-    "Т-Банк": {
-        "Кредитные карты": {
-            "Карта Платинум": {
-                "age_limit": 18,
-                "advantages": [
-                    "Кэшбэк 1% на все покупки",
-                    "До 30% у партнеров банка",
-                    "До 55 дней без процентов",
-                    "Кредитный лимит: до 700 000 рублей",
-                    "Процентная ставка от 12% годовых после льготного периода",
-                    "Бесплатное обслуживание при тратах от 3 000 рублей в месяц, иначе — 99 рублей в месяц",
-                    "Оформление онлайн и бесплатная доставка карты"
-                ],
-                "ref_link": "https://example.com/tbank_platinum"
-            },
-            "Кредитная карта All Games": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 5% кэшбэка на покупки игр и внутриигровых товаров",
-                    "До 55 дней без процентов",
-                    "Кредитный лимит: до 700 000 рублей",
-                    "Процентная ставка от 12% годовых после льготного периода",
-                    "Бесплатное обслуживание при тратах от 3 000 рублей в месяц, иначе — 99 рублей в месяц",
-                    "Специальные предложения для геймеров и бонусы в популярных играх"
-                ],
-                "ref_link": "https://example.com/tbank_allgames"
-            }
-        },
-        "Дебетовые карты": {
-            "Black": {
-                "age_limit": 18,
-                "advantages": [
-                    "1% на все покупки",
-                    "До 15% у партнеров банка",
-                    "До 3% годовых на остаток свыше 10 000 рублей",
-                    "Бесплатное снятие наличных в банкоматах Т-Банка",
-                    "До 50 000 рублей в месяц без комиссии в банкоматах других банков",
-                    "Бесплатные переводы через СБП до 100 000 рублей в месяц",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц или среднемесячном остатке от 10 000 рублей, иначе — 149 рублей в месяц",
-                    "Стильная карта с выгодными условиями для повседневного использования"
-                ],
-                "ref_link": "https://example.com/tbank_black"
-            },
-            "Premium": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 30% по спецпредложениям партнеров",
-                    "До 15% за билеты в кино, театры, на концерты при покупке в Т‑Городе",
-                    "До 10% за отели и авиабилеты в приложении Т‑Банка",
-                    "До 5% за покупку продуктов Т‑Страхования",
-                    "До 17% годовых по накопительному счету с подпиской Pro",
-                    "Бесплатное снятие наличных от 3 000 до 100 000 рублей в любых банкоматах по всему миру",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатные переводы через СБП до 100 000 рублей в месяц",
-                    "Бесплатное обслуживание при постоянном остатке на картсчетах, вкладах, накопительных счетах и в инвестициях от 50 000 рублей, иначе — 99 рублей в месяц",
-                    "Премиальная карта с расширенными возможностями для взыскательных клиентов"
-                ],
-                "ref_link": "https://example.com/tbank_premium"
-            }
-        }
-    },    "СберБанк": {
-        "Кредитные карты": {
-            "Кредитная карта": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 50 дней без процентов",
-                    "Кредитный лимит: до 600 000 рублей",
-                    "Спасибо от Сбербанка: до 30% бонусами у партнеров",
-                    "Процентная ставка от 11,9% годовых после льготного периода",
-                    "От 0 до 750 рублей в год, в зависимости от типа карты",
-                    "Широкая сеть обслуживания и бонусная программа"
-                ],
-                "ref_link": "https://example.com/sber_credit"
-            }
-        },
-        "Дебетовые карты": {
-            "СберКарта МИР": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 10% у партнеров",
-                    "До 1,5% на все покупки",
-                    "До 6% при остатке от 50 000 рублей",
-                    "Бесплатное снятие наличных в банкоматах Сбербанка",
-                    "Бесплатные переводы через СБП до 100 000 рублей",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц, иначе — 150 рублей",
-                    "Отличный выбор для клиентов Сбербанка с удобной бонусной программой"
-                ],
-                "ref_link": "https://example.com/sber_debit"
-            }
-        }
-    },
-    "Уралсиб Банк": {
-        "Кредитные карты": {
-            "Кредитная карта «120 дней»": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 120 дней без процентов на покупки и снятие наличных",
-                    "Кредитный лимит: до 1 000 000 рублей",
-                    "До 1,5% на все покупки",
-                    "Процентная ставка от 13,9% годовых после льготного периода",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц, иначе — 199 рублей в месяц",
-                    "Возможность бесплатного обслуживания и длительный льготный период"
-                ],
-                "ref_link": "https://example.com/uralsib_120"
-            }
-        },
-        "Дебетовые карты": {
-            "Прибыль": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 10% на любимые категории",
-                    "1% на все покупки",
-                    "До 6% годовых",
-                    "Бесплатное снятие наличных в любых банкоматах при снятии от 3 000 рублей",
-                    "Бесплатные переводы через СБП до 100 000 рублей",
-                    "Бесплатное обслуживание при тратах от 10 000 рублей, иначе — 99 рублей",
-                    "Оптимальная карта с высокой доходностью и хорошим кэшбэком"
-                ],
-                "ref_link": "https://example.com/uralsib_profit"
-            }
-        }
-    },
-    "Совкомбанк": {
-        "Кредитные карты": {
-            "Карта «Халва»": {
-                "age_limit": 18,
-                "advantages": [
-                    "Беспроцентная рассрочка до 12 месяцев у партнеров банка",
-                    "До 6% на остаток собственных средств",
-                    "До 108 дней без процентов",
-                    "Кредитный лимит: до 350 000 рублей",
-                    "0% при покупках в рассрочку у партнеров",
-                    "Бесплатное обслуживание"
-                ],
-                "ref_link": "https://example.com/sovcombank_halva"
-            }
-        }
-    },
-    "Ак Барс": {
-        "Кредитные карты": {
-            "Кредитная карта 115 дней": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 115 дней без процентов",
-                    "Кредитный лимит: до 600 000 рублей"
-                ],
-                "ref_link": "https://example.com/akbars_115"
-            }
-        }
-    },
-    "АТБ": {
-        "Кредитные карты": {
-            "Кредитная карта «Универсальная»": {
-                "age_limit": 18,
-                "advantages": [
-                    "Кэшбэк 1% на все покупки",
-                    "До 10% у партнеров банка",
-                    "До 50 дней без процентов",
-                    "Кредитный лимит: до 500 000 рублей",
-                    "Процентная ставка от 13,9% годовых после льготного периода",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц, иначе — 99 рублей",
-                    "Универсальная карта с выгодным кэшбэком и длительным льготным периодом"
-                ],
-                "ref_link": "https://example.com/atb_universal"
-            }
-        }
-    },
-    "ВТБ": {
-        "Кредитные карты": {
-            "Кредитная карта": {
-                "age_limit": 18,
-                "advantages": [
-                    "Кэшбэк 1,5% на все покупки",
-                    "До 10% у партнеров банка",
-                    "До 110 дней без процентов",
-                    "Кредитный лимит: до 1 000 000 рублей",
-                    "Процентная ставка от 14,6% годовых после льготного периода",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц, иначе — 249 рублей",
-                    "Идеальный выбор для тех, кто ценит длительный льготный период и высокий кредитный лимит"
-                ],
-                "ref_link": "https://example.com/vtb_credit"
-            }
-        },
-        "Дебетовые карты": {
-            "МИР": {
-                "age_limit": 18,
-                "advantages": [
-                    "1% на все покупки",
-                    "До 10% у партнеров банка",
-                    "До 5% годовых на остаток свыше 15 000 рублей",
-                    "Бесплатное снятие наличных в банкоматах ВТБ",
-                    "До 50 000 рублей в месяц без комиссии в банкоматах других банков",
-                    "Бесплатные переводы через СБП до 100 000 рублей",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц или среднемесячном остатке от 15 000 рублей, иначе — 249 рублей",
-                    "Удобная карта с выгодными условиями для повседневных расходов"
-                ],
-                "ref_link": "https://example.com/vtb_mir"
-            },
-            "Платёжный стикер": {
-                "age_limit": 18,
-                "advantages": [
-                    "1% на все покупки",
-                    "До 10% у партнеров банка",
-                    "До 5% годовых на остаток свыше 15 000 рублей",
-                    "Бесплатное снятие наличных в банкоматах ВТБ",
-                    "До 50 000 рублей в месяц без комиссии в банкоматах других банков",
-                    "Бесплатные переводы через СБП до 100 000 рублей",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатное обслуживание при тратах от 5 000 рублей в месяц или среднемесячном остатке от 15 000 рублей, иначе — 249 рублей",
-                    "Современное решение для бесконтактных платежей с выгодными условиями"
-                ],
-                "ref_link": "https://example.com/vtb_sticker"
-            }
-        }
-    },
-    "ОТП Банк": {
-        "Дебетовые карты": {
-            "Premium Light": {
-                "age_limit": 18,
-                "advantages": [
-                    "1,5% на все покупки",
-                    "До 20% у партнеров банка",
-                    "До 4% годовых на остаток свыше 10 000 рублей",
-                    "Бесплатное снятие наличных в банкоматах ОТП Банка",
-                    "До 100 000 рублей в месяц без комиссии в банкоматах других банков",
-                    "Бесплатные переводы через СБП до 100 000 рублей в месяц",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатное обслуживание при тратах от 10 000 рублей в месяц или среднемесячном остатке от 30 000 рублей, иначе — 199 рублей",
-                    "Премиальная карта с привлекательными условиями для активных пользователей"
-                ],
-                "ref_link": "https://example.com/otp_premium_light"
-            }
-        }
-    },
-    "ФОРА-БАНК": {
-        "Дебетовые карты": {
-            "МИР «Все включено»": {
-                "age_limit": 18,
-                "advantages": [
-                    "До 5% на покупки в категориях «Продукты», «Аптеки», «АЗС»",
-                    "1% на все остальные покупки",
-                    "До 6% годовых при остатке от 10 000 рублей",
-                    "Бесплатное снятие наличных в любых банкоматах России от 3 000 рублей",
-                    "Бесплатные переводы через СБП до 100 000 рублей",
-                    "Бесплатное пополнение с карт других банков",
-                    "Бесплатное обслуживание при ежемесячных тратах от 5 000 рублей, иначе — 99 рублей",
-                    "Оптимальный вариант для тех, кто хочет получать высокий кэшбэк на повседневные покупки"
-                ],
-                "ref_link": "https://example.com/fora_all_inclusive"
-            }
-        }
-    }
-}
-
-# Вспомогательная функция для создания клавиатуры
-def build_keyboard(buttons):
-    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data)] for text, data in buttons])
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+# Период проверки файла каталога на изменения, секунды (0 — не следить)
+CATALOG_RELOAD_INTERVAL = float(os.getenv("CATALOG_RELOAD_INTERVAL", "10"))
+# Файл снимка каталога с готовыми индексами и экранами для быстрого запуска (пусто — без снимка)
+CATALOG_SNAPSHOT = os.getenv("CATALOG_SNAPSHOT", os.path.splitext(CATALOG_PATH)[0] + ".snapshot")
+if SHORTLINK_BASE_URL:
+    from shortlinks import ShortLinks, link_builder, make_redirect_handler
+    renderer = functools.partial(build_screens, link_for=link_builder(SHORTLINK_BASE_URL))
+else:
+    renderer = build_screens
+startup = StartupTimer(STARTUP_BUDGET, STARTUP_STARTED)
+startup.mark("imports")
+# Экраны зависят от адреса коротких ссылок, поэтому он входит в ключ снимка
+catalog_snapshot = CatalogSnapshot(CATALOG_SNAPSHOT, key=SHORTLINK_BASE_URL) if CATALOG_SNAPSHOT else None
+catalog_store = CatalogStore(CATALOG_PATH, renderer=renderer, snapshot_file=catalog_snapshot)
+catalog_store.load()
+startup.mark("catalog")
+
+events = analytics.create_analytics(ANALYTICS_STORE, ANALYTICS_FLUSH_INTERVAL)
+
+# Переходы по коротким ссылкам
+short_links = ShortLinks(catalog_store, SHORTLINK_TTL) if SHORTLINK_BASE_URL else None
+SHORTLINK_PATH = urlsplit(SHORTLINK_BASE_URL).path.rstrip("/") + "/"
+
+# Переход учитывается в аналитике; пользователь по ссылке неизвестен
+def record_click(card) -> None:
+    events.emit(analytics.REF_CLICK, 0, card.bank, card.card_type, card.name)
+
+# Медленные обновления с профилями
+if SLOW_UPDATE_THRESHOLD > 0:
+    from profiler import ProfiledConversationHandler, SlowUpdateRecorder, make_dump_handler
+    slow_updates = SlowUpdateRecorder(
+        SLOW_UPDATE_THRESHOLD, PROFILE_SAMPLE_RATE, SLOW_UPDATE_BUFFER, state_names=STATE_NAMES
+    )
+else:
+    slow_updates = None
+
+# Служебные HTTP-маршруты бота
+def add_http_routes(server: HttpServer) -> None:
+    if short_links is not None:
+        server.route("GET", SHORTLINK_PATH, make_redirect_handler(short_links, SHORTLINK_PATH, record_click), prefix=True)
+    if METRICS_PATH:
+        server.route("GET", METRICS_PATH, metrics.make_metrics_handler())
+    if slow_updates is not None and SLOW_UPDATES_TOKEN:
+        server.route("GET", SLOW_UPDATES_PATH, make_dump_handler(slow_updates, SLOW_UPDATES_TOKEN))
+
+# None, если обслуживать нечего
+http_routes = (
+    add_http_routes
+    if short_links is not None or METRICS_PATH or slow_updates is not None and SLOW_UPDATES_TOKEN
+    else None
+)
+
+# Обработчик диалога последнего построенного приложения
+conversation_handler: Optional[ConversationHandler] = None
+
+# Состояния диалогов читаются из приватного ConversationHandler._conversations:
+# у PTB нет публичного API для этого, версия PTB ограничена в requirements.txt
+
+# Число активных диалогов по состояниям; считается только при запросе /metrics
+def conversations_by_state():
+    counts = dict.fromkeys(((name,) for name in STATE_NAMES), 0)
+    if conversation_handler is not None:
+        for state in conversation_handler._conversations.values():
+            if isinstance(state, int) and 0 <= state < len(STATE_NAMES):
+                counts[(STATE_NAMES[state],)] += 1
+    return counts
+
+metrics.registry.gauge(
+    "refbot_active_conversations", "Активные диалоги по состояниям", ("state",), collect=conversations_by_state
+)
+
+# Вместе с сессией забывается и состояние диалога в этом чате
+def drop_conversation(user_id: int, chat_id: Optional[int]) -> None:
+    if conversation_handler is not None and chat_id is not None:
+        conversation_handler._conversations.pop((chat_id, user_id), None)
+
+# Ограниченное хранилище сессий в памяти, если нет постоянного
+session_cache = SessionCache(
+    ttl=SESSION_IDLE_TTL,
+    max_sessions=int(SESSION_MEMORY_LIMIT_MB * 2**20 // SESSION_BYTES),
+    sweep_interval=SESSION_SWEEP_INTERVAL,
+    on_evict=drop_conversation,
+) if not SESSION_STORE else None
+
+class MemorySessionContext(SessionContext):
+    memory_sessions = session_cache
+
+if session_cache is not None:
+    metrics.registry.gauge("refbot_sessions", "Сессии пользователей в памяти", collect=lambda: {(): len(session_cache)})
+
+# Рассылки; создаются в post_init, в каждом процессе свои
+broadcaster: Optional["Broadcaster"] = None
+
+# Прогресс текущей рассылки для /metrics
+def broadcast_progress():
+    progress = broadcaster.progress if broadcaster is not None else None
+    if progress is None:
+        return {}
+    return {("sent",): progress.sent, ("blocked",): progress.blocked, ("failed",): progress.failed}
+
+def broadcast_eta():
+    progress = broadcaster.progress if broadcaster is not None else None
+    if progress is None or progress.eta is None:
+        return {}
+    return {(): progress.eta}
+
+metrics.registry.gauge(
+    "refbot_broadcast_messages", "Обработанные получатели текущей рассылки по исходу", ("outcome",),
+    collect=broadcast_progress,
+)
+metrics.registry.gauge(
+    "refbot_broadcast_eta_seconds", "Оценка времени до конца текущей рассылки, секунды", collect=broadcast_eta,
+)
+
+# Отдельный HTTP сервер для служебных маршрутов в режиме polling
+service_server: Optional[HttpServer] = None
+
+# Картинки карт; создаются в post_init
+card_media: Optional["CardMedia"] = None
+
+# Проверка реферальных ссылок; создаётся в post_init
+link_checker: Optional["LinkChecker"] = None
+
+metrics.registry.gauge(
+    "refbot_hidden_cards", "Карты, скрытые из меню из-за нерабочей реферальной ссылки",
+    collect=lambda: {(): len(catalog_store.current.hidden)},
+)
+
+# Хэши и прогрев картинок для каждого нового снимка каталога
+def on_catalog_loaded(catalog: Catalog) -> None:
+    if card_media is not None:
+        card_media.start(catalog)
+
+catalog_store.add_listener(on_catalog_loaded)
+
+# Снимок каталога, из которого выдана кнопка
+def catalog_for(data: str) -> Catalog:
+    generation = payload_generation(data)
+    if generation is not None:
+        snapshot = catalog_store.snapshot(generation)
+        if snapshot is not None:
+            return snapshot
+    return catalog_store.current
+
+# Экраны возрастной категории пользователя; None, если возраст ещё не выбран
+def age_screens(context: ContextTypes.DEFAULT_TYPE, catalog: Optional[Catalog] = None) -> Optional[AgeScreens]:
+    age = context.user_data.get("age")
+    if age is None:
+        return None
+    return (catalog or catalog_store.current).screens.for_age(age)
+
+# Отпечатки экранов, уже показанных в сообщениях
+rendered_messages = RenderedMessages(RENDERED_MESSAGES_CACHE)
+
+# Ключ сообщения, к которому относится callback
+def message_key(query):
+    if query.message is not None:
+        return (query.message.chat_id, query.message.message_id)
+    return query.inline_message_id
+
+# Замена сообщения с фото текстовым: правкой фото в текст не превратить,
+# поэтому отправляется новое сообщение, а старое удаляется
+async def replace_photo_message(query, screen: Screen) -> None:
+    message = await query.get_bot().send_message(
+        query.message.chat_id,
+        screen.text,
+        reply_markup=screen.reply_markup,
+        parse_mode=ParseMode.HTML
+    )
+    await delete_message(query)
+    rendered_messages.remember((message.chat_id, message.message_id), screen.fingerprint)
+
+async def delete_message(query) -> None:
+    rendered_messages.forget(message_key(query))
+    try:
+        await query.get_bot().delete_message(query.message.chat.id, query.message.message_id)
+    except TelegramError as exc:
+        # Старше 48 часов или уже удалено: остаётся в чате
+        logger.debug("Сообщение не удалено: %s", exc)
+
+# Показ готового экрана; правка пропускается, если экран уже показан
+async def show_screen(query, screen: Screen) -> None:
+    key = message_key(query)
+    if rendered_messages.is_shown(key, screen.fingerprint):
+        return
+    if getattr(query.message, "photo", None):
+        return await replace_photo_message(query, screen)
+    try:
+        await query.edit_message_text(
+            screen.text,
+            reply_markup=screen.reply_markup,
+            parse_mode=ParseMode.HTML
+        )
+    except BadRequest as exc:
+        if "not modified" not in exc.message.lower():
+            rendered_messages.forget(key)
+            raise
+        rendered_messages.count_not_modified()
+    rendered_messages.remember(key, screen.fingerprint)
+
+# Отправка страницы карты с фото: правкой, если сообщение уже с фото,
+# иначе новым сообщением вместо текстового
+async def send_card_photo(query, screen: Screen, photo):
+    if getattr(query.message, "photo", None):
+        return await query.edit_message_media(
+            InputMediaPhoto(photo, caption=screen.text, parse_mode=ParseMode.HTML),
+            reply_markup=screen.reply_markup,
+        )
+    message = await query.get_bot().send_photo(
+        query.message.chat_id,
+        photo,
+        caption=screen.text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=screen.reply_markup,
+    )
+    await delete_message(query)
+    return message
+
+# Страница карты; с картинкой, если она задана и подпись помещается в лимит.
+# Картинка отправляется по сохранённому file_id, а загружается, только если
+# его ещё нет или Telegram его не принял
+async def show_card_screen(query, screen: Screen, card) -> None:
+    image = card_media.image(card) if card_media is not None else None
+    if image is None or query.message is None:
+        return await show_screen(query, screen)
+    from media import card_media_sends, fits_caption
+    if not fits_caption(screen.text):
+        return await show_screen(query, screen)
+    if rendered_messages.is_shown(message_key(query), screen.fingerprint):
+        return
+
+    file_id = await card_media.file_id(card, image) or await card_media.wait_upload(image)
+    message = None
+    if file_id is not None:
+        try:
+            message = await send_card_photo(query, screen, file_id)
+            card_media_sends.inc("file_id")
+        except BadRequest as exc:
+            logger.warning("file_id картинки %s не принят, загрузка заново: %s", image.path, exc)
+            await card_media.forget(image)
+    if message is None:
+        try:
+            message = await send_card_photo(query, screen, await card_media.read(image))
+        except (OSError, BadRequest) as exc:
+            logger.warning("Картинка %s не отправлена, страница карты без неё: %s", image.path, exc)
+            return await show_screen(query, screen)
+        card_media_sends.inc("upload")
+        if message.photo:
+            await card_media.remember(card, image, message.photo[-1].file_id)
+    rendered_messages.remember((message.chat_id, message.message_id), screen.fingerprint)
+
+# Загрузка картинки при прогреве: фото отправляется в служебный чат и удаляется
+async def upload_card_image(bot, content: bytes, filename: str) -> str:
+    message = await bot.send_photo(MEDIA_WARMUP_CHAT_ID, content, filename=filename, disable_notification=True)
+    try:
+        await message.delete()
+    except TelegramError as exc:
+        logger.debug("Сообщение прогрева не удалено: %s", exc)
+    return message.photo[-1].file_id
 
 # Обработчик команды /start
+@metrics.timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    keyboard = [
-        [InlineKeyboardButton("🎂 14-17 лет", callback_data="age_14_17")],
-        [InlineKeyboardButton("🎂 18+ лет", callback_data="age_18_plus")]
-    ]
-    await update.message.reply_text(
-        "👋 <b>Добро пожаловать!</b>\n\nПожалуйста, выберите вашу возрастную категорию:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+    # Сессия заводится уже на /start: с ней вытесняется и состояние диалога,
+    # которое ConversationHandler запоминает для каждого пользователя
+    if session_cache is not None:
+        session_cache.get(update.effective_user.id, update.effective_chat.id)
+    screen = catalog_store.current.screens.welcome
+    message = await update.message.reply_text(
+        screen.text,
+        reply_markup=screen.reply_markup,
         parse_mode=ParseMode.HTML
     )
+    rendered_messages.remember((message.chat_id, message.message_id), screen.fingerprint)
+    events.emit(analytics.START, update.effective_user.id)
+    if broadcaster is not None:
+        broadcaster.subscribe(update.effective_user.id)
     return MAIN_MENU
 
-# Обработчик выбора возраста
-async def handle_age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-
-    age_group = query.data
-    context.user_data["age"] = 14 if age_group == "age_14_17" else 18
+# Обработчики кнопок вызываются маршрутизатором (routing.py) с уже
+# разобранным аргументом кнопки: (query, context, argument)
 
-    return await show_bank_selection(query)
+# Обработчик выбора возраста
+@metrics.timed
+async def handle_age(query, context: ContextTypes.DEFAULT_TYPE, age: int) -> int:
+    context.user_data["age"] = age
+    return await show_bank_selection(query, context)
 
 # Показ списка банков
-async def show_bank_selection(query) -> int:
+async def show_bank_selection(query, context: ContextTypes.DEFAULT_TYPE) -> int:
     await query.answer()
-    keyboard = [
-        [InlineKeyboardButton(bank, callback_data=f"bank_{bank}")] for bank in banks
-    ] + [
-        [InlineKeyboardButton("📋 Все карты", callback_data="show_all_cards")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ]
-    await query.edit_message_text(
-        "🏦 <b>Выберите банк:</b>",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode=ParseMode.HTML
-    )
+    screens = age_screens(context)
+    if screens is None:
+        return await return_to_main_menu(query)
+    await show_screen(query, screens.bank_selection)
+    events.emit(analytics.BANK_LIST, query.from_user.id)
     return BANK_SELECTION
 
 # Обработчик выбора банка
-async def handle_bank_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-
-    if query.data == "show_all_cards":
-        return await show_all_cards_view(query)
-
-    if query.data == "main_menu":
+@metrics.timed
+async def handle_bank_selection(query, context: ContextTypes.DEFAULT_TYPE, data: str) -> int:
+    catalog = catalog_for(data)
+    try:
+        bank_name = catalog.ids.decode_bank(data)
+    except CallbackDataError:
         return await return_to_main_menu(query)
-
-    bank_name = query.data.split("_", 1)[1]
     context.user_data["current_bank"] = bank_name
+    events.emit(analytics.BANK_VIEW, query.from_user.id, bank_name)
 
-    return await show_card_type_selection(query)
+    return await show_card_type_selection(query, context, bank_name, catalog)
 
 # Новый обработчик выбора типа карты
-async def show_card_type_selection(query) -> int:
+async def show_card_type_selection(query, context: ContextTypes.DEFAULT_TYPE, bank_name, catalog: Optional[Catalog] = None) -> int:
     await query.answer()
-    keyboard = [
-        [InlineKeyboardButton("Кредитные карты", callback_data="credit_cards")],
-        [InlineKeyboardButton("Дебетовые карты", callback_data="debit_cards")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_banks")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ]
-    await query.edit_message_text(
-        "💳 <b>Выберите тип карты:</b>",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode=ParseMode.HTML
-    )
+    screens = age_screens(context, catalog)
+    screen = screens.card_type(bank_name) if screens else None
+    if screen is None:
+        return await return_to_main_menu(query)
+    await show_screen(query, screen)
     return CARD_TYPE_SELECTION
 
 # Обработчик выбора типа карты
-async def handle_card_type_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-
-    if query.data == "back_to_banks":
-        return await show_bank_selection(query)
-
-    if query.data == "main_menu":
+@metrics.timed
+async def handle_card_type_selection(query, context: ContextTypes.DEFAULT_TYPE, data: str) -> int:
+    if "current_bank" not in context.user_data:
         return await return_to_main_menu(query)
 
-    card_type = query.data
-    context.user_data["card_type"] = "Кредитные карты" if card_type == "credit_cards" else "Дебетовые карты"
+    catalog = catalog_for(data)
+    try:
+        card_type = catalog.ids.decode_type(data)
+    except CallbackDataError:
+        return await return_to_main_menu(query)
+    context.user_data["card_type"] = card_type
+    events.emit(analytics.TYPE_VIEW, query.from_user.id, context.user_data["current_bank"], card_type)
 
-    return await show_card_selection(query, context.user_data["current_bank"])
+    return await show_card_selection(query, context, context.user_data["current_bank"], card_type, catalog)
 
 # Показ списка карт выбранного банка
-async def show_card_selection(query, bank_name) -> int:
+async def show_card_selection(query, context: ContextTypes.DEFAULT_TYPE, bank_name, card_type, catalog: Optional[Catalog] = None) -> int:
     await query.answer()
 
-    cards = banks[bank_name][context.user_data["card_type"]]
-    keyboard = [
-        [InlineKeyboardButton(card, callback_data=f"card_{card}")] for card in cards
-    ] + [
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_card_type")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ]
-    await query.edit_message_text(
-        f"🏦 <b>{bank_name}</b>\n\nВыберите карту:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode=ParseMode.HTML
-    )
+    screens = age_screens(context, catalog)
+    screen = screens.card_list(bank_name, card_type) if screens else None
+    if screen is None:
+        return await return_to_main_menu(query)
+    await show_screen(query, screen)
     return CARD_SELECTION
 
 # Обработчик выбора карты
-async def handle_card_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
+@metrics.timed
+async def handle_card_selection(query, context: ContextTypes.DEFAULT_TYPE, data: str) -> int:
     await query.answer()
 
-    if "current_bank" not in context.user_data or "card_type" not in context.user_data:
+    catalog = catalog_for(data)
+    try:
+        bank_name, card_type, card_name = catalog.ids.decode_card(data)
+    except CallbackDataError:
         return await return_to_main_menu(query)
 
-    card_name = query.data.split("_", 1)[1]
-    bank_name = context.user_data["current_bank"]
-    card_info = banks[bank_name][context.user_data["card_type"]][card_name]
-
-    text = f"🏦 <b>{bank_name}</b> - <b>{card_name}</b>\n\n"
-    text += "🔥 <b>Преимущества:</b>\n" + "\n".join(f"• {adv}" for adv in card_info["advantages"])
-    text += f"\n\n🔗 <a href='{card_info['ref_link']}'>Ссылка на карту</a>"
-
-    keyboard = [
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_cards")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ]
+    screens = age_screens(context, catalog)
+    screen = screens.card(bank_name, card_type, card_name) if screens else None
+    if screen is None:
+        return await return_to_main_menu(query)
+    context.user_data["current_bank"] = bank_name
+    context.user_data["card_type"] = card_type
 
-    await query.edit_message_text(
-        text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode=ParseMode.HTML
-    )
+    await show_card_screen(query, screen, catalog.card(bank_name, card_type, card_name))
+    # Страница карты содержит реферальную ссылку
+    user_id = query.from_user.id
+    events.emit(analytics.CARD_VIEW, user_id, bank_name, card_type, card_name)
+    events.emit(analytics.REF_EXPOSURE, user_id, bank_name, card_type, card_name)
     return CARD_SELECTION
 
 # Показ всех доступных карт
-async def show_all_cards_view(query) -> int:
+async def show_all_cards_view(query, context: ContextTypes.DEFAULT_TYPE, page: int = 0) -> int:
     await query.answer()
-
-    text = "📋 <b>Все доступные карты:</b>\n\n"
-    for bank, types in banks.items():
-        text += f"🏦 <b>{bank}</b>:\n"
-        for card_type, cards in types.items():
-            text += f"  <b>{card_type}:</b>\n"
-            for card, info in cards.items():
-                text += f"    • {card} ({info['age_limit']}+)\n"
-
-    keyboard = [
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_banks")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ]
-
-    await query.edit_message_text(
-        text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode=ParseMode.HTML
-    )
+    screens = age_screens(context)
+    if screens is None:
+        return await return_to_main_menu(query)
+    await show_screen(query, screens.all_cards_page(page))
+    events.emit(analytics.ALL_CARDS_VIEW, query.from_user.id)
     return ALL_CARDS_VIEW
 
-# Обработчик навигации
-async def handle_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
+# Листание списка всех карт
+@metrics.timed
+async def handle_all_cards_page(query, context: ContextTypes.DEFAULT_TYPE, page: int) -> int:
+    return await show_all_cards_view(query, context, page)
 
-    if "current_bank" not in context.user_data:
+# Показ меню рейтингов карт
+async def show_top_cards_menu(query, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await query.answer()
+    screens = age_screens(context)
+    if screens is None or screens.top_menu is None:
         return await return_to_main_menu(query)
+    await show_screen(query, screens.top_menu)
+    return TOP_CARDS_VIEW
 
-    if query.data == "main_menu":
+# Рейтинг карт по выбранной характеристике; кнопки карт ведут на их страницы
+@metrics.timed
+async def handle_top_cards(query, context: ContextTypes.DEFAULT_TYPE, key: str) -> int:
+    await query.answer()
+    screens = age_screens(context)
+    screen = screens.top_cards(key) if screens else None
+    if screen is None:
         return await return_to_main_menu(query)
+    await show_screen(query, screen)
+    return TOP_CARDS_VIEW
+
+# Кнопки навигации
+@metrics.timed
+async def handle_main_menu(query, context: ContextTypes.DEFAULT_TYPE, _) -> int:
+    return await return_to_main_menu(query)
+
+@metrics.timed
+async def handle_show_all_cards(query, context: ContextTypes.DEFAULT_TYPE, _) -> int:
+    return await show_all_cards_view(query, context)
+
+@metrics.timed
+async def handle_show_top_cards(query, context: ContextTypes.DEFAULT_TYPE, _) -> int:
+    return await show_top_cards_menu(query, context)
+
+@metrics.timed
+async def handle_back_to_banks(query, context: ContextTypes.DEFAULT_TYPE, _) -> int:
+    return await show_bank_selection(query, context)
+
+@metrics.timed
+async def handle_back_to_card_type(query, context: ContextTypes.DEFAULT_TYPE, _) -> int:
+    bank_name = context.user_data.get("current_bank")
+    if bank_name is None:
+        return await return_to_main_menu(query)
+    return await show_card_type_selection(query, context, bank_name)
 
-    if query.data == "back_to_banks":
-        return await show_bank_selection(query)
-
-    if query.data == "back_to_card_type":
-        return await show_card_type_selection(query)
+@metrics.timed
+async def handle_back_to_cards(query, context: ContextTypes.DEFAULT_TYPE, _) -> int:
+    bank_name = context.user_data.get("current_bank")
+    card_type = context.user_data.get("card_type")
+    if bank_name is None or card_type is None:
+        return await return_to_main_menu(query)
+    return await show_card_selection(query, context, bank_name, card_type)
 
-    if query.data == "back_to_cards":
-        return await show_card_selection(query, context.user_data["current_bank"])
+# Кнопка, не предусмотренная в текущем состоянии диалога: из старого
+# сообщения, от устаревшей версии бота или подделанная
+async def handle_unknown_callback(query, context: ContextTypes.DEFAULT_TYPE, state: int) -> int:
+    unknown_callbacks.inc(STATE_NAMES[state])
+    logger.debug("Неизвестная кнопка %r в состоянии %s", query.data, STATE_NAMES[state])
+    return await return_to_main_menu(query)
 
 # Возврат в главное меню
 async def return_to_main_menu(query) -> int:
     await query.answer()
+    await show_screen(query, catalog_store.current.screens.main_menu)
+    return MAIN_MENU
 
-    keyboard = [
-        [InlineKeyboardButton("🎂 14-17 лет", callback_data="age_14_17")],
-        [InlineKeyboardButton("🎂 18+ лет", callback_data="age_18_plus")]
-    ]
-    await query.edit_message_text(
-        "🏠 <b>Вы вернулись в главное меню!</b>",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode=ParseMode.HTML
+# Inline-поиск карт (@bot кэшбэк). Выдача зависит от возраста пользователя,
+# поэтому ответ кэшируется Telegram отдельно для каждого (is_personal)
+@metrics.timed
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.inline_query
+    age = context.user_data.get("age")
+    if age is None:
+        await query.answer(
+            [],
+            cache_time=0,
+            is_personal=True,
+            button=InlineQueryResultsButton("🎂 Укажите возраст, чтобы искать карты", start_parameter="age"),
+        )
+        return
+
+    catalog = catalog_store.current
+    screens = catalog.screens.for_age(age)
+    results = []
+    for card in catalog.search.search(query.query, age, INLINE_RESULTS_LIMIT):
+        screen = screens.card(card.bank, card.card_type, card.name)
+        if screen is None:
+            continue
+        results.append(InlineQueryResultArticle(
+            id=f"{catalog.generation}-{card.id}",
+            title=card.name,
+            description=f"{card.bank} · {card.card_type}",
+            input_message_content=InputTextMessageContent(screen.text, parse_mode=ParseMode.HTML),
+        ))
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+# Кнопка из сообщения, диалог которого уже забыт (сессия вытеснена):
+# показывается главное меню, кнопки возраста снова открывают диалог
+async def handle_stale_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await return_to_main_menu(update.callback_query)
+
+# Отправка сообщения рассылки одному получателю
+# Рассылка идёт фоновыми запросами: планировщик оставляет запас лимита
+# ответам на кнопки и правкам меню
+async def send_announcement(bot, chat_id: int, text: str) -> None:
+    await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, rate_limit_args=BACKGROUND)
+
+# Описание рассылки: живой прогресс, если её ведёт этот процесс, иначе
+# счётчики последней контрольной точки
+def describe_broadcast(job) -> str:
+    progress = broadcaster.progress
+    if progress is None or progress.job_id != job.id:
+        progress = None
+        total, sent, blocked, failed = job.total, job.sent, job.blocked, job.failed
+    else:
+        total, sent, blocked, failed = progress.total, progress.sent, progress.blocked, progress.failed
+    text = (
+        f"📣 Рассылка #{job.id}: {job.status}\n"
+        f"Обработано {sent + blocked + failed} из {total}: отправлено {sent}, "
+        f"заблокировали бота {blocked}, ошибок {failed}"
+    )
+    if progress is not None:
+        from broadcast import format_eta
+        text += f"\nСкорость {progress.rate:.1f} сообщ./с, осталось {format_eta(progress.eta)}"
+    return text
+
+# /broadcast <текст> — рассылка всем подписчикам; форматирование сохраняется
+@metrics.timed
+async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    parts = update.message.text_html.split(None, 1)
+    if len(parts) < 2:
+        await update.message.reply_text("Использование: /broadcast текст сообщения")
+        return
+    job_id, recipients = await broadcaster.enqueue(parts[1])
+    await update.message.reply_text(
+        f"📣 Рассылка #{job_id} поставлена в очередь, подписчиков: {recipients}.\n"
+        f"Прогресс: /broadcast_status {job_id}, отмена: /broadcast_cancel {job_id}"
     )
-    return MAIN_MENU
+
+# /broadcast_status [id] — прогресс рассылки; без id — текущей
+@metrics.timed
+async def handle_broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    job_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    job = await broadcaster.status(job_id)
+    if job is None:
+        await update.message.reply_text("Рассылка не найдена" if job_id else "Активных рассылок нет")
+        return
+    await update.message.reply_text(describe_broadcast(job))
+
+# /broadcast_cancel <id>
+@metrics.timed
+async def handle_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /broadcast_cancel номер")
+        return
+    job_id = int(context.args[0])
+    if await broadcaster.cancel(job_id):
+        await update.message.reply_text(f"Рассылка #{job_id} отменена")
+    else:
+        await update.message.reply_text(f"Рассылка #{job_id} не найдена или уже завершена")
 
 # Завершение сессии
+@metrics.timed
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("🚫 Сессия завершена")
     return ConversationHandler.END
 
-# Основная функция
-def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    async def startup_actions(app: Application):
-        await app.bot.delete_webhook()
-        logger.info("Webhook удален")
-
-    async def shutdown_actions(app: Application):
-        await app.shutdown()
-        logger.info("Приложение остановлено")
-
-    # Выполнение дополнительных действий при старте и завершении работы приложения
-    application.initialize()
-    asyncio.get_event_loop().run_until_complete(startup_actions(application))
-
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+# Нажатия кнопок по состояниям диалога; действие без состояний допустимо в любом
+unknown_callbacks = metrics.registry.counter(
+    "refbot_unknown_callbacks_total", "Нажатия кнопок, не предусмотренных в состоянии диалога", ("state",)
+)
+callback_routes = CallbackRouter(range(len(STATE_NAMES)), on_unknown=handle_unknown_callback)
+callback_routes.add(ACTION_AGE, handle_age)
+callback_routes.add(ACTION_MAIN_MENU, handle_main_menu)
+callback_routes.add(ACTION_BACK_TO_BANKS, handle_back_to_banks)
+callback_routes.add(ACTION_SHOW_ALL_CARDS, handle_show_all_cards)
+callback_routes.add(ACTION_SHOW_TOP_CARDS, handle_show_top_cards)
+callback_routes.add(ACTION_BANK, handle_bank_selection, BANK_SELECTION)
+callback_routes.add(ACTION_CARD_TYPE, handle_card_type_selection, CARD_TYPE_SELECTION)
+callback_routes.add(ACTION_BACK_TO_CARD_TYPE, handle_back_to_card_type, CARD_SELECTION)
+callback_routes.add(ACTION_CARD, handle_card_selection, CARD_SELECTION, TOP_CARDS_VIEW)
+callback_routes.add(ACTION_BACK_TO_CARDS, handle_back_to_cards, CARD_SELECTION)
+callback_routes.add(ACTION_ALL_CARDS_PAGE, handle_all_cards_page, ALL_CARDS_VIEW)
+callback_routes.add(ACTION_TOP_CARDS, handle_top_cards, TOP_CARDS_VIEW)
+
+# Построение обработчика диалога
+def build_conversation_handler(persistent: bool = False) -> ConversationHandler:
+    if slow_updates is not None:
+        handler_class = functools.partial(ProfiledConversationHandler, recorder=slow_updates)
+    else:
+        handler_class = ConversationHandler
+    return handler_class(
+        entry_points=[
+            CommandHandler("start", start),
+            CallbackQueryHandler(callback_routes.handler(MAIN_MENU), pattern=callback_routes.accepts(ACTION_AGE))
+        ],
+        # В каждом состоянии один обработчик кнопок: маршрут выбирается по таблице
         states={
-            MAIN_MENU: [
-                CallbackQueryHandler(handle_age)
-            ],
-            BANK_SELECTION: [
-                CallbackQueryHandler(handle_bank_selection),
-                CallbackQueryHandler(return_to_main_menu, pattern="^main_menu$")
-            ],
-            CARD_TYPE_SELECTION: [
-                CallbackQueryHandler(handle_card_type_selection),
-                CallbackQueryHandler(return_to_main_menu, pattern="^main_menu$")
-            ],
-            CARD_SELECTION: [
-                CallbackQueryHandler(handle_card_selection),
-                CallbackQueryHandler(handle_navigation, pattern="^main_menu$")
-            ],
-            ALL_CARDS_VIEW: [
-                CallbackQueryHandler(handle_navigation, pattern="^main_menu$")
-            ]
+            state: [CallbackQueryHandler(callback_routes.handler(state))]
+            for state in range(len(STATE_NAMES))
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="refbot",
+        persistent=persistent
+    )
+
+# Фоновые задачи, запускаемые после инициализации приложения
+async def post_init(application: Application) -> None:
+    if CATALOG_RELOAD_INTERVAL > 0:
+        application.create_task(catalog_store.watch(CATALOG_RELOAD_INTERVAL))
+    events.start()
+    if METRICS_PATH:
+        application.create_task(metrics.watch_event_loop())
+    if slow_updates is not None:
+        slow_updates.start()
+    if session_cache is not None:
+        session_cache.start()
+    global broadcaster
+    if BROADCAST_STORE:
+        from broadcast import BroadcastStore, Broadcaster
+        broadcaster = Broadcaster(
+            BroadcastStore(BROADCAST_STORE),
+            functools.partial(send_announcement, application.bot),
+            rate=BROADCAST_RATE,
+            workers=BROADCAST_WORKERS,
+        )
+        broadcaster.start()
+    global card_media
+    if MEDIA_STORE:
+        from media import CardMedia, MediaStore
+        upload = functools.partial(upload_card_image, application.bot) if MEDIA_WARMUP_CHAT_ID else None
+        card_media = CardMedia(
+            MediaStore(MEDIA_STORE),
+            os.path.dirname(os.path.abspath(CATALOG_PATH)),
+            upload=upload,
+            concurrency=MEDIA_WARMUP_CONCURRENCY,
+        )
+        card_media.start(catalog_store.current)
+    global link_checker
+    if LINKCHECK_STORE:
+        from linkcheck import LinkChecker, LinkStore
+        link_checker = LinkChecker(
+            LinkStore(LINKCHECK_STORE),
+            catalog_store,
+            interval=LINKCHECK_INTERVAL,
+            concurrency=LINKCHECK_CONCURRENCY,
+            host_rate=LINKCHECK_HOST_RATE,
+            failures=LINKCHECK_FAILURES,
+            timeout=LINKCHECK_TIMEOUT,
+        )
+        link_checker.start()
+    # В режиме polling с одним процессом маршрутам нужен свой сервер;
+    # в остальных режимах их обслуживает сервер вебхука или супервизора
+    global service_server
+    if http_routes is not None and BOT_MODE != "webhook" and BOT_WORKERS <= 1:
+        # SO_REUSEPORT: порт свободен для нового процесса, пока этот останавливается
+        service_server = HttpServer(HOST, PORT, reuse_port=True)
+        http_routes(service_server)
+        await service_server.start()
+
+# Запись оставшихся событий при остановке приложения
+async def post_shutdown(application: Application) -> None:
+    global service_server
+    if service_server is not None:
+        await service_server.stop()
+        service_server = None
+    if slow_updates is not None:
+        slow_updates.stop()
+    if session_cache is not None:
+        session_cache.stop()
+    global broadcaster
+    if broadcaster is not None:
+        await broadcaster.stop()
+        broadcaster.store.close()
+        broadcaster = None
+    global card_media
+    if card_media is not None:
+        await card_media.stop()
+        card_media.store.close()
+        card_media = None
+    global link_checker
+    if link_checker is not None:
+        await link_checker.stop()
+        link_checker.store.close()
+        link_checker = None
+    await events.stop()
+
+# Входной процесс супервизора: обслуживает переходы по коротким ссылкам
+# и /metrics, поэтому ведёт собственную аналитику, замер цикла событий и
+# перечитывает каталог, чтобы короткие ссылки вели на актуальные ref_link
+async def run_entry_process(supervisor) -> None:
+    events.start()
+    tasks = []
+    if METRICS_PATH:
+        tasks.append(asyncio.create_task(metrics.watch_event_loop()))
+    if CATALOG_RELOAD_INTERVAL > 0:
+        tasks.append(asyncio.create_task(catalog_store.watch(CATALOG_RELOAD_INTERVAL)))
+    try:
+        await supervisor
+    finally:
+        for task in tasks:
+            task.cancel()
+        await events.stop()
+
+# Построение приложения со всеми обработчиками; request подменяет
+# HTTP-клиент Bot API (используется нагрузочным стендом), journal
+# включает пропуск повторов и передачу обновлений при перезапуске
+def build_application(request: Optional[BaseRequest] = None, journal: Optional[UpdateJournal] = None) -> Application:
+    builder = (
+        Application.builder()
+        .application_class(TrackedApplication, kwargs={"journal": journal})
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
     )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    if METRICS_PATH:
+        # Пул того же размера, что строит ApplicationBuilder по умолчанию
+        request = metrics.InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256))
+    if request is not None:
+        builder = builder.request(request)
+    if RATE_LIMIT_GLOBAL > 0:
+        # У каждого рабочего процесса супервизора свой планировщик, поэтому
+        # общий лимит делится между ними поровну. Чат закреплён за одним
+        # процессом (шардирование по user_id), и лимит чата не делится.
+        global_rate = RATE_LIMIT_GLOBAL / max(BOT_WORKERS, 1)
+        builder = builder.rate_limiter(OutboundScheduler(
+            global_rate=global_rate,
+            global_burst=max(global_rate, 1.0),
+            chat_rate=RATE_LIMIT_CHAT,
+        ))
+    if SESSION_STORE:
+        builder = builder.persistence(
+            create_persistence(SESSION_STORE, SESSION_FLUSH_INTERVAL, SESSION_CACHE_SIZE)
+        ).context_types(ContextTypes(context=SessionContext))
+    else:
+        builder = builder.context_types(ContextTypes(context=MemorySessionContext))
+    application = builder.build()
+    global conversation_handler
+    conversation_handler = build_conversation_handler(persistent=bool(SESSION_STORE))
+    application.add_handler(conversation_handler)
+    application.add_handler(CallbackQueryHandler(handle_stale_button))
+    application.add_handler(InlineQueryHandler(handle_inline_query))
+    if BROADCAST_STORE and ADMIN_IDS:
+        admins = filters.User(user_id=ADMIN_IDS)
+        application.add_handler(CommandHandler("broadcast", handle_broadcast, filters=admins))
+        application.add_handler(CommandHandler("broadcast_status", handle_broadcast_status, filters=admins))
+        application.add_handler(CommandHandler("broadcast_cancel", handle_broadcast_cancel, filters=admins))
+    return application
 
-    application.add_handler(conv_handler)
-    application.run_polling()
+# Основная функция
+def main() -> None:
+    if BOT_WORKERS > 1:
+        from workers import run_supervisor
+        asyncio.run(run_entry_process(run_supervisor(
+            BOT_TOKEN,
+            build_application,
+            workers=BOT_WORKERS,
+            mode=BOT_MODE,
+            host=HOST,
+            port=PORT,
+            path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            routes=http_routes,
+            drain_timeout=DRAIN_TIMEOUT,
+        )))
+        return
+
+    # Журнал ведёт только однопроцессный режим: в режиме супервизора
+    # обновления распределяются по рабочим процессам
+    journal = UpdateJournal(UPDATE_JOURNAL) if UPDATE_JOURNAL else None
+
+    if BOT_MODE == "webhook":
+        from webhook import run_webhook
+        asyncio.run(run_webhook(
+            build_application,
+            host=HOST,
+            port=PORT,
+            path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            routes=http_routes,
+            drain_timeout=DRAIN_TIMEOUT,
+            journal=journal,
+            startup=startup,
+        ))
+        return
+
+    asyncio.run(run_polling(build_application, DRAIN_TIMEOUT, journal, startup))
 
 if __name__ == "__main__":
     main()
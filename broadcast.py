@@ -0,0 +1,501 @@
+import asyncio
+import fcntl
+import logging
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Awaitable, Callable, Deque, List, NamedTuple, Optional, Set, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Рассылки объявлений всем подписчикам бота.
+# Подписчики (все, кто нажимал /start) и рассылки хранятся в SQLite.
+# Рассылку ведёт один процесс — тот, кто захватил файловую блокировку;
+# остальные процессы только ставят рассылки в очередь. Получатели читаются
+# страницами по возрастанию user_id и раздаются ограниченному пулу задач
+# отправки под общим token bucket. Прогресс сохраняется раз в
+# checkpoint_interval секунд как курсор — наибольший user_id, до которого
+# включительно все отправки завершены, — поэтому после аварийного
+# завершения повторно получат сообщение только те, кому оно ушло за
+# последние checkpoint_interval секунд.
+# Заблокировавшие бота и удалённые пользователи исключаются из подписчиков.
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+
+# Ответы BadRequest, означающие, что писать в этот чат больше нельзя
+_GONE_MARKERS = ("chat not found", "user not found", "peer_id_invalid")
+
+SendFunc = Callable[[int, str], Awaitable[object]]
+
+
+class Job(NamedTuple):
+    id: int
+    text: str
+    status: str
+    cursor: int
+    total: int
+    sent: int
+    blocked: int
+    failed: int
+
+
+class BroadcastStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS subscribers ("
+            " user_id INTEGER PRIMARY KEY, added_at INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, status TEXT NOT NULL,"
+            " created_at INTEGER NOT NULL, started_at INTEGER, finished_at INTEGER,"
+            " cursor INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0,"
+            " sent INTEGER NOT NULL DEFAULT 0, blocked INTEGER NOT NULL DEFAULT 0,"
+            " failed INTEGER NOT NULL DEFAULT 0);"
+        )
+        self._db.commit()
+
+    def add_subscribers(self, user_ids: List[int]) -> None:
+        now = int(time.time())
+        with self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO subscribers (user_id, added_at) VALUES (?, ?)",
+                [(user_id, now) for user_id in user_ids],
+            )
+
+    def subscriber_count(self, after: int = 0) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM subscribers WHERE user_id > ?", (after,)).fetchone()[0]
+
+    # Следующая страница получателей после user_id after
+    def page(self, after: int, limit: int) -> List[int]:
+        rows = self._db.execute(
+            "SELECT user_id FROM subscribers WHERE user_id > ? ORDER BY user_id LIMIT ?", (after, limit)
+        ).fetchall()
+        return [user_id for user_id, in rows]
+
+    def create(self, text: str) -> int:
+        with self._db:
+            cursor = self._db.execute(
+                "INSERT INTO broadcasts (text, status, created_at) VALUES (?, ?, ?)",
+                (text, PENDING, int(time.time())),
+            )
+        return cursor.lastrowid
+
+    def _job(self, where: str, args: Tuple) -> Optional[Job]:
+        row = self._db.execute(
+            "SELECT id, text, status, cursor, total, sent, blocked, failed FROM broadcasts "
+            f"WHERE {where} ORDER BY id LIMIT 1",
+            args,
+        ).fetchone()
+        return Job(*row) if row else None
+
+    def get(self, job_id: int) -> Optional[Job]:
+        return self._job("id = ?", (job_id,))
+
+    # Прерванная рассылка продолжается раньше новых
+    def next_job(self) -> Optional[Job]:
+        return self._job("status = ?", (RUNNING,)) or self._job("status = ?", (PENDING,))
+
+    def begin(self, job: Job) -> Job:
+        total = job.sent + job.blocked + job.failed + self.subscriber_count(job.cursor)
+        with self._db:
+            self._db.execute(
+                "UPDATE broadcasts SET status = ?, total = ?, started_at = COALESCE(started_at, ?) WHERE id = ?",
+                (RUNNING, total, int(time.time()), job.id),
+            )
+        return job._replace(status=RUNNING, total=total)
+
+    # Сохранение прогресса и исключение недоступных получателей одной
+    # транзакцией. Статус меняется, только пока рассылка идёт: отмена из
+    # другого процесса не затирается. Возвращает статус после записи.
+    def checkpoint(self, job: Job, gone: List[int], status: Optional[str] = None) -> str:
+        with self._db:
+            self._db.executemany("DELETE FROM subscribers WHERE user_id = ?", [(user_id,) for user_id in gone])
+            current, = self._db.execute("SELECT status FROM broadcasts WHERE id = ?", (job.id,)).fetchone()
+            if current == RUNNING and status is not None:
+                current = status
+            self._db.execute(
+                "UPDATE broadcasts SET cursor = ?, sent = ?, blocked = ?, failed = ?, status = ?,"
+                " finished_at = CASE WHEN ? = ? THEN ? ELSE finished_at END WHERE id = ?",
+                (job.cursor, job.sent, job.blocked, job.failed, current, current, DONE, int(time.time()), job.id),
+            )
+        return current
+
+    def cancel(self, job_id: int) -> bool:
+        with self._db:
+            cursor = self._db.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+                (CANCELLED, int(time.time()), job_id, PENDING, RUNNING),
+            )
+        return cursor.rowcount > 0
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class Progress(NamedTuple):
+    job_id: int
+    total: int
+    sent: int
+    blocked: int
+    failed: int
+    # Отправок в секунду за последнее окно и оценка оставшегося времени, с
+    rate: float
+    eta: Optional[float]
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+
+# Курсор прогресса: отправки завершаются не по порядку, курсор двигается
+# до первого незавершённого получателя
+class Watermark:
+    def __init__(self, cursor: int):
+        self.cursor = cursor
+        self._pending: Deque[int] = deque()
+        self._done: Set[int] = set()
+
+    def issue(self, user_id: int) -> None:
+        self._pending.append(user_id)
+
+    def complete(self, user_id: int) -> None:
+        pending = self._pending
+        if pending and pending[0] == user_id:
+            pending.popleft()
+            self.cursor = user_id
+            done = self._done
+            while pending and pending[0] in done:
+                self.cursor = pending.popleft()
+                done.discard(self.cursor)
+        else:
+            self._done.add(user_id)
+
+
+class Broadcaster:
+    def __init__(
+        self,
+        store: BroadcastStore,
+        send: SendFunc,
+        rate: float = 25.0,
+        workers: int = 16,
+        page_size: int = 1000,
+        flush_interval: float = 5.0,
+        checkpoint_interval: float = 2.0,
+        poll_interval: float = 5.0,
+        report_interval: float = 30.0,
+        max_retries: int = 3,
+    ):
+        self.store = store
+        self.send = send
+        self.rate = rate
+        self.workers = workers
+        self.page_size = page_size
+        self.flush_interval = flush_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval
+        self.max_retries = max_retries
+        self.progress: Optional[Progress] = None
+        self._subscribers: Set[int] = set()
+        # Запись в SQLite и чтение страниц — в отдельном потоке
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="broadcast")
+        self._lock_file = None
+        self._tasks: List[asyncio.Task] = []
+        self._stopping: Optional[asyncio.Event] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._cancelled: Set[int] = set()
+        self._bucket: Optional[TokenBucket] = None
+        self._paused_until = 0.0
+
+    async def _io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # Горячий путь /start: только добавление во множество в памяти
+    def subscribe(self, user_id: int) -> None:
+        self._subscribers.add(user_id)
+
+    async def flush_subscribers(self) -> None:
+        if not self._subscribers:
+            return
+        user_ids, self._subscribers = list(self._subscribers), set()
+        try:
+            await self._io(self.store.add_subscribers, user_ids)
+        except Exception:
+            logger.exception("Не удалось записать %s подписчиков", len(user_ids))
+            self._subscribers.update(user_ids)
+
+    async def enqueue(self, text: str) -> Tuple[int, int]:
+        await self.flush_subscribers()
+        job_id = await self._io(self.store.create, text)
+        recipients = await self._io(self.store.subscriber_count)
+        if self._wake is not None:
+            self._wake.set()
+        return job_id, recipients
+
+    async def cancel(self, job_id: int) -> bool:
+        self._cancelled.add(job_id)
+        return await self._io(self.store.cancel, job_id)
+
+    async def status(self, job_id: Optional[int] = None) -> Optional[Job]:
+        if job_id is None:
+            return await self._io(self.store.next_job)
+        return await self._io(self.store.get, job_id)
+
+    def _try_lock(self) -> bool:
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.store.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._wake = asyncio.Event()
+        self._tasks.append(loop.create_task(self._flush_loop()))
+        if not self._try_lock():
+            logger.info("Рассылки ведёт другой процесс, здесь они только ставятся в очередь")
+        self._tasks.append(loop.create_task(self._run_loop()))
+
+    # Остановка: начатые отправки завершаются, прогресс сохраняется, и
+    # прерванная рассылка продолжится после перезапуска
+    async def stop(self) -> None:
+        if not self._tasks:
+            return
+        self._stopping.set()
+        self._wake.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush_subscribers()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def _flush_loop(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush_subscribers()
+
+    async def _run_loop(self) -> None:
+        locked = self._lock_file is not None
+        while not self._stopping.is_set():
+            # Сброс до запроса очереди, чтобы не пропустить enqueue()
+            self._wake.clear()
+            try:
+                # Блокировку можно получить и позже, если рассылавший процесс завершился
+                if self._try_lock():
+                    if not locked:
+                        logger.info("Рассылки переходят к этому процессу")
+                        locked = True
+                    job = await self._io(self.store.next_job)
+                else:
+                    job = None
+                if job is not None:
+                    await self._run_job(job)
+                    continue
+            except Exception:
+                logger.exception("Ошибка рассылки")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    # Ожидание слота отправки; False, если рассылку прервали раньше
+    async def _acquire(self, interrupted: Callable[[], bool]) -> bool:
+        loop = asyncio.get_running_loop()
+        while not interrupted():
+            now = loop.time()
+            wait = max(self._paused_until - now, self._bucket.wait_time(now))
+            if wait <= 0:
+                self._bucket.take()
+                return True
+            await asyncio.sleep(min(wait, 1.0))
+        return False
+
+    def _pause(self, exc: RetryAfter) -> None:
+        retry_after = exc.retry_after
+        seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+        self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + seconds)
+        logger.warning("Рассылка: flood control, пауза %.1f с", seconds)
+
+    # Отправка одному получателю: "sent", "blocked", "failed" или None,
+    # если рассылку прервали до отправки
+    async def _deliver(self, user_id: int, text: str, interrupted: Callable[[], bool]) -> Optional[str]:
+        attempt = 0
+        while await self._acquire(interrupted):
+            try:
+                await self.send(user_id, text)
+                return "sent"
+            except Forbidden:
+                return "blocked"
+            except RetryAfter as exc:
+                # Повтор после паузы не считается попыткой
+                self._pause(exc)
+            except BadRequest as exc:
+                if any(marker in exc.message.lower() for marker in _GONE_MARKERS):
+                    return "blocked"
+                logger.warning("Рассылка: %s не доставлено: %s", user_id, exc.message)
+                return "failed"
+            except NetworkError as exc:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.warning("Рассылка: %s не доставлено после %s попыток: %s", user_id, attempt, exc)
+                    return "failed"
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramError as exc:
+                logger.warning("Рассылка: %s не доставлено: %s", user_id, exc)
+                return "failed"
+        return None
+
+    async def _run_job(self, job: Job) -> None:
+        job = await self._io(self.store.begin, job)
+        loop = asyncio.get_running_loop()
+        self._bucket = TokenBucket(self.rate, max(self.rate, 1.0), loop.time())
+        counts = {"sent": job.sent, "blocked": job.blocked, "failed": job.failed}
+        logger.info(
+            "Рассылка #%s: %s получателей, продолжение после user_id %s",
+            job.id, job.total - sum(counts.values()), job.cursor,
+        )
+
+        gone: List[int] = []
+        watermark = Watermark(job.cursor)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 4)
+        # (время, обработано) для оценки скорости за последнюю минуту
+        samples: Deque[Tuple[float, int]] = deque(
+            [(loop.time(), sum(counts.values()))], maxlen=max(int(60 / self.checkpoint_interval), 2)
+        )
+
+        def interrupted() -> bool:
+            return self._stopping.is_set() or job.id in self._cancelled
+
+        async def produce() -> None:
+            after = job.cursor
+            while not interrupted():
+                user_ids = await self._io(self.store.page, after, self.page_size)
+                if not user_ids:
+                    break
+                for user_id in user_ids:
+                    if interrupted():
+                        break
+                    watermark.issue(user_id)
+                    await queue.put(user_id)
+                after = user_ids[-1]
+            for _ in range(self.workers):
+                await queue.put(None)
+
+        async def work() -> None:
+            while True:
+                user_id = await queue.get()
+                if user_id is None:
+                    return
+                try:
+                    outcome = await self._deliver(user_id, job.text, interrupted)
+                except Exception:
+                    logger.exception("Рассылка: ошибка отправки %s", user_id)
+                    outcome = "failed"
+                if outcome is None:
+                    continue
+                counts[outcome] += 1
+                if outcome == "blocked":
+                    gone.append(user_id)
+                watermark.complete(user_id)
+
+        def report() -> None:
+            now = loop.time()
+            processed = sum(counts.values())
+            samples.append((now, processed))
+            since, processed_then = samples[0]
+            rate = (processed - processed_then) / (now - since) if now > since else 0.0
+            remaining = max(job.total - processed, 0)
+            self.progress = Progress(
+                job.id, job.total, counts["sent"], counts["blocked"], counts["failed"],
+                rate, remaining / rate if rate > 0 else None,
+            )
+
+        async def checkpoint(status: Optional[str] = None) -> str:
+            nonlocal gone
+            batch, gone = gone, []
+            try:
+                current = await self._io(
+                    self.store.checkpoint, job._replace(cursor=watermark.cursor, **counts), batch, status
+                )
+            except Exception:
+                logger.exception("Рассылка #%s: не удалось сохранить прогресс", job.id)
+                gone = batch + gone
+                return RUNNING
+            if current == CANCELLED:
+                self._cancelled.add(job.id)
+            return current
+
+        async def checkpoints() -> None:
+            last_report = loop.time()
+            while True:
+                await asyncio.sleep(self.checkpoint_interval)
+                report()
+                await checkpoint()
+                if loop.time() - last_report >= self.report_interval:
+                    last_report = loop.time()
+                    self._log_progress()
+
+        saver = loop.create_task(checkpoints())
+        try:
+            await asyncio.gather(produce(), *(work() for _ in range(self.workers)))
+        finally:
+            saver.cancel()
+            await asyncio.gather(saver, return_exceptions=True)
+
+        report()
+        self._log_progress()
+        # При остановке процесса рассылка остаётся в статусе running
+        status = await checkpoint(None if self._stopping.is_set() else DONE)
+        self.progress = None
+        self._cancelled.discard(job.id)
+        if status == RUNNING:
+            logger.info("Рассылка #%s приостановлена после user_id %s", job.id, watermark.cursor)
+        else:
+            logger.info("Рассылка #%s: %s", job.id, status)
+
+    def _log_progress(self) -> None:
+        progress = self.progress
+        if progress is None:
+            return
+        logger.info(
+            "Рассылка #%s: %s/%s (отправлено %s, заблокировали бота %s, ошибок %s), %.1f сообщ./с, осталось %s",
+            progress.job_id, progress.processed, progress.total, progress.sent, progress.blocked, progress.failed,
+            progress.rate, format_eta(progress.eta),
+        )
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин {seconds} с"
+    return f"{seconds} с"
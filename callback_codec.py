@@ -0,0 +1,146 @@
+import base64
+import binascii
+import struct
+import zlib
+from typing import Mapping, Optional, Tuple
+
+# Компактный кодек callback_data.
+# Вместо имён банков и карт в кнопки кладётся версия формата, поколение
+# каталога, вид сущности и её целочисленный ID, упакованные в 6 байт и
+# закодированные в base64url (9 символов с префиксом). Декодирование —
+# индекс в массиве, без split() и хэширования длинных строк.
+
+CODEC_VERSION = 1
+PREFIX = "~"
+
+KIND_BANK = 1
+KIND_TYPE = 2
+KIND_CARD = 3
+
+# version (B), generation (H), kind (B), id (H)
+_PAYLOAD = struct.Struct(">BHBH")
+_ENCODED_LENGTH = len(PREFIX) + 8
+
+
+class CallbackDataError(ValueError):
+    pass
+
+
+def _unpack(data: str) -> Optional[Tuple[int, int, int, int]]:
+    if len(data) != _ENCODED_LENGTH or not data.startswith(PREFIX):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(data[len(PREFIX):])
+        return _PAYLOAD.unpack(raw)
+    except (binascii.Error, struct.error, ValueError):
+        return None
+
+
+# Поколение каталога из callback_data без полного разбора
+def payload_generation(data: str) -> Optional[int]:
+    payload = _unpack(data)
+    if payload is None or payload[0] != CODEC_VERSION:
+        return None
+    return payload[1]
+
+
+# Вид сущности — четвёртый байт упаковки; его кодируют 5-й и 6-й символы
+# base64, поэтому вид определяется поиском этой пары в таблице, без
+# декодирования. Версия, поколение и ID проверяются при полном разборе.
+_BASE64_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+_KIND_OFFSET = len(PREFIX) + 4
+_KIND_BY_CHARS = {
+    high + low: (i << 2) | (j >> 4)
+    for i, high in enumerate(_BASE64_ALPHABET)
+    for j, low in enumerate(_BASE64_ALPHABET)
+    if (i << 2) | (j >> 4) in (KIND_BANK, KIND_TYPE, KIND_CARD)
+}
+
+
+# Вид сущности из callback_data без проверки версии, поколения и ID
+def payload_kind(data: str) -> Optional[int]:
+    if len(data) != _ENCODED_LENGTH or not data.startswith(PREFIX):
+        return None
+    return _KIND_BY_CHARS.get(data[_KIND_OFFSET:_KIND_OFFSET + 2])
+
+
+class CatalogIds:
+    def __init__(self, banks: Mapping):
+        bank_names = []
+        type_names = []
+        cards = []
+        for bank, types in banks.items():
+            bank_names.append(bank)
+            for card_type, type_cards in types.items():
+                if card_type not in type_names:
+                    type_names.append(card_type)
+                for card in type_cards:
+                    cards.append((bank, card_type, card))
+
+        self.banks: Tuple[str, ...] = tuple(bank_names)
+        self.types: Tuple[str, ...] = tuple(type_names)
+        self.cards: Tuple[Tuple[str, str, str], ...] = tuple(cards)
+
+        self._bank_ids = {name: i for i, name in enumerate(self.banks)}
+        self._type_ids = {name: i for i, name in enumerate(self.types)}
+        self._card_ids = {key: i for i, key in enumerate(self.cards)}
+        self._tables = (None, self.banks, self.types, self.cards)
+
+        # Поколение каталога: кнопки, выданные до изменения каталога, отклоняются
+        fingerprint = "\x00".join("\x01".join(key) for key in self.cards)
+        self.generation = zlib.crc32(fingerprint.encode("utf-8")) & 0xFFFF
+
+    def bank_id(self, bank: str) -> int:
+        return self._bank_ids[bank]
+
+    def type_id(self, card_type: str) -> int:
+        return self._type_ids[card_type]
+
+    def card_id(self, bank: str, card_type: str, card: str) -> int:
+        return self._card_ids[(bank, card_type, card)]
+
+    def _encode(self, kind: int, item_id: int) -> str:
+        raw = _PAYLOAD.pack(CODEC_VERSION, self.generation, kind, item_id)
+        return PREFIX + base64.urlsafe_b64encode(raw).decode("ascii")
+
+    def encode_bank(self, bank: str) -> str:
+        return self._encode(KIND_BANK, self._bank_ids[bank])
+
+    def encode_type(self, card_type: str) -> str:
+        return self._encode(KIND_TYPE, self._type_ids[card_type])
+
+    def encode_card(self, bank: str, card_type: str, card: str) -> str:
+        return self._encode(KIND_CARD, self._card_ids[(bank, card_type, card)])
+
+    # Разбор callback_data в (kind, id); устаревшие и чужие данные отклоняются
+    def decode_id(self, data: str) -> Tuple[int, int]:
+        if len(data) != _ENCODED_LENGTH or not data.startswith(PREFIX):
+            raise CallbackDataError(f"Неизвестный формат callback_data: {data!r}")
+        try:
+            raw = base64.urlsafe_b64decode(data[len(PREFIX):])
+            version, generation, kind, item_id = _PAYLOAD.unpack(raw)
+        except (binascii.Error, struct.error, ValueError) as exc:
+            raise CallbackDataError(f"Повреждённые callback_data: {data!r}") from exc
+
+        if version != CODEC_VERSION:
+            raise CallbackDataError(f"Неподдерживаемая версия callback_data: {version}")
+        if generation != self.generation:
+            raise CallbackDataError("callback_data от устаревшей версии каталога")
+        if not KIND_BANK <= kind <= KIND_CARD or item_id >= len(self._tables[kind]):
+            raise CallbackDataError(f"Неизвестная сущность в callback_data: {kind}/{item_id}")
+        return kind, item_id
+
+    def decode(self, data: str, kind: int):
+        actual_kind, item_id = self.decode_id(data)
+        if actual_kind != kind:
+            raise CallbackDataError(f"Ожидался вид {kind}, получен {actual_kind}")
+        return self._tables[kind][item_id]
+
+    def decode_bank(self, data: str) -> str:
+        return self.decode(data, KIND_BANK)
+
+    def decode_type(self, data: str) -> str:
+        return self.decode(data, KIND_TYPE)
+
+    def decode_card(self, data: str) -> Tuple[str, str, str]:
+        return self.decode(data, KIND_CARD)
@@ -0,0 +1,297 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import AbstractSet, Any, Callable, Dict, FrozenSet, List, Mapping, NamedTuple, Optional, Tuple
+
+from attributes import CardTable
+from callback_codec import CatalogIds
+from search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+# Каталог банков и карт, загружаемый из внешнего JSON-файла.
+# Каждая загрузка строит неизменяемый снимок с индексами; новый снимок
+# подменяет старый одним присваиванием, а несколько предыдущих поколений
+# остаются доступны, чтобы кнопки, выданные до перезагрузки, продолжали
+# работать в рамках своего снимка.
+
+
+# Возрастные категории из главного меню: 14-17 и 18+
+AGE_BRACKETS = (14, 18)
+
+
+class CatalogError(ValueError):
+    pass
+
+
+class Card(NamedTuple):
+    id: int
+    bank: str
+    card_type: str
+    name: str
+    age_limit: int
+    advantages: Tuple[str, ...]
+    ref_link: str
+    # Путь к картинке относительно файла каталога
+    image: Optional[str] = None
+
+
+# Часть каталога, доступная возрастной категории: только непустые банки и типы
+class AgeView(NamedTuple):
+    age: int
+    cards: Tuple[Card, ...]
+    # bank -> card_type -> карты
+    banks: Mapping[str, Mapping[str, Tuple[Card, ...]]]
+
+
+def build_age_view(cards: Tuple[Card, ...], age: int) -> AgeView:
+    eligible = tuple(card for card in cards if card.age_limit <= age)
+    banks: Dict[str, Dict[str, List[Card]]] = {}
+    for card in eligible:
+        banks.setdefault(card.bank, {}).setdefault(card.card_type, []).append(card)
+    return AgeView(
+        age=age,
+        cards=eligible,
+        banks=MappingProxyType({
+            bank: MappingProxyType({t: tuple(c) for t, c in types.items()})
+            for bank, types in banks.items()
+        }),
+    )
+
+
+def age_bracket(age: int) -> int:
+    bracket = AGE_BRACKETS[0]
+    for candidate in AGE_BRACKETS:
+        if candidate <= age:
+            bracket = candidate
+    return bracket
+
+
+class Catalog:
+    # hidden_links — ref_link, признанные нерабочими: карты с ними остаются
+    # в снимке (их ID и кнопки не меняются), но не попадают в меню,
+    # рейтинги и поиск. indexes — состояние поиска и таблицы характеристик
+    # из файла снимка (snapshot.py), тогда индексы не строятся заново
+    def __init__(
+        self,
+        banks: Mapping,
+        version: Any = None,
+        hidden_links: AbstractSet[str] = frozenset(),
+        indexes: Optional[Tuple[tuple, tuple]] = None,
+    ):
+        self.version = version
+        self.ids = CatalogIds(banks)
+        self.generation = self.ids.generation
+
+        cards = []
+        for card_id, (bank, card_type, name) in enumerate(self.ids.cards):
+            info = banks[bank][card_type][name]
+            cards.append(Card(
+                id=card_id,
+                bank=bank,
+                card_type=card_type,
+                name=name,
+                age_limit=int(info["age_limit"]),
+                advantages=tuple(info["advantages"]),
+                ref_link=info["ref_link"],
+                image=info.get("image") or None,
+            ))
+        # Индекс по ID: позиция в кортеже совпадает с ID кодека callback_data
+        self.cards: Tuple[Card, ...] = tuple(cards)
+        self.hidden: FrozenSet[int] = frozenset(card.id for card in self.cards if card.ref_link in hidden_links)
+        visible = tuple(card for card in self.cards if card.id not in self.hidden) if self.hidden else self.cards
+
+        by_bank: Dict[str, List[Card]] = {}
+        by_type: Dict[str, List[Card]] = {}
+        by_age: Dict[int, List[Card]] = {}
+        by_key: Dict[Tuple[str, str, str], Card] = {}
+        nested: Dict[str, Dict[str, Dict[str, Card]]] = {}
+        for card in self.cards:
+            by_bank.setdefault(card.bank, []).append(card)
+            by_type.setdefault(card.card_type, []).append(card)
+            by_age.setdefault(card.age_limit, []).append(card)
+            by_key[(card.bank, card.card_type, card.name)] = card
+            nested.setdefault(card.bank, {}).setdefault(card.card_type, {})[card.name] = card
+
+        self.by_bank: Mapping[str, Tuple[Card, ...]] = MappingProxyType({k: tuple(v) for k, v in by_bank.items()})
+        self.by_type: Mapping[str, Tuple[Card, ...]] = MappingProxyType({k: tuple(v) for k, v in by_type.items()})
+        self.by_age: Mapping[int, Tuple[Card, ...]] = MappingProxyType({k: tuple(v) for k, v in sorted(by_age.items())})
+        self.by_key: Mapping[Tuple[str, str, str], Card] = MappingProxyType(by_key)
+        # bank -> card_type -> card name -> Card, в порядке файла
+        self.banks: Mapping[str, Mapping[str, Mapping[str, Card]]] = MappingProxyType({
+            bank: MappingProxyType({t: MappingProxyType(c) for t, c in types.items()})
+            for bank, types in nested.items()
+        })
+
+        self.views: Mapping[int, AgeView] = MappingProxyType(
+            {age: build_age_view(visible, age) for age in AGE_BRACKETS}
+        )
+
+        if indexes is not None:
+            self.search = SearchIndex.restore(self.cards, self.hidden, indexes[0])
+            self.table = CardTable.restore(self.cards, indexes[1])
+        else:
+            # Поиск для inline-режима
+            self.search = SearchIndex(self.cards, self.hidden)
+            # Числовые характеристики карт для рейтингов
+            self.table = CardTable(self.cards, self.hidden)
+
+        # Производные представления (экраны и т.п.), строятся до публикации снимка
+        self.screens = None
+
+    def __len__(self) -> int:
+        return len(self.cards)
+
+    def card(self, bank: str, card_type: str, name: str) -> Optional[Card]:
+        return self.by_key.get((bank, card_type, name))
+
+    def view(self, age: int) -> AgeView:
+        return self.views[age_bracket(age)]
+
+
+def _validate(data: Any) -> Tuple[Mapping, Any]:
+    if not isinstance(data, dict) or not isinstance(data.get("banks"), dict):
+        raise CatalogError("Ожидается объект с ключом 'banks'")
+    banks = data["banks"]
+    for bank, types in banks.items():
+        if not isinstance(types, dict):
+            raise CatalogError(f"{bank}: ожидается словарь типов карт")
+        for card_type, cards in types.items():
+            if not isinstance(cards, dict):
+                raise CatalogError(f"{bank}/{card_type}: ожидается словарь карт")
+            for name, info in cards.items():
+                missing = {"age_limit", "advantages", "ref_link"} - set(info)
+                if missing:
+                    raise CatalogError(f"{bank}/{card_type}/{name}: нет полей {sorted(missing)}")
+                if not isinstance(info.get("image", ""), str):
+                    raise CatalogError(f"{bank}/{card_type}/{name}: поле image должно быть строкой")
+    return banks, data.get("version")
+
+
+def parse_catalog(content: bytes, path: str, hidden_links: AbstractSet[str] = frozenset()) -> Catalog:
+    try:
+        data = json.loads(content)
+    except ValueError as exc:
+        raise CatalogError(f"{path}: некорректный JSON: {exc}") from exc
+    banks, version = _validate(data)
+    return Catalog(banks, version, hidden_links)
+
+
+def load_catalog(path: str, hidden_links: AbstractSet[str] = frozenset()) -> Catalog:
+    with open(path, "rb") as f:
+        content = f.read()
+    return parse_catalog(content, path, hidden_links)
+
+
+class CatalogStore:
+    def __init__(
+        self,
+        path: str,
+        renderer: Optional[Callable[[Catalog], Any]] = None,
+        keep_generations: int = 4,
+        snapshot_file=None,
+    ):
+        self.path = path
+        self._renderer = renderer
+        # Файл снимка для быстрого запуска (snapshot.CatalogSnapshot) или None
+        self.snapshot_file = snapshot_file
+        self._keep_generations = keep_generations
+        self._snapshots: "OrderedDict[int, Catalog]" = OrderedDict()
+        self._current: Optional[Catalog] = None
+        self._mtime: Optional[float] = None
+        self._listeners: List[Callable[[Catalog], None]] = []
+        # Нерабочие ссылки, карты с которыми скрываются из меню
+        self.hidden_links: FrozenSet[str] = frozenset()
+        self.last_reload_seconds = 0.0
+        # Последний снимок прочитан из файла снимка, а не собран из JSON
+        self.from_snapshot = False
+
+    @property
+    def current(self) -> Catalog:
+        return self._current
+
+    # Снимок, которому принадлежит поколение из callback_data
+    def snapshot(self, generation: int) -> Optional[Catalog]:
+        return self._snapshots.get(generation)
+
+    def add_listener(self, listener: Callable[[Catalog], None]) -> None:
+        self._listeners.append(listener)
+
+    def _build(self) -> Catalog:
+        started = time.perf_counter()
+        # Битый файл не перечитывается повторно, пока его снова не изменят
+        self._mtime = os.stat(self.path).st_mtime
+        with open(self.path, "rb") as f:
+            content = f.read()
+        # Снимок на диске хранит каталог без скрытых карт
+        snapshot_file = self.snapshot_file if not self.hidden_links else None
+        catalog = snapshot_file.load(content) if snapshot_file is not None else None
+        self.from_snapshot = catalog is not None
+        if catalog is None:
+            catalog = parse_catalog(content, self.path, self.hidden_links)
+            if self._renderer is not None:
+                catalog.screens = self._renderer(catalog)
+            if snapshot_file is not None:
+                snapshot_file.save(catalog, content)
+        self.last_reload_seconds = time.perf_counter() - started
+        return catalog
+
+    def _publish(self, catalog: Catalog) -> None:
+        self._snapshots[catalog.generation] = catalog
+        self._snapshots.move_to_end(catalog.generation)
+        while len(self._snapshots) > self._keep_generations:
+            self._snapshots.popitem(last=False)
+        self._current = catalog
+        for listener in self._listeners:
+            try:
+                listener(catalog)
+            except Exception:
+                logger.exception("Ошибка обработчика перезагрузки каталога")
+
+    def load(self) -> Catalog:
+        catalog = self._build()
+        self._publish(catalog)
+        logger.info(
+            "Каталог загружен%s: %s карт за %.1f мс",
+            " из снимка" if self.from_snapshot else "", len(catalog), self.last_reload_seconds * 1e3,
+        )
+        return catalog
+
+    def changed(self) -> bool:
+        try:
+            return os.stat(self.path).st_mtime != self._mtime
+        except OSError:
+            return False
+
+    # Перезагрузка в отдельном потоке; при ошибке остаётся прежний снимок
+    async def reload(self) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            catalog = await loop.run_in_executor(None, self._build)
+        except (OSError, CatalogError, KeyError, TypeError, ValueError) as exc:
+            logger.error("Каталог не перезагружен, используется прежний: %s", exc)
+            return False
+        self._publish(catalog)
+        logger.info(
+            "Каталог перезагружен: %s карт за %.1f мс", len(catalog), self.last_reload_seconds * 1e3
+        )
+        return True
+
+    # Пересборка снимка с новым набором нерабочих ссылок; False, если
+    # набор не изменился или снимок не пересобран
+    async def hide_links(self, links: AbstractSet[str]) -> bool:
+        links = frozenset(links)
+        if links == self.hidden_links:
+            return False
+        self.hidden_links = links
+        return await self.reload()
+
+    async def watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            if self.changed():
+                await self.reload()
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import metrics
+
+# Отпечатки последнего показанного экрана для каждого сообщения.
+# Если новый экран совпадает с уже показанным, правка не отправляется:
+# Telegram всё равно ответил бы ошибкой "message is not modified".
+
+unchanged_edits = metrics.registry.counter(
+    "refbot_unchanged_edits_total",
+    "Правки, не изменившие экран: пропущенные до запроса и отклонённые Telegram",
+    ("result",),
+)
+
+
+class RenderedMessages:
+    def __init__(self, max_messages: int = 50000):
+        self.max_messages = max_messages
+        self._fingerprints: "OrderedDict[Hashable, int]" = OrderedDict()
+        # Сэкономленные обращения к Bot API
+        self.skipped = 0
+        # Правки, на которые Telegram ответил "message is not modified"
+        self.not_modified = 0
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+    def is_shown(self, key: Optional[Hashable], fingerprint: int) -> bool:
+        if key is None or self._fingerprints.get(key) != fingerprint:
+            return False
+        self._fingerprints.move_to_end(key)
+        self.skipped += 1
+        unchanged_edits.inc("skipped")
+        return True
+
+    # Telegram ответил на правку "message is not modified"
+    def count_not_modified(self) -> None:
+        self.not_modified += 1
+        unchanged_edits.inc("not_modified")
+
+    def remember(self, key: Optional[Hashable], fingerprint: int) -> None:
+        if key is None:
+            return
+        self._fingerprints[key] = fingerprint
+        self._fingerprints.move_to_end(key)
+        if len(self._fingerprints) > self.max_messages:
+            self._fingerprints.popitem(last=False)
+
+    def forget(self, key: Optional[Hashable]) -> None:
+        if key is not None:
+            self._fingerprints.pop(key, None)
@@ -0,0 +1,326 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import signal
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Жизненный цикл процесса бота: замер запуска, остановка по SIGTERM с
+# дочиткой очереди обновлений до дедлайна и передача необработанных
+# обновлений следующему процессу.
+# Журнал обновлений — JSON-файл с id недавно обработанных обновлений и
+# обновлениями, которые не успели обработать до дедлайна. Пока процесс
+# работает, он держит блокировку журнала; новый процесс при запуске ждёт её
+# и тем самым — окончания остановки старого, затем первыми обрабатывает
+# переданные обновления и пропускает повторно доставленные.
+
+startup_seconds = metrics.registry.gauge(
+    "refbot_startup_seconds", "Время запуска процесса до готовности принимать обновления", ("phase",)
+)
+duplicate_updates = metrics.registry.counter(
+    "refbot_duplicate_updates_total", "Повторно доставленные и пропущенные обновления"
+)
+handed_off_updates = metrics.registry.counter(
+    "refbot_handed_off_updates_total", "Обновления, переданные следующему процессу при остановке"
+)
+
+
+# Ожидание SIGTERM/SIGINT
+async def wait_for_stop_signal() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await stop.wait()
+
+
+# Замер этапов запуска от начала импорта модуля бота
+class StartupTimer:
+    def __init__(self, budget: float, started: Optional[float] = None):
+        self.budget = budget
+        self.started = time.perf_counter() if started is None else started
+        self._last = self.started
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def ready(self) -> float:
+        total = time.perf_counter() - self.started
+        for phase, seconds in self.phases.items():
+            startup_seconds.set(seconds, phase)
+        startup_seconds.set(total, "total")
+        details = ", ".join(f"{phase} {seconds * 1e3:.0f} мс" for phase, seconds in self.phases.items())
+        if self.budget > 0 and total > self.budget:
+            logger.warning("Запуск занял %.2f с при бюджете %.2f с: %s", total, self.budget, details)
+        else:
+            logger.info("Запуск за %.2f с: %s", total, details)
+        return total
+
+
+class UpdateJournal:
+    def __init__(self, path: str, window: int = 4096):
+        self.path = path
+        self._processed: Deque[int] = deque(maxlen=window)
+        self._seen: Set[int] = set()
+        self._pending: List[dict] = []
+        self._lock_file = None
+
+    # Ожидание блокировки журнала: предыдущий процесс ещё дочитывает очередь
+    async def acquire(self, timeout: float) -> bool:
+        lock_file = open(self.path + ".lock", "a")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if loop.time() >= deadline:
+                    lock_file.close()
+                    logger.warning("Журнал %s занят дольше %.0f с, запуск без передачи обновлений", self.path, timeout)
+                    return False
+                await asyncio.sleep(0.1)
+        self._lock_file = lock_file
+        self._load()
+        return True
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as exc:
+            logger.error("Журнал обновлений %s повреждён, пропущен: %s", self.path, exc)
+            return
+        for update_id in data.get("processed", ()):
+            self._remember(update_id)
+        self._pending = data.get("pending", [])
+        if self._processed or self._pending:
+            logger.info(
+                "Журнал обновлений: последнее обработанное %s, передано необработанных %s",
+                self.last_update_id, len(self._pending),
+            )
+
+    def _remember(self, update_id: int) -> None:
+        if len(self._processed) == self._processed.maxlen:
+            self._seen.discard(self._processed[0])
+        self._processed.append(update_id)
+        self._seen.add(update_id)
+
+    @property
+    def last_update_id(self) -> Optional[int]:
+        return max(self._processed) if self._processed else None
+
+    def seen(self, update_id: int) -> bool:
+        return update_id in self._seen
+
+    def done(self, update_id: int) -> None:
+        if update_id not in self._seen:
+            self._remember(update_id)
+
+    def take_pending(self) -> List[dict]:
+        pending, self._pending = self._pending, []
+        return pending
+
+    def save(self, pending: List[dict]) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"processed": list(self._processed), "pending": pending}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def release(self) -> None:
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+# Application, отмечающее обработанные обновления в журнале и
+# пропускающее уже обработанные
+class TrackedApplication(Application):
+    def __init__(self, *args, journal: Optional[UpdateJournal] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.journal = journal
+        # update_id -> обновление, обрабатываемое прямо сейчас, и задача,
+        # в которой идёт его обработка
+        self.in_flight: Dict[int, Update] = {}
+        self._handler_tasks: Dict[int, asyncio.Task] = {}
+        # Обработка прервана cancel_handlers
+        self._interrupted: Set[int] = set()
+        # Вызывается, когда обработка обновления завершена (в том числе
+        # ошибкой или как дубликат); для прерванных не вызывается
+        self.on_done: Optional[Callable[[Update], None]] = None
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            return await super().process_update(update)
+        journal = self.journal
+        update_id = update.update_id
+        if journal is not None and journal.seen(update_id):
+            duplicate_updates.inc()
+            logger.debug("Обновление %s уже обработано, пропущено", update_id)
+            self._finish(update)
+            return None
+        self.in_flight[update_id] = update
+        self._handler_tasks[update_id] = asyncio.current_task()
+        try:
+            await super().process_update(update)
+        except asyncio.CancelledError:
+            # Прервано по дедлайну остановки: отмена снимается, чтобы PTB
+            # продолжил читать очередь, а обновление останется в журнале
+            # необработанным. Отмену задачи извне пробрасываем дальше.
+            if update_id not in self._interrupted or asyncio.current_task().uncancel() > 0:
+                raise
+            return None
+        except BaseException:
+            self._finish(update)
+            raise
+        else:
+            self._finish(update)
+        finally:
+            self.in_flight.pop(update_id, None)
+            self._handler_tasks.pop(update_id, None)
+
+    def _finish(self, update: Update) -> None:
+        if self.journal is not None:
+            self.journal.done(update.update_id)
+        if self.on_done is not None:
+            self.on_done(update)
+
+    # Прерывание обработчиков, не завершившихся к дедлайну, с ожиданием их
+    # завершения; возвращает обновления, обработка которых прервана
+    async def cancel_handlers(self) -> List[Update]:
+        interrupted = dict(self.in_flight)
+        self._interrupted.update(interrupted)
+        for task in self._handler_tasks.values():
+            task.cancel()
+        try:
+            while any(update_id in self.in_flight for update_id in interrupted):
+                await asyncio.sleep(0.01)
+        finally:
+            self._interrupted.difference_update(interrupted)
+        return list(interrupted.values())
+
+
+# Обновления, переданные предыдущим процессом, ставятся в очередь первыми
+async def restore_pending(application: Application, journal: UpdateJournal) -> int:
+    pending = journal.take_pending()
+    for data in pending:
+        update = Update.de_json(data, application.bot)
+        if update is not None:
+            await application.update_queue.put(update)
+    return len(pending)
+
+
+# Остановка после того, как приём новых обновлений прекращён: очередь
+# дочитывается до дедлайна, оставшиеся и прерванные обновления сохраняются
+# в журнал, затем выполняются shutdown и post_shutdown — запись сессий,
+# аналитики и прогресса рассылок.
+async def drain_and_shutdown(application: Application, timeout: float, journal: Optional[UpdateJournal] = None) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    queue = application.update_queue
+    in_flight = getattr(application, "in_flight", {})
+    started = loop.time()
+    while (not queue.empty() or in_flight) and loop.time() < deadline:
+        await asyncio.sleep(0.02)
+
+    # Не дочитанное до дедлайна не обрабатывается, а передаётся дальше
+    leftover: List[Update] = []
+    while not queue.empty():
+        item = queue.get_nowait()
+        queue.task_done()
+        if isinstance(item, Update):
+            leftover.append(item)
+
+    # Обработчики, не успевшие к дедлайну, прерываются и дожидаются до
+    # снимка: иначе они могли бы ещё отправить сообщения, а следующий
+    # процесс — обработать те же обновления заново
+    interrupted: List[Update] = []
+    if isinstance(application, TrackedApplication):
+        interrupted = await application.cancel_handlers()
+        if interrupted:
+            logger.warning("Обработчики не завершились за %.0f с, прерваны: %s", timeout, len(interrupted))
+    if application.running:
+        await application.stop()
+    pending = interrupted + leftover
+    logger.info(
+        "Очередь обновлений дочитана за %.2f с, передаётся следующему процессу: %s",
+        loop.time() - started, len(pending),
+    )
+
+    try:
+        await application.shutdown()
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        if journal is not None:
+            handed_off_updates.inc(amount=len(pending))
+            journal.save([update.to_dict() for update in pending])
+            journal.release()
+
+
+# Ожидание остановки предыдущего процесса. Вызывается до построения
+# приложения: хранилище сессий и блокировки рассылки, медиа и проверки
+# ссылок открываются, только когда старый процесс их уже отпустил.
+# None, если блокировку журнала получить не удалось: процесс работает без
+# журнала и не трогает файл передачи, принадлежащий другому процессу.
+async def acquire_journal(
+    journal: Optional[UpdateJournal], drain_timeout: float, startup: Optional[StartupTimer] = None
+) -> Optional[UpdateJournal]:
+    if journal is None:
+        return None
+    acquired = await journal.acquire(drain_timeout + 5)
+    if startup is not None:
+        startup.mark("handoff")
+    return journal if acquired else None
+
+
+# build(journal=...) строит приложение после передачи журнала
+async def run_polling(
+    build: Callable[..., Application],
+    drain_timeout: float,
+    journal: Optional[UpdateJournal] = None,
+    startup: Optional[StartupTimer] = None,
+) -> None:
+    journal = await acquire_journal(journal, drain_timeout, startup)
+    application = build(journal=journal)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if startup is not None:
+        startup.mark("initialize")
+    await application.start()
+    if journal is not None:
+        await restore_pending(application, journal)
+    # start_polling сам снимает вебхук
+    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    if startup is not None:
+        startup.mark("polling")
+        startup.ready()
+    try:
+        await wait_for_stop_signal()
+    finally:
+        logger.info("Остановка: приём обновлений прекращён")
+        if application.updater.running:
+            await application.updater.stop()
+        await drain_and_shutdown(application, drain_timeout, journal)
+        logger.info("Приложение остановлено")
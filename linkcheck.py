@@ -0,0 +1,327 @@
+import asyncio
+import fcntl
+import itertools
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+from urllib.parse import urlsplit
+
+import httpx
+
+import metrics
+from catalog import Catalog, CatalogStore
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Проверка реферальных ссылок каталога.
+# Каждая уникальная ссылка запрашивается GET с переходом по редиректам через
+# пул keep-alive соединений своего хоста: не больше concurrency запросов
+# одновременно, не больше host_connections соединений и host_rate запросов в
+# секунду на хост (token bucket на хост, ссылки в очереди чередуются по хостам). ETag и Last-Modified прошлого
+# ответа отправляются в If-None-Match/If-Modified-Since, и неизменившаяся
+# страница отвечает 304 без тела. Ссылка, не открывшаяся failures раз подряд
+# (ошибка соединения, таймаут, ответ 4xx/5xx), считается нерабочей, и карты
+# с ней скрываются из меню пересборкой снимка каталога; первая же успешная
+# проверка возвращает их. 429 и 503 не считаются ни успехом, ни ошибкой.
+# Результаты хранятся в SQLite; проверяет один процесс (файловая блокировка
+# LINKCHECK_STORE.lock), остальные берут нерабочие ссылки из базы.
+
+link_checks = metrics.registry.counter(
+    "refbot_link_checks_total", "Проверки реферальных ссылок по исходу", ("result",)
+)
+
+# Ответы перегруженного сервера: проверка откладывается до следующего круга
+_DEFERRED_STATUSES = frozenset((429, 503))
+
+
+class LinkState(NamedTuple):
+    url: str
+    # HTTP статус последнего ответа после редиректов; 0 — ответа нет
+    status: int
+    # Сколько проверок подряд закончились ошибкой
+    failures: int
+    checked_at: float
+    final_url: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    error: Optional[str] = None
+
+
+class LinkStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS links ("
+            " url TEXT PRIMARY KEY, status INTEGER NOT NULL, failures INTEGER NOT NULL,"
+            " checked_at REAL NOT NULL, final_url TEXT, etag TEXT, last_modified TEXT, error TEXT)"
+        )
+        self._db.commit()
+
+    def load(self) -> Dict[str, LinkState]:
+        rows = self._db.execute(
+            "SELECT url, status, failures, checked_at, final_url, etag, last_modified, error FROM links"
+        )
+        return {row[0]: LinkState(*row) for row in rows}
+
+    def save(self, states: Iterable[LinkState]) -> None:
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?, ?, ?)", states)
+
+    def failing(self, failures: int) -> Set[str]:
+        rows = self._db.execute("SELECT url FROM links WHERE failures >= ?", (failures,))
+        return {row[0] for row in rows}
+
+    def close(self) -> None:
+        self._db.close()
+
+
+# Ограничение частоты запросов к каждому хосту
+class HostLimiter:
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    async def acquire(self, host: str) -> None:
+        if self.rate <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = TokenBucket(self.rate, self.burst, loop.time())
+        while True:
+            wait = bucket.wait_time(loop.time())
+            if wait <= 0:
+                bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+
+# Очередь ссылок вперемешку по хостам, чтобы соседние запросы не ждали
+# лимита одного и того же хоста
+def interleave_by_host(urls: Iterable[str]) -> List[str]:
+    by_host: Dict[str, List[str]] = {}
+    for url in urls:
+        by_host.setdefault(urlsplit(url).netloc, []).append(url)
+    return [url for group in itertools.zip_longest(*by_host.values()) for url in group if url is not None]
+
+
+class LinkChecker:
+    def __init__(
+        self,
+        store: LinkStore,
+        catalog_store: CatalogStore,
+        interval: float = 600.0,
+        concurrency: int = 32,
+        host_rate: float = 2.0,
+        failures: int = 3,
+        timeout: float = 10.0,
+        max_hidden_share: float = 0.5,
+        host_connections: int = 4,
+    ):
+        self.store = store
+        self.catalog_store = catalog_store
+        self.interval = interval
+        self.concurrency = max(1, concurrency)
+        self.failures = max(1, failures)
+        self.timeout = timeout
+        # Если нерабочими оказалась большая доля ссылок, вероятнее сбой сети
+        # у бота, чем у партнёров, и карты не скрываются
+        self.max_hidden_share = max_hidden_share
+        self.hosts = HostLimiter(host_rate)
+        self._states: Optional[Dict[str, LinkState]] = None
+        self.host_connections = max(1, host_connections)
+        # Хост -> клиент со своим пулом соединений
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        # Запись в SQLite — в отдельном потоке
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="linkcheck")
+        self._lock_file = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        catalog_store.add_listener(self._on_reload)
+
+    async def _io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _try_lock(self) -> bool:
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.store.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    # Новые ссылки после перезагрузки каталога проверяются сразу, не
+    # дожидаясь очередного круга
+    def _on_reload(self, catalog: Catalog) -> None:
+        if self._wake is None or self._states is None:
+            return
+        if any(card.ref_link not in self._states for card in catalog.cards):
+            self._wake.set()
+
+    # Пул соединений на хост: соединения переиспользуются между проверками
+    # ссылок одного хоста, их число ограничено host_connections. Один общий
+    # пул httpx на сотни соединений перебирает их все при каждом запросе и
+    # на многих хостах медленнее, чем открытие нового соединения
+    def _client_for(self, host: str) -> httpx.AsyncClient:
+        client = self._clients.get(host)
+        if client is None:
+            limit = self.host_connections
+            client = self._clients[host] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+                timeout=self.timeout,
+                follow_redirects=True,
+                headers={"User-Agent": "RefBot link checker"},
+            )
+        return client
+
+    def state(self, url: str) -> Optional[LinkState]:
+        return self._states.get(url) if self._states is not None else None
+
+    async def check_url(self, url: str) -> LinkState:
+        previous = self.state(url)
+        headers = {}
+        if previous is not None and previous.status:
+            if previous.etag:
+                headers["If-None-Match"] = previous.etag
+            if previous.last_modified:
+                headers["If-Modified-Since"] = previous.last_modified
+        failures = previous.failures if previous is not None else 0
+        host = urlsplit(url).netloc
+        await self.hosts.acquire(host)
+        try:
+            response = await self._client_for(host).get(url, headers=headers)
+        except (httpx.HTTPError, httpx.InvalidURL) as exc:
+            link_checks.inc("failed")
+            return LinkState(url, 0, failures + 1, time.time(), error=str(exc) or type(exc).__name__)
+
+        now = time.time()
+        status = response.status_code
+        if status == 304 and previous is not None:
+            link_checks.inc("not_modified")
+            return previous._replace(failures=0, checked_at=now, error=None)
+        if status in _DEFERRED_STATUSES:
+            link_checks.inc("deferred")
+            if previous is not None:
+                return previous._replace(checked_at=now)
+            return LinkState(url, status, failures, now, str(response.url))
+        if 200 <= status < 300:
+            link_checks.inc("ok")
+            return LinkState(
+                url, status, 0, now, str(response.url),
+                response.headers.get("etag"), response.headers.get("last-modified"),
+            )
+        link_checks.inc("failed")
+        return LinkState(url, status, failures + 1, now, str(response.url), error=response.reason_phrase)
+
+    # Проверка ссылок с ограничением числа одновременных запросов
+    async def check(self, urls: Iterable[str]) -> Dict[str, LinkState]:
+        if self._states is None:
+            self._states = await self._io(self.store.load)
+        queue: asyncio.Queue = asyncio.Queue()
+        for url in interleave_by_host(dict.fromkeys(urls)):
+            queue.put_nowait(url)
+        results: Dict[str, LinkState] = {}
+
+        async def worker() -> None:
+            while not queue.empty():
+                url = queue.get_nowait()
+                state = await self.check_url(url)
+                results[url] = self._states[url] = state
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, queue.qsize()))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            if results:
+                await self._io(self.store.save, list(results.values()))
+        return results
+
+    # Круг проверки: ссылки текущего снимка, не проверявшиеся дольше interval
+    async def check_catalog(self) -> Set[str]:
+        if self._states is None:
+            self._states = await self._io(self.store.load)
+        urls = {card.ref_link for card in self.catalog_store.current.cards}
+        now = time.time()
+        due = [
+            url for url in urls
+            if url not in self._states or now - self._states[url].checked_at >= self.interval
+        ]
+        if due:
+            started = time.perf_counter()
+            results = await self.check(due)
+            failed = sum(1 for state in results.values() if state.failures)
+            logger.info(
+                "Проверено реферальных ссылок: %s за %.1f с, с ошибкой: %s",
+                len(results), time.perf_counter() - started, failed,
+            )
+        return {url for url in urls if self._states[url].failures >= self.failures}
+
+    # Скрытие карт с нерабочими ссылками и возврат восстановившихся
+    async def apply(self, failing: Set[str]) -> bool:
+        catalog = self.catalog_store.current
+        urls = {card.ref_link for card in catalog.cards}
+        failing = failing & urls
+        if urls and len(failing) > self.max_hidden_share * len(urls):
+            logger.error(
+                "Не открываются %s из %s реферальных ссылок, карты не скрываются: вероятен сбой сети",
+                len(failing), len(urls),
+            )
+            return False
+        hidden = self.catalog_store.hidden_links & urls
+        for url in sorted(failing - hidden):
+            state = self.state(url)
+            logger.warning(
+                "Ссылка не открывается, карты скрыты: %s (%s)",
+                url, state.error or state.status if state is not None else "по данным другого процесса",
+            )
+        for url in sorted(hidden - failing):
+            logger.info("Ссылка снова открывается, карты возвращены: %s", url)
+        return await self.catalog_store.hide_links(failing)
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                # Блокировку можно получить и позже, если проверявший процесс завершился
+                if self._try_lock():
+                    failing = await self.check_catalog()
+                else:
+                    failing = await self._io(self.store.failing, self.failures)
+                await self.apply(failing)
+            except Exception:
+                logger.exception("Ошибка проверки реферальных ссылок")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._wake = None
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(client.aclose() for client in clients))
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
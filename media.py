@@ -0,0 +1,285 @@
+import asyncio
+import fcntl
+import functools
+import hashlib
+import html
+import logging
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from telegram.error import RetryAfter, TelegramError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Картинки карт.
+# Картинка задаётся полем "image" карты в каталоге — путём относительно
+# файла каталога. Telegram возвращает file_id загруженного файла, и
+# повторная отправка по file_id не передаёт байты. file_id хранятся в SQLite
+# по (ID карты, SHA-256 содержимого): изменённая картинка получает новый хэш
+# и загружается заново, а одинаковая картинка у нескольких карт или после
+# перенумерации карт загружается один раз. Хэши считаются в потоке при
+# загрузке каталога и кэшируются по размеру и mtime файла.
+# Прогрев — загрузка ещё не загруженных картинок в служебный чат
+# ограниченным числом одновременных отправок — ведёт один процесс
+# (файловая блокировка MEDIA_STORE.lock); остальные читают file_id из базы.
+# Запросы к базе идут в отдельном потоке, цикл событий их не ждёт.
+
+# Лимит подписи к фото в Telegram, символов без разметки
+CAPTION_LIMIT = 1024
+_TAG_RE = re.compile(r"<[^>]*>")
+
+card_media_sends = metrics.registry.counter(
+    "refbot_card_media_total", "Показы картинок карт: по сохранённому file_id или с загрузкой файла", ("source",)
+)
+
+# (содержимое, имя файла) -> file_id загруженного фото
+UploadFunc = Callable[[bytes, str], Awaitable[str]]
+
+
+class CardImage(NamedTuple):
+    path: str
+    digest: str
+
+
+@functools.lru_cache(maxsize=4096)
+def fits_caption(text: str) -> bool:
+    return len(html.unescape(_TAG_RE.sub("", text))) <= CAPTION_LIMIT
+
+
+class MediaStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS card_media ("
+            " card_id INTEGER NOT NULL, digest TEXT NOT NULL, file_id TEXT NOT NULL,"
+            " uploaded_at INTEGER NOT NULL, PRIMARY KEY (card_id, digest));"
+            "CREATE INDEX IF NOT EXISTS card_media_digest ON card_media (digest);"
+        )
+        self._db.commit()
+
+    # file_id этой карты, иначе любой карты с тем же содержимым
+    def get(self, card_id: int, digest: str) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT file_id FROM card_media WHERE digest = ? ORDER BY card_id = ? DESC LIMIT 1",
+            (digest, card_id),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, card_id: int, digest: str, file_id: str) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO card_media (card_id, digest, file_id, uploaded_at) VALUES (?, ?, ?, ?)",
+                (card_id, digest, file_id, int(time.time())),
+            )
+
+    # file_id, который Telegram больше не принимает
+    def forget(self, digest: str) -> None:
+        with self._db:
+            self._db.execute("DELETE FROM card_media WHERE digest = ?", (digest,))
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class CardMedia:
+    # upload загружает картинку при прогреве; без него file_id появляются
+    # только при первых показах
+    def __init__(
+        self,
+        store: MediaStore,
+        base_dir: str,
+        upload: Optional[UploadFunc] = None,
+        concurrency: int = 4,
+    ):
+        self.store = store
+        self.base_dir = base_dir
+        self.upload = upload
+        self.concurrency = max(1, concurrency)
+        # путь -> (размер, mtime_ns, хэш)
+        self._stats: Dict[str, Tuple[int, int, str]] = {}
+        # путь -> хэш последнего просмотренного содержимого
+        self._digests: Dict[str, str] = {}
+        # хэш -> file_id
+        self._file_ids: Dict[str, str] = {}
+        # хэш -> загрузка в процессе прогрева
+        self._uploads: Dict[str, asyncio.Future] = {}
+        self._tasks: List[asyncio.Task] = []
+        # Один поток: соединение с SQLite используется последовательно
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media")
+        self._lock_file = None
+        self.warmed = 0
+
+    async def _io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def path_for(self, card) -> Optional[str]:
+        if not card.image:
+            return None
+        return os.path.normpath(os.path.join(self.base_dir, card.image))
+
+    def _digest(self, path: str) -> Optional[str]:
+        try:
+            stat = os.stat(path)
+            cached = self._stats.get(path)
+            if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+                return cached[2]
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except OSError as exc:
+            logger.warning("Картинка карты недоступна: %s", exc)
+            return None
+        self._stats[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    # Хэши картинок снимка; выполняется в потоке
+    def _scan(self, cards: Iterable) -> Dict[str, str]:
+        digests = {}
+        for card in cards:
+            path = self.path_for(card)
+            if path is not None and path not in digests:
+                digest = self._digest(path)
+                if digest is not None:
+                    digests[path] = digest
+        return digests
+
+    async def prepare(self, catalog) -> Dict[str, str]:
+        loop = asyncio.get_running_loop()
+        digests = await loop.run_in_executor(None, self._scan, catalog.cards)
+        self._digests.update(digests)
+        return digests
+
+    # Картинка карты; None, если её нет или хэш ещё не посчитан
+    def image(self, card) -> Optional[CardImage]:
+        path = self.path_for(card)
+        if path is None:
+            return None
+        digest = self._digests.get(path)
+        return CardImage(path, digest) if digest is not None else None
+
+    # file_id из памяти, иначе из базы: его мог сохранить другой процесс
+    async def file_id(self, card, image: CardImage) -> Optional[str]:
+        file_id = self._file_ids.get(image.digest)
+        if file_id is None:
+            file_id = await self._io(self.store.get, card.id, image.digest)
+            if file_id is not None:
+                self._file_ids[image.digest] = file_id
+        return file_id
+
+    # file_id, если картинку как раз загружает прогрев
+    async def wait_upload(self, image: CardImage) -> Optional[str]:
+        upload = self._uploads.get(image.digest)
+        if upload is None:
+            return None
+        return await asyncio.shield(upload)
+
+    async def remember(self, card, image: CardImage, file_id: str) -> None:
+        if self._file_ids.get(image.digest) == file_id:
+            return
+        self._file_ids[image.digest] = file_id
+        await self._io(self.store.put, card.id, image.digest, file_id)
+
+    async def forget(self, image: CardImage) -> None:
+        self._file_ids.pop(image.digest, None)
+        await self._io(self.store.forget, image.digest)
+
+    async def read(self, image: CardImage) -> bytes:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _read_file, image.path)
+
+    def _acquire(self) -> bool:
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.store.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    # Хэши картинок снимка и, если задан upload, прогрев в фоне
+    def start(self, catalog) -> None:
+        self._tasks = [task for task in self._tasks if not task.done()]
+        self._tasks.append(asyncio.get_running_loop().create_task(self._warm(catalog)))
+
+    async def _warm(self, catalog) -> None:
+        await self.prepare(catalog)
+        if self.upload is None or not self._acquire():
+            return
+        pending: Dict[str, Tuple[object, CardImage]] = {}
+        for card in catalog.cards:
+            image = self.image(card)
+            if image is None or image.digest in pending or image.digest in self._uploads:
+                continue
+            if await self.file_id(card, image) is None:
+                pending[image.digest] = (card, image)
+        if not pending:
+            return
+
+        started = time.perf_counter()
+        warmed = self.warmed
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in pending.values():
+            queue.put_nowait(item)
+        workers = [asyncio.create_task(self._upload_worker(queue)) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        logger.info(
+            "Прогрев картинок карт: загружено %s из %s за %.1f с",
+            self.warmed - warmed, len(pending), time.perf_counter() - started,
+        )
+
+    async def _upload_worker(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while not queue.empty():
+            card, image = queue.get_nowait()
+            future = loop.create_future()
+            self._uploads[image.digest] = future
+            file_id = None
+            try:
+                content = await self.read(image)
+                while file_id is None:
+                    try:
+                        file_id = await self.upload(content, os.path.basename(image.path))
+                    except RetryAfter as exc:
+                        retry_after = exc.retry_after
+                        await asyncio.sleep(
+                            retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                        )
+                await self.remember(card, image, file_id)
+                self.warmed += 1
+            except (OSError, TelegramError) as exc:
+                logger.warning("Картинка %s не загружена: %s", image.path, exc)
+            finally:
+                self._uploads.pop(image.digest, None)
+                future.set_result(file_id)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Дожидаемся начатых запросов: после остановки базу закрывают
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
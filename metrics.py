@@ -0,0 +1,248 @@
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from http import HTTPStatus
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+from webserver import Request, Response
+
+# Метрики в текстовом формате Prometheus без внешних зависимостей.
+# Запись значения — несколько операций со словарём и списком, без
+# блокировок: всё обновляется из одного цикла событий. Тяжёлые значения
+# (число диалогов по состояниям и т.п.) считаются только при запросе /metrics.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы корзин по умолчанию, секунды
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self) -> Iterable[str]:
+        for values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}"
+
+
+class Gauge:
+    kind = "gauge"
+
+    # collect, если задан, вызывается при каждом запросе /metrics и
+    # возвращает значения по наборам меток
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], Mapping[LabelValues, float]]] = None,
+    ):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._collect = collect
+
+    def set(self, value: float, *label_values: str) -> None:
+        self._values[label_values] = value
+
+    def collect(self) -> Iterable[str]:
+        values = self._collect() if self._collect is not None else self._values
+        for label_values, value in values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Метки -> [счётчики корзин..., +Inf, сумма]
+        self._series: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self) -> Iterable[str]:
+        for values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                labels = _format_labels(self.labels, values, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, values)
+            yield f"{self.name}_sum{labels} {_format_value(series[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Sequence[str] = (), collect=None) -> Gauge:
+        return self._register(Gauge(name, help_text, labels, collect))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    "refbot_handler_seconds", "Время выполнения обработчиков обновлений", ("handler",)
+)
+handler_errors = registry.counter(
+    "refbot_handler_errors_total", "Исключения в обработчиках обновлений", ("handler",)
+)
+api_seconds = registry.histogram(
+    "refbot_api_request_seconds", "Время запросов к Bot API", ("method",)
+)
+api_errors = registry.counter(
+    "refbot_api_errors_total", "Ошибки запросов к Bot API: HTTP-статус или сетевая ошибка", ("method", "reason")
+)
+loop_lag_seconds = registry.histogram(
+    "refbot_event_loop_lag_seconds", "Запаздывание цикла событий относительно ожидаемого пробуждения",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+loop_lag_last = registry.gauge(
+    "refbot_event_loop_lag_last_seconds", "Последнее измеренное запаздывание цикла событий"
+)
+
+
+# Замер времени асинхронного обработчика под именем функции
+def timed(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+
+# Обёртка HTTP-клиента Bot API: время и ошибки по методам
+class InstrumentedRequest(BaseRequest):
+    def __init__(self, wrapped: BaseRequest):
+        self.wrapped = wrapped
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.wrapped.read_timeout
+
+    async def initialize(self) -> None:
+        await self.wrapped.initialize()
+
+    async def shutdown(self) -> None:
+        await self.wrapped.shutdown()
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self.wrapped.do_request(
+                url,
+                method,
+                request_data=request_data,
+                read_timeout=read_timeout,
+                write_timeout=write_timeout,
+                connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout,
+            )
+        except Exception as exc:
+            api_errors.inc(api_method, type(exc).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, api_method)
+        if status >= 400:
+            api_errors.inc(api_method, str(status))
+        return status, payload
+
+
+# Замер запаздывания цикла событий: насколько позже ожидаемого
+# просыпается задача, спящая interval секунд
+async def watch_event_loop(interval: float = 0.5) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        loop_lag_seconds.observe(lag)
+        loop_lag_last.set(lag)
+
+
+def make_metrics_handler(target: Registry = registry):
+    async def handle_metrics(request: Request) -> Response:
+        return Response(HTTPStatus.OK, target.render().encode("utf-8"), CONTENT_TYPE)
+
+    return handle_metrics
@@ -0,0 +1,462 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, CallbackContext, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# Постоянное хранилище user_data и состояний ConversationHandler.
+# Записи копятся в памяти и сбрасываются на диск пачкой раз в
+# flush_interval секунд (повторные изменения одного пользователя
+# схлопываются), user_data загружается лениво в потоке хранилища до вызова
+# обработчика, а простаивающие сессии вытесняются из памяти по LRU.
+
+ConversationKey = Tuple[int, ...]
+
+
+class SqliteBackend:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "name TEXT NOT NULL, key TEXT NOT NULL, state INTEGER NOT NULL, "
+            "PRIMARY KEY (name, key))"
+        )
+        self._db.commit()
+
+    def load_user(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_conversations(self, name: str) -> Dict[ConversationKey, object]:
+        with self._lock:
+            rows = self._db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    def write(self, users: Dict[int, Optional[str]], conversations: Dict[Tuple[str, str], object]) -> None:
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                [(user_id, data) for user_id, data in users.items() if data is not None],
+            )
+            self._db.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in users.items() if data is None],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None],
+            )
+            self._db.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None],
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# Журнал только на дозапись: одна JSON-строка на изменение.
+# При открытии файл читается один раз и строится индекс user_id -> смещение
+# последней записи; сами user_data читаются с диска лениво.
+class AppendOnlyBackend:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a+b")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            raise RuntimeError(f"Журнал {path} уже открыт другим процессом, используйте sqlite")
+        self._offsets: Dict[int, int] = {}
+        self._conversations: Dict[str, Dict[ConversationKey, object]] = {}
+        self._records = 0
+        self._scan()
+        if self._records > 2 * (len(self._offsets) + sum(map(len, self._conversations.values()))) + 1000:
+            self._compact()
+
+    def _scan(self) -> None:
+        self._file.seek(0)
+        offset = 0
+        unterminated = False
+        for line in self._file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Недописанная последняя строка после аварийного завершения
+                break
+            self._apply(record, offset)
+            offset += len(line)
+            unterminated = not line.endswith(b"\n")
+        self._file.truncate(offset)
+        # Последняя запись целая, но без перевода строки: без него следующая
+        # запись склеилась бы с ней в одну строку
+        if unterminated:
+            self._file.write(b"\n")
+            self._file.flush()
+
+    def _apply(self, record: dict, offset: int) -> None:
+        self._records += 1
+        if "u" in record:
+            if record["d"] is None:
+                self._offsets.pop(record["u"], None)
+            else:
+                self._offsets[record["u"]] = offset
+        else:
+            states = self._conversations.setdefault(record["c"], {})
+            key = tuple(record["k"])
+            if record["s"] is None:
+                states.pop(key, None)
+            else:
+                states[key] = record["s"]
+
+    def _compact(self) -> None:
+        tmp_path = self.path + ".compact"
+        with open(tmp_path, "wb") as tmp:
+            for user_id in self._offsets:
+                tmp.write(self._encode({"u": user_id, "d": self._read_user(user_id)}))
+            for name, states in self._conversations.items():
+                for key, state in states.items():
+                    tmp.write(self._encode({"c": name, "k": list(key), "s": state}))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_path, self.path)
+        old = self._file
+        self._file = open(self.path, "a+b")
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        old.close()
+        self._offsets.clear()
+        self._conversations.clear()
+        self._records = 0
+        self._scan()
+
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        return json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+
+    def _read_user(self, user_id: int) -> Optional[dict]:
+        offset = self._offsets.get(user_id)
+        if offset is None:
+            return None
+        self._file.seek(offset)
+        return json.loads(self._file.readline())["d"]
+
+    def load_user(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            return self._read_user(user_id)
+
+    def load_conversations(self, name: str) -> Dict[ConversationKey, object]:
+        with self._lock:
+            return dict(self._conversations.get(name, {}))
+
+    def write(self, users: Dict[int, Optional[str]], conversations: Dict[Tuple[str, str], object]) -> None:
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            chunks = []
+            for user_id, data in users.items():
+                chunk = b'{"u": %d, "d": %s}\n' % (user_id, (data or "null").encode("utf-8"))
+                self._apply({"u": user_id, "d": data}, offset)
+                chunks.append(chunk)
+                offset += len(chunk)
+            for (name, key), state in conversations.items():
+                record = {"c": name, "k": json.loads(key), "s": state}
+                chunk = self._encode(record)
+                self._apply(record, offset)
+                chunks.append(chunk)
+                offset += len(chunk)
+            self._file.write(b"".join(chunks))
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+# user_data, сообщающий хранилищу о каждом изменении
+class SessionDict(dict):
+    __slots__ = ("_store", "_user_id", "__weakref__")
+
+    def __init__(self, store: "SessionStore", user_id: int, data: Optional[dict] = None):
+        super().__init__(data or ())
+        self._store = store
+        self._user_id = user_id
+
+    def _touch(self) -> None:
+        # После drop_user сессия отвязана от хранилища
+        if self._store is not None:
+            self._store.mark_dirty(self._user_id, self)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._touch()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._touch()
+
+    def pop(self, *args):
+        result = super().pop(*args)
+        self._touch()
+        return result
+
+    def popitem(self):
+        result = super().popitem()
+        self._touch()
+        return result
+
+    def setdefault(self, key, default=None):
+        result = super().setdefault(key, default)
+        self._touch()
+        return result
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._touch()
+
+    def clear(self):
+        super().clear()
+        self._touch()
+
+
+class SessionStore:
+    def __init__(self, backend, flush_interval: float = 5.0, max_sessions: int = 10000):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[int, SessionDict]" = OrderedDict()
+        # Вытесненные сессии, на которые ещё ссылаются обработчики: при
+        # следующем обращении или изменении возвращаются те же объекты
+        self._evicted: "weakref.WeakValueDictionary[int, SessionDict]" = weakref.WeakValueDictionary()
+        self._dirty_users = set()
+        # Снимки, ожидающие записи: вытесненные сессии и удалённые пользователи
+        self._pending_users: Dict[int, Optional[str]] = {}
+        self._pending_conversations: Dict[Tuple[str, str], object] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    # Сессия без чтения с диска, если она в памяти или ждёт записи
+    def _cached(self, user_id: int) -> Optional[SessionDict]:
+        session = self._sessions.get(user_id)
+        if session is not None:
+            self._sessions.move_to_end(user_id)
+            return session
+        session = self._evicted.pop(user_id, None)
+        if session is None and user_id in self._pending_users:
+            pending = self._pending_users[user_id]
+            session = SessionDict(self, user_id, json.loads(pending) if pending is not None else None)
+        if session is not None:
+            self._insert(user_id, session)
+        return session
+
+    def _insert(self, user_id: int, session: SessionDict) -> None:
+        self._sessions[user_id] = session
+        if len(self._sessions) > self.max_sessions:
+            self._evict()
+
+    # Загрузка user_data в потоке хранилища; вызывается до обработчика
+    # (SessionContext.refresh_data), чтобы user_data не читал диск в цикле
+    # событий. Поток тот же, что у записи, поэтому начатый сброс сессии
+    # завершается раньше её чтения.
+    async def load(self, user_id: int) -> None:
+        if self._cached(user_id) is not None:
+            return
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self._executor, self.backend.load_user, user_id)
+        if self._cached(user_id) is None:
+            self._insert(user_id, SessionDict(self, user_id, data))
+
+    def user_data(self, user_id: int) -> SessionDict:
+        session = self._cached(user_id)
+        if session is None:
+            # Обращение без load(), например из задачи JobQueue
+            session = SessionDict(self, user_id, self.backend.load_user(user_id))
+            self._insert(user_id, session)
+        return session
+
+    def _evict(self) -> None:
+        while len(self._sessions) > self.max_sessions:
+            user_id, session = self._sessions.popitem(last=False)
+            if user_id in self._dirty_users:
+                self._dirty_users.discard(user_id)
+                self._pending_users[user_id] = json.dumps(session, ensure_ascii=False)
+            self._evicted[user_id] = session
+
+    def mark_dirty(self, user_id: int, session: SessionDict) -> None:
+        if self._sessions.get(user_id) is not session:
+            # Изменение уже вытесненной сессии: она снова в памяти, и
+            # изменение попадёт в следующий сброс
+            self._evicted.pop(user_id, None)
+            self._insert(user_id, session)
+        self._dirty_users.add(user_id)
+
+    def drop_user(self, user_id: int) -> None:
+        for session in (self._sessions.pop(user_id, None), self._evicted.pop(user_id, None)):
+            if session is not None:
+                session._store = None
+        self._dirty_users.discard(user_id)
+        self._pending_users[user_id] = None
+
+    def set_conversation(self, name: str, key: ConversationKey, state: object) -> None:
+        self._pending_conversations[(name, json.dumps(list(key)))] = state
+
+    @property
+    def pending_writes(self) -> int:
+        return len(self._dirty_users) + len(self._pending_users) + len(self._pending_conversations)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            users = self._pending_users
+            for user_id in self._dirty_users:
+                session = self._sessions.get(user_id)
+                if session is not None:
+                    users[user_id] = json.dumps(session, ensure_ascii=False)
+            conversations = self._pending_conversations
+            self._dirty_users = set()
+            self._pending_users = {}
+            self._pending_conversations = {}
+            if not users and not conversations:
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self._executor, self.backend.write, users, conversations)
+            except Exception:
+                logger.exception("Не удалось сохранить сессии, повтор при следующем сбросе")
+                # Более новые изменения, накопленные за время записи, приоритетнее
+                for user_id, data in users.items():
+                    if user_id not in self._dirty_users:
+                        self._pending_users.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._pending_conversations.setdefault(key, state)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        self.backend.close()
+
+
+# Адаптер к BasePersistence: PTB хранит в нём состояния диалогов,
+# а user_data отдаёт SessionContext напрямую из SessionStore
+class StorePersistence(BasePersistence):
+    def __init__(self, store: SessionStore):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=store.flush_interval,
+        )
+        self.store = store
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        self.store.start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.store.backend.load_conversations, name)
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        self.store.set_conversation(name, key, new_state)
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.store.drop_user(user_id)
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self.store.close()
+
+
+class SessionContext(CallbackContext):
+    # Сессии в памяти (sessions.SessionCache) для режима без постоянного
+    # хранилища; задаётся в подклассе
+    memory_sessions = None
+
+    async def refresh_data(self) -> None:
+        persistence = self.application.persistence
+        if isinstance(persistence, StorePersistence) and self._user_id is not None:
+            await persistence.store.load(self._user_id)
+        await super().refresh_data()
+
+    @property
+    def user_data(self):
+        if self._user_id is None:
+            return super().user_data
+        persistence = self.application.persistence
+        if isinstance(persistence, StorePersistence):
+            return persistence.store.user_data(self._user_id)
+        if self.memory_sessions is not None:
+            return self.memory_sessions.get(self._user_id, self._chat_id)
+        return super().user_data
+
+
+# Создание хранилища по строке вида "sqlite:sessions.db" или "aof:sessions.log"
+def create_persistence(url: str, flush_interval: float, max_sessions: int) -> StorePersistence:
+    kind, _, path = url.partition(":")
+    if kind == "sqlite":
+        backend = SqliteBackend(path or "sessions.db")
+    elif kind == "aof":
+        backend = AppendOnlyBackend(path or "sessions.log")
+    else:
+        raise ValueError(f"Неизвестное хранилище сессий: {url!r}")
+    return StorePersistence(SessionStore(backend, flush_interval, max_sessions))
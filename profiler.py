@@ -0,0 +1,197 @@
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http import HTTPStatus
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from telegram.ext import ConversationHandler
+
+from webserver import Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Поиск медленных обновлений.
+# Время обработки меряется у каждого обновления диалога. Для доли
+# sample_rate обновлений во время обработки работает сэмплирующий профайлер:
+# отдельный поток раз в interval секунд снимает стек потока цикла событий.
+# Обновление дольше threshold попадает в кольцевой буфер вместе с исходным
+# JSON, переходом состояния и стеками, снятыми за время его обработки.
+
+# Заголовок с токеном доступа к буферу медленных обновлений
+DEBUG_TOKEN_HEADER = "x-debug-token"
+
+MAX_STACK_DEPTH = 64
+# Сколько самых частых стеков хранить в записи о медленном обновлении
+PROFILE_TOP = 30
+
+
+def _fold_stack(frame) -> str:
+    names: List[str] = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005, max_samples: int = 20000):
+        self.interval = interval
+        # (время снятия, свёрнутый стек) за последние max_samples снимков
+        self.samples: Deque[Tuple[float, str]] = deque(maxlen=max_samples)
+        self._active = 0
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._target: Optional[int] = None
+
+    # Запускается из потока, стек которого нужно снимать
+    def start(self) -> None:
+        self._target = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def acquire(self) -> None:
+        self._active += 1
+        self._wake.set()
+
+    def release(self) -> None:
+        self._active -= 1
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            if self._active <= 0:
+                # Пока нет обновлений под профайлером, поток спит; повторная
+                # проверка после clear() не даёт пропустить acquire()
+                self._wake.clear()
+                if self._active <= 0:
+                    self._wake.wait()
+                continue
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self.samples.append((time.perf_counter(), _fold_stack(frame)))
+            del frame
+            time.sleep(self.interval)
+
+    def profile(self, started: float, finished: float) -> List[Dict[str, Any]]:
+        counts = Counter(stack for at, stack in list(self.samples) if started <= at <= finished)
+        return [{"stack": stack, "samples": count} for stack, count in counts.most_common(PROFILE_TOP)]
+
+
+class SlowUpdateRecorder:
+    def __init__(
+        self,
+        threshold: float,
+        sample_rate: float = 0.05,
+        capacity: int = 50,
+        interval: float = 0.005,
+        state_names: Tuple[str, ...] = (),
+    ):
+        self.threshold = threshold
+        self.state_names = state_names
+        self.sample_rate = sample_rate
+        self.records: Deque[Dict[str, Any]] = deque(maxlen=capacity)
+        self.sampler = StackSampler(interval)
+        self.updates = 0
+        self.sampled = 0
+        self.slow = 0
+
+    def start(self) -> None:
+        if self.sample_rate > 0:
+            self.sampler.start()
+
+    def stop(self) -> None:
+        if self.sample_rate > 0:
+            self.sampler.stop()
+
+    def begin(self) -> bool:
+        self.updates += 1
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            self.sampled += 1
+            self.sampler.acquire()
+            return True
+        return False
+
+    def _state_name(self, state) -> Optional[str]:
+        if isinstance(state, int) and 0 <= state < len(self.state_names):
+            return self.state_names[state]
+        return None if state is None else str(state)
+
+    def end(self, sampled: bool, update, state_before, state_after, started: float, finished: float) -> None:
+        if sampled:
+            self.sampler.release()
+        elapsed = finished - started
+        if elapsed < self.threshold:
+            return
+        self.slow += 1
+        self.records.append({
+            "received_at": time.time() - (time.perf_counter() - started),
+            "seconds": elapsed,
+            "state_before": self._state_name(state_before),
+            "state_after": self._state_name(state_after),
+            "sampled": sampled,
+            "update": update.to_dict(),
+            "profile": self.sampler.profile(started, finished) if sampled else None,
+        })
+        logger.warning(
+            "Медленное обновление %s: %.3f с (%s → %s)",
+            update.update_id, elapsed, self._state_name(state_before), self._state_name(state_after),
+        )
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            "threshold_seconds": self.threshold,
+            "sample_rate": self.sample_rate,
+            "updates": self.updates,
+            "sampled": self.sampled,
+            "slow": self.slow,
+            "records": list(self.records),
+        }
+
+
+# ConversationHandler с замером каждого обновления
+class ProfiledConversationHandler(ConversationHandler):
+    def __init__(self, *args, recorder: SlowUpdateRecorder, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorder = recorder
+
+    async def handle_update(self, update, application, check_result, context):
+        state_before, key = check_result[0], check_result[1]
+        recorder = self.recorder
+        sampled = recorder.begin()
+        started = time.perf_counter()
+        try:
+            return await super().handle_update(update, application, check_result, context)
+        finally:
+            recorder.end(sampled, update, state_before, self._conversations.get(key), started, time.perf_counter())
+
+
+# В буфере исходные обновления с данными пользователей: отдаётся только
+# по токену в заголовке X-Debug-Token
+def make_dump_handler(recorder: SlowUpdateRecorder, token: str):
+    expected = token.encode("utf-8")
+
+    async def handle_dump(request: Request) -> Response:
+        received = request.headers.get(DEBUG_TOKEN_HEADER, "").encode("utf-8")
+        if not hmac.compare_digest(received, expected):
+            logger.warning("Отклонён запрос медленных обновлений с неверным токеном")
+            return Response(HTTPStatus.FORBIDDEN)
+        body = json.dumps(recorder.dump(), ensure_ascii=False, indent=1, default=str)
+        return Response(HTTPStatus.OK, body.encode("utf-8"), "application/json")
+
+    return handle_dump
@@ -0,0 +1,319 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Set, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Планировщик исходящих запросов к Bot API.
+# Глобальный и по-чатовые token bucket'ы, пауза всего
+# трафика по retry_after, отбрасывание повторных answerCallbackQuery и
+# слияние подряд идущих правок одного сообщения: пока правка ждёт своей
+# очереди, более новая правка того же сообщения её заменяет.
+# Фоновые запросы (рассылки) помечаются rate_limit_args=BACKGROUND и берут
+# токен глобального bucket'а, только если после этого в нём остаётся
+# резерв для интерактивного трафика. Поэтому ответы на кнопки и правки
+# получают свою скорость первыми, а рассылка — остаток лимита.
+
+JSONResult = Union[bool, Dict[str, Any], List[Dict[str, Any]]]
+
+# Значение rate_limit_args для фоновых запросов: bot.send_message(..., rate_limit_args=BACKGROUND)
+BACKGROUND = "background"
+
+# Запущенные планировщики процесса, их статистика отдаётся в /metrics
+_active: Set["OutboundScheduler"] = set()
+
+# Счётчики статистики, которые отдаются как refbot_scheduler_events{event}
+_EVENT_STATS = (
+    "requests", "background_requests", "waited", "answers_deduplicated", "edits_merged", "retry_after_events",
+)
+
+
+def _collect_events():
+    return {(name,): sum(getattr(scheduler.stats, name) for scheduler in _active) for name in _EVENT_STATS}
+
+
+wait_seconds = metrics.registry.histogram(
+    "refbot_scheduler_wait_seconds", "Ожидание слота в планировщике исходящих запросов", ("lane",)
+)
+metrics.registry.gauge(
+    "refbot_scheduler_events", "События планировщика исходящих запросов с запуска процесса", ("event",),
+    collect=_collect_events,
+)
+metrics.registry.gauge(
+    "refbot_scheduler_queue_depth", "Запросы, ожидающие слота в планировщике",
+    collect=lambda: {(): sum(scheduler.stats.queue_depth for scheduler in _active)},
+)
+metrics.registry.gauge(
+    "refbot_scheduler_max_queue_depth", "Наибольшая очередь ожидающих слота запросов с запуска процесса",
+    collect=lambda: {(): max((scheduler.stats.max_queue_depth for scheduler in _active), default=0)},
+)
+
+_EDIT_ENDPOINTS = frozenset((
+    "editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup",
+))
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько ждать до появления токена сверх reserve (без его списания)
+    def wait_time(self, now: float, reserve: float = 0.0) -> float:
+        self._refill(now)
+        needed = 1 + reserve
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _PendingEdit:
+    __slots__ = ("call", "futures")
+
+    def __init__(self, call):
+        self.call = call
+        # Ожидания вызовов, чьи правки заменены этой
+        self.futures: List[asyncio.Future] = []
+
+
+class SchedulerStats:
+    __slots__ = (
+        "requests", "queue_depth", "max_queue_depth", "waited", "wait_seconds", "max_wait_seconds",
+        "answers_deduplicated", "edits_merged", "retry_after_events", "background_requests",
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.answers_deduplicated = 0
+        self.edits_merged = 0
+        self.retry_after_events = 0
+        self.background_requests = 0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# interactive_reserve — доля глобального bucket'а, которую фоновые запросы
+# не занимают
+class OutboundScheduler(BaseRateLimiter[Union[int, str]]):
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        global_burst: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        group_rate: float = 20 / 60,
+        group_burst: float = 3.0,
+        max_retries: int = 3,
+        max_tracked: int = 10000,
+        interactive_reserve: float = 0.5,
+    ):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_tracked = max_tracked
+        # Резерв в токенах; хотя бы один токен bucket'а доступен фоновым запросам
+        self.background_reserve = max(0.0, min(global_burst - 1, global_burst * interactive_reserve))
+        self.stats = SchedulerStats()
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._paused_until = 0.0
+        self._answered: "OrderedDict[str, None]" = OrderedDict()
+        self._edits: Dict[Tuple, _PendingEdit] = {}
+
+    async def initialize(self) -> None:
+        self._global = TokenBucket(self.global_rate, self.global_burst, asyncio.get_running_loop().time())
+        _active.add(self)
+
+    async def shutdown(self) -> None:
+        _active.discard(self)
+        logger.info("Статистика исходящих запросов: %s", self.stats.as_dict())
+        self._chats.clear()
+        self._answered.clear()
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_tracked:
+                # Полные bucket'ы эквивалентны новым, их можно забыть
+                for key in [key for key, b in self._chats.items() if b.full(now)]:
+                    del self._chats[key]
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.group_rate if is_group else self.chat_rate,
+                self.group_burst if is_group else self.chat_burst,
+                now,
+            )
+        return bucket
+
+    # Ожидание свободного слота в глобальном и чатовом bucket'ах
+    async def _acquire(self, chat_id, background: bool = False) -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        stats = self.stats
+        stats.queue_depth += 1
+        stats.max_queue_depth = max(stats.max_queue_depth, stats.queue_depth)
+        slept = False
+        reserve = self.background_reserve if background else 0.0
+        try:
+            while True:
+                now = loop.time()
+                chat_bucket = self._chat_bucket(chat_id, now) if chat_id is not None else None
+                wait = max(
+                    self._paused_until - now,
+                    self._global.wait_time(now, reserve),
+                    chat_bucket.wait_time(now) if chat_bucket is not None else 0.0,
+                )
+                if wait <= 0:
+                    self._global.take()
+                    if chat_bucket is not None:
+                        chat_bucket.take()
+                    break
+                await asyncio.sleep(wait)
+                slept = True
+        finally:
+            stats.queue_depth -= 1
+        waited = loop.time() - started if slept else 0.0
+        wait_seconds.observe(waited, "background" if background else "interactive")
+        if slept:
+            stats.waited += 1
+            stats.wait_seconds += waited
+            stats.max_wait_seconds = max(stats.max_wait_seconds, waited)
+
+    async def _send(self, callback, args, kwargs, chat_id, max_retries: int, background: bool = False) -> JSONResult:
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, background)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                self._pause(exc)
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                logger.warning("Flood control: пауза %.1f с (попытка %s)", self._retry_seconds(exc), attempt)
+
+    @staticmethod
+    def _retry_seconds(exc: RetryAfter) -> float:
+        retry_after = exc.retry_after
+        if isinstance(retry_after, timedelta):
+            return retry_after.total_seconds()
+        return float(retry_after)
+
+    # retry_after приостанавливает весь исходящий трафик
+    def _pause(self, exc: RetryAfter) -> None:
+        self.stats.retry_after_events += 1
+        resume_at = asyncio.get_running_loop().time() + self._retry_seconds(exc)
+        self._paused_until = max(self._paused_until, resume_at)
+
+    async def _edit(self, key, callback, args, kwargs, chat_id, max_retries: int) -> JSONResult:
+        call = (callback, args, kwargs)
+        pending = self._edits.get(key)
+        if pending is not None:
+            # Предыдущая правка ещё не отправлена: отправится только эта
+            future = asyncio.get_running_loop().create_future()
+            pending.call = call
+            pending.futures.append(future)
+            self.stats.edits_merged += 1
+            return await future
+
+        pending = self._edits[key] = _PendingEdit(call)
+        try:
+            await self._acquire(chat_id)
+        except BaseException as exc:
+            del self._edits[key]
+            self._settle(pending.futures, exception=exc)
+            raise
+        del self._edits[key]
+        callback, args, kwargs = pending.call
+        # Слот уже получен, повторы по retry_after идут через _send
+        try:
+            result = await callback(*args, **kwargs)
+        except RetryAfter as exc:
+            self._pause(exc)
+            try:
+                result = await self._send(callback, args, kwargs, chat_id, max_retries)
+            except BaseException as exc:
+                self._settle(pending.futures, exception=exc)
+                raise
+        except BaseException as exc:
+            self._settle(pending.futures, exception=exc)
+            raise
+        self._settle(pending.futures, result=result)
+        return result
+
+    @staticmethod
+    def _settle(futures, result=None, exception=None) -> None:
+        for future in futures:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, JSONResult]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Union[int, str]],
+    ) -> JSONResult:
+        self.stats.requests += 1
+        background = rate_limit_args == BACKGROUND
+        max_retries = self.max_retries if rate_limit_args is None or background else rate_limit_args
+
+        if endpoint == "answerCallbackQuery":
+            query_id = data.get("callback_query_id")
+            if query_id in self._answered:
+                self.stats.answers_deduplicated += 1
+                return True
+            self._answered[query_id] = None
+            if len(self._answered) > self.max_tracked:
+                self._answered.popitem(last=False)
+            try:
+                return await self._send(callback, args, kwargs, None, max_retries)
+            except BaseException:
+                self._answered.pop(query_id, None)
+                raise
+
+        chat_id = data.get("chat_id")
+        if background:
+            self.stats.background_requests += 1
+            return await self._send(callback, args, kwargs, chat_id, max_retries, background=True)
+        if endpoint in _EDIT_ENDPOINTS:
+            key = (endpoint, chat_id, data.get("message_id"), data.get("inline_message_id"))
+            return await self._edit(key, callback, args, kwargs, chat_id, max_retries)
+
+        return await self._send(callback, args, kwargs, chat_id, max_retries)
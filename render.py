@@ -0,0 +1,398 @@
+import collections.abc
+import hashlib
+import html
+import re
+from types import MappingProxyType
+from typing import Callable, Dict, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from attributes import ATTRIBUTES, CardTable, format_value
+from catalog import AgeView, age_bracket
+from callback_codec import CatalogIds
+
+# Слой предварительного рендеринга экранов.
+# Все пары (текст, клавиатура) строятся один раз при загрузке каталога,
+# обработчики лишь достают готовый экран по ключу.
+
+WELCOME_TEXT = "👋 <b>Добро пожаловать!</b>\n\nПожалуйста, выберите вашу возрастную категорию:"
+MAIN_MENU_TEXT = "🏠 <b>Вы вернулись в главное меню!</b>"
+BANK_SELECTION_TEXT = "🏦 <b>Выберите банк:</b>"
+NO_CARDS_TEXT = "😔 <b>Для вашей возрастной категории пока нет доступных карт.</b>"
+CARD_TYPE_SELECTION_TEXT = "💳 <b>Выберите тип карты:</b>"
+
+# Запас до лимита Telegram в 4096 символов на заголовок страницы
+ALL_CARDS_PAGE_BUDGET = 3900
+ALL_CARDS_PAGE_PREFIX = "all_cards:"
+TOP_CARDS_TEXT = "🏆 <b>Лучшие карты</b>\n\nПо какому условию сравнить карты?"
+TOP_CARDS_PREFIX = "top:"
+# Сколько карт показывать в рейтинге
+TOP_CARDS_LIMIT = 10
+_TAG_RE = re.compile(r"<[^>]*>")
+
+
+class Screen(NamedTuple):
+    text: str
+    reply_markup: InlineKeyboardMarkup
+    # Отпечаток содержимого: одинаковые экраны из разных снимков совпадают
+    fingerprint: int
+
+
+def fingerprint(text: str, reply_markup: InlineKeyboardMarkup) -> int:
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8)
+    for row in reply_markup.inline_keyboard:
+        for button in row:
+            digest.update(b"\x00" + button.text.encode("utf-8") + b"\x01" + (button.callback_data or "").encode("utf-8"))
+        digest.update(b"\x02")
+    return int.from_bytes(digest.digest(), "big")
+
+
+def make_screen(text: str, reply_markup: InlineKeyboardMarkup) -> Screen:
+    return Screen(text, reply_markup, fingerprint(text, reply_markup))
+
+
+# Экраны одной возрастной категории: скрыты банки и типы без подходящих карт
+class AgeScreens(NamedTuple):
+    bank_selection: Screen
+    # страницы списка всех карт
+    all_cards: Tuple[Screen, ...]
+    # меню рейтингов; None, если сравнивать нечего
+    top_menu: Optional[Screen]
+    # ключ характеристики -> рейтинг карт
+    top: Mapping[str, Screen]
+    # bank -> экран выбора типа карты
+    card_types: Mapping[str, Screen]
+    # (bank, card_type) -> экран списка карт
+    card_lists: Mapping[Tuple[str, str], Screen]
+    # (bank, card_type, card) -> страница карты
+    cards: Mapping[Tuple[str, str, str], Screen]
+
+    def card_type(self, bank: str) -> Optional[Screen]:
+        return self.card_types.get(bank)
+
+    def card_list(self, bank: str, card_type: str) -> Optional[Screen]:
+        return self.card_lists.get((bank, card_type))
+
+    def card(self, bank: str, card_type: str, card: str) -> Optional[Screen]:
+        return self.cards.get((bank, card_type, card))
+
+    def all_cards_page(self, page: int) -> Screen:
+        return self.all_cards[min(max(page, 0), len(self.all_cards) - 1)]
+
+    def top_cards(self, key: str) -> Optional[Screen]:
+        return self.top.get(key)
+
+
+class Screens(NamedTuple):
+    welcome: Screen
+    main_menu: Screen
+    # возрастная категория -> экраны
+    by_age: Mapping[int, AgeScreens]
+
+    def for_age(self, age: int) -> AgeScreens:
+        return self.by_age[age_bracket(age)]
+
+
+# Вспомогательная функция для создания клавиатуры
+def build_keyboard(buttons) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        tuple((InlineKeyboardButton(text, callback_data=data),) for text, data in buttons)
+    )
+
+
+MAIN_MENU_BUTTON = ("🏠 Главное меню", "main_menu")
+AGE_BUTTONS = (
+    ("🎂 14-17 лет", "age_14_17"),
+    ("🎂 18+ лет", "age_18_plus"),
+)
+
+
+def escape(text: str) -> str:
+    return html.escape(text, quote=False)
+
+
+# Длина текста сообщения так, как её считает Telegram: без тегов, с
+# раскрытыми сущностями, в кодовых единицах UTF-16
+def visible_length(markup: str) -> int:
+    return len(html.unescape(_TAG_RE.sub("", markup)).encode("utf-16-le")) // 2
+
+
+def render_card_page(card, link: Optional[str] = None) -> str:
+    return "".join((
+        f"🏦 <b>{escape(card.bank)}</b> - <b>{escape(card.name)}</b>\n\n",
+        "🔥 <b>Преимущества:</b>\n",
+        "\n".join(f"• {escape(adv)}" for adv in card.advantages),
+        f"\n\n🔗 <a href='{html.escape(link or card.ref_link)}'>Ссылка на карту</a>",
+    ))
+
+
+# Разбиение списка всех карт на страницы не длиннее budget видимых символов.
+# Страница режется только между строками, поэтому теги и сущности не
+# разрываются; на новой странице заголовки банка и типа повторяются.
+def paginate_all_cards(view: AgeView, budget: int = ALL_CARDS_PAGE_BUDGET) -> List[str]:
+    pages: List[str] = []
+    parts: List[str] = []
+    size = 0
+    page_bank = page_type = None
+
+    for bank, types in view.banks.items():
+        bank_header = f"🏦 <b>{escape(bank)}</b>:\n"
+        for card_type, cards in types.items():
+            type_header = f"  <b>{escape(card_type)}:</b>\n"
+            for card in cards:
+                line = f"    • {escape(card.name)} ({card.age_limit}+)\n"
+                chunk = []
+                if page_bank != bank:
+                    chunk.append(bank_header)
+                if page_bank != bank or page_type != card_type:
+                    chunk.append(type_header)
+                chunk.append(line)
+                cost = sum(map(visible_length, chunk))
+
+                if parts and size + cost > budget:
+                    pages.append("".join(parts))
+                    parts, size = [], 0
+                    chunk = [bank_header, type_header, line]
+                    cost = sum(map(visible_length, chunk))
+
+                parts.extend(chunk)
+                size += cost
+                page_bank, page_type = bank, card_type
+
+    if parts:
+        pages.append("".join(parts))
+    return pages
+
+
+def build_all_cards_pages(view: AgeView) -> Tuple[Screen, ...]:
+    bodies = paginate_all_cards(view)
+    if not bodies:
+        return (make_screen(NO_CARDS_TEXT, build_keyboard([("🔙 Назад", "back_to_banks"), MAIN_MENU_BUTTON])),)
+
+    total = len(bodies)
+    screens = []
+    for index, body in enumerate(bodies):
+        if total == 1:
+            title = "📋 <b>Все доступные карты:</b>\n\n"
+        else:
+            title = f"📋 <b>Все доступные карты</b> ({index + 1}/{total}):\n\n"
+        pager = []
+        if index > 0:
+            pager.append(InlineKeyboardButton("◀️", callback_data=f"{ALL_CARDS_PAGE_PREFIX}{index - 1}"))
+        if index < total - 1:
+            pager.append(InlineKeyboardButton("▶️", callback_data=f"{ALL_CARDS_PAGE_PREFIX}{index + 1}"))
+        rows = ((tuple(pager),) if pager else ()) + tuple(
+            (InlineKeyboardButton(text, callback_data=data),)
+            for text, data in (("🔙 Назад", "back_to_banks"), MAIN_MENU_BUTTON)
+        )
+        screens.append(make_screen(title + body, InlineKeyboardMarkup(rows)))
+    return tuple(screens)
+
+
+# Рейтинги карт возрастной категории по каждой характеристике; в меню
+# попадают только характеристики, известные хотя бы у одной карты
+def build_top_screens(view: AgeView, ids: CatalogIds, table: CardTable) -> Tuple[Optional[Screen], Mapping[str, Screen]]:
+    top = {}
+    menu = []
+    back_keyboard = (("🔙 Назад", "show_top_cards"), MAIN_MENU_BUTTON)
+    for attribute in ATTRIBUTES:
+        cards = table.top(attribute, view.age, limit=TOP_CARDS_LIMIT)
+        if not cards:
+            continue
+        lines = [
+            f"{place}. <b>{escape(card.bank)}</b> — {escape(card.name)}: "
+            f"{escape(format_value(attribute, table.value(attribute, card.id)))}"
+            for place, card in enumerate(cards, 1)
+        ]
+        top[attribute.key] = make_screen(
+            f"🏆 <b>{escape(attribute.title)}</b>\n\n" + "\n".join(lines),
+            build_keyboard(
+                [(f"{place}. {card.name}", ids.encode_card(card.bank, card.card_type, card.name))
+                 for place, card in enumerate(cards, 1)]
+                + list(back_keyboard)
+            ),
+        )
+        menu.append((attribute.button, f"{TOP_CARDS_PREFIX}{attribute.key}"))
+    if not menu:
+        return None, MappingProxyType(top)
+    top_menu = make_screen(TOP_CARDS_TEXT, build_keyboard(menu + [("🔙 Назад", "back_to_banks"), MAIN_MENU_BUTTON]))
+    return top_menu, MappingProxyType(top)
+
+
+def build_age_screens(
+    view: AgeView,
+    ids: CatalogIds,
+    link_for: Optional[Callable] = None,
+    table: Optional[CardTable] = None,
+) -> AgeScreens:
+    card_types = {}
+    card_lists = {}
+    cards = {}
+
+    card_back_keyboard = build_keyboard([("⬅️ Назад", "back_to_cards"), MAIN_MENU_BUTTON])
+
+    for bank, types in view.banks.items():
+        card_types[bank] = make_screen(
+            CARD_TYPE_SELECTION_TEXT,
+            build_keyboard(
+                [(card_type, ids.encode_type(card_type)) for card_type in types]
+                + [("🔙 Назад", "back_to_banks"), MAIN_MENU_BUTTON]
+            ),
+        )
+        for card_type, type_cards in types.items():
+            card_lists[(bank, card_type)] = make_screen(
+                f"🏦 <b>{escape(bank)}</b>\n\nВыберите карту:",
+                build_keyboard(
+                    [(card.name, ids.encode_card(bank, card_type, card.name)) for card in type_cards]
+                    + [("🔙 Назад", "back_to_card_type"), MAIN_MENU_BUTTON]
+                ),
+            )
+            for card in type_cards:
+                cards[(bank, card_type, card.name)] = make_screen(
+                    render_card_page(card, link_for(card) if link_for else None), card_back_keyboard
+                )
+
+    if table is not None:
+        top_menu, top = build_top_screens(view, ids, table)
+    else:
+        top_menu, top = None, MappingProxyType({})
+
+    if view.banks:
+        bank_selection = make_screen(
+            BANK_SELECTION_TEXT,
+            build_keyboard(
+                [(bank, ids.encode_bank(bank)) for bank in view.banks]
+                + [("📋 Все карты", "show_all_cards")]
+                + ([("🏆 Лучшие карты", "show_top_cards")] if top_menu is not None else [])
+                + [MAIN_MENU_BUTTON]
+            ),
+        )
+    else:
+        bank_selection = make_screen(NO_CARDS_TEXT, build_keyboard([MAIN_MENU_BUTTON]))
+
+    return AgeScreens(
+        bank_selection=bank_selection,
+        all_cards=build_all_cards_pages(view),
+        top_menu=top_menu,
+        top=top,
+        card_types=MappingProxyType(card_types),
+        card_lists=MappingProxyType(card_lists),
+        cards=MappingProxyType(cards),
+    )
+
+
+# Построение всех экранов снимка каталога; link_for подменяет ссылку
+# на странице карты (например, короткой ссылкой)
+def build_screens(catalog, link_for: Optional[Callable] = None) -> Screens:
+    age_keyboard = build_keyboard(AGE_BUTTONS)
+    return Screens(
+        welcome=make_screen(WELCOME_TEXT, age_keyboard),
+        main_menu=make_screen(MAIN_MENU_TEXT, age_keyboard),
+        by_age=MappingProxyType({
+            age: build_age_screens(view, catalog.ids, link_for, catalog.table) for age, view in catalog.views.items()
+        }),
+    )
+
+
+# Экраны в файле снимка каталога (snapshot.py) хранятся простыми данными:
+# экран — (текст, номер клавиатуры, отпечаток), клавиатура — строки кнопок
+# (текст, callback_data), одинаковые клавиатуры — один раз. Объекты
+# клавиатур PTB дороги в построении, поэтому при загрузке снимка экраны
+# банков, типов и карт строятся при первом обращении.
+ScreenData = Tuple[str, int, int]
+
+
+# Клавиатуры снимка по номеру; объект строится при первом обращении
+class KeyboardTable:
+    def __init__(self, rows: Sequence[tuple]):
+        self._rows = rows
+        self._markups: List[Optional[InlineKeyboardMarkup]] = [None] * len(rows)
+
+    def __getitem__(self, index: int) -> InlineKeyboardMarkup:
+        markup = self._markups[index]
+        if markup is None:
+            markup = self._markups[index] = InlineKeyboardMarkup(tuple(
+                tuple(InlineKeyboardButton(text, callback_data=data) for text, data in row)
+                for row in self._rows[index]
+            ))
+        return markup
+
+    def screen(self, data: ScreenData) -> Screen:
+        text, keyboard, screen_fingerprint = data
+        return Screen(text, self[keyboard], screen_fingerprint)
+
+
+# Неизменяемое отображение ключ -> экран, экраны строятся при первом обращении
+class LazyScreens(collections.abc.Mapping):
+    def __init__(self, data: Mapping, keyboards: KeyboardTable):
+        self._data = data
+        self._keyboards = keyboards
+        self._screens: Dict = {}
+
+    def __getitem__(self, key) -> Screen:
+        screen = self._screens.get(key)
+        if screen is None:
+            screen = self._screens[key] = self._keyboards.screen(self._data[key])
+        return screen
+
+    def __iter__(self) -> Iterator:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def pack_screens(screens: Screens) -> tuple:
+    keyboards: Dict[tuple, int] = {}
+    # Страница карты обеих возрастных категорий — одна строка: marshal
+    # сохраняет повтор объекта ссылкой
+    texts: Dict[str, str] = {}
+
+    def pack(screen: Screen) -> ScreenData:
+        rows = tuple(
+            tuple((button.text, button.callback_data) for button in row)
+            for row in screen.reply_markup.inline_keyboard
+        )
+        text = texts.setdefault(screen.text, screen.text)
+        return text, keyboards.setdefault(rows, len(keyboards)), screen.fingerprint
+
+    def pack_mapping(mapping: Mapping) -> dict:
+        return {key: pack(screen) for key, screen in mapping.items()}
+
+    welcome = pack(screens.welcome)
+    main_menu = pack(screens.main_menu)
+    by_age = {
+        age: (
+            pack(age_screens.bank_selection),
+            tuple(map(pack, age_screens.all_cards)),
+            pack(age_screens.top_menu) if age_screens.top_menu is not None else None,
+            pack_mapping(age_screens.top),
+            pack_mapping(age_screens.card_types),
+            pack_mapping(age_screens.card_lists),
+            pack_mapping(age_screens.cards),
+        )
+        for age, age_screens in screens.by_age.items()
+    }
+    return welcome, main_menu, by_age, tuple(keyboards)
+
+
+def unpack_screens(state: tuple) -> Screens:
+    welcome, main_menu, by_age, rows = state
+    keyboards = KeyboardTable(rows)
+    screen = keyboards.screen
+    return Screens(
+        welcome=screen(welcome),
+        main_menu=screen(main_menu),
+        by_age=MappingProxyType({
+            age: AgeScreens(
+                bank_selection=screen(bank_selection),
+                all_cards=tuple(map(screen, all_cards)),
+                top_menu=screen(top_menu) if top_menu is not None else None,
+                top=MappingProxyType({key: screen(data) for key, data in top.items()}),
+                card_types=LazyScreens(card_types, keyboards),
+                card_lists=LazyScreens(card_lists, keyboards),
+                cards=LazyScreens(cards, keyboards),
+            )
+            for age, (bank_selection, all_cards, top_menu, top, card_types, card_lists, cards) in by_age.items()
+        }),
+    )
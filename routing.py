@@ -0,0 +1,152 @@
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from callback_codec import KIND_BANK, KIND_CARD, KIND_TYPE, PREFIX, payload_kind
+from render import ALL_CARDS_PAGE_PREFIX, TOP_CARDS_PREFIX
+
+# Маршрутизация нажатий кнопок.
+# callback_data один раз разбирается в код действия и аргумент: статичные
+# кнопки — поиск строки целиком в словаре, кнопки с параметром — словарь
+# по префиксу до ":", кнопки каталога — вид сущности из упакованных данных.
+# Обработчик берётся из заранее построенной таблицы [состояние][действие]
+# индексом, без регулярных выражений и цепочек сравнений. Каждое действие
+# объявляется один раз вместе с состояниями, в которых оно допустимо;
+# для остальных пар (состояние, действие) вызывается обработчик неизвестных
+# действий.
+
+ACTION_UNKNOWN = 0
+ACTION_AGE = 1
+ACTION_MAIN_MENU = 2
+ACTION_SHOW_ALL_CARDS = 3
+ACTION_SHOW_TOP_CARDS = 4
+ACTION_BACK_TO_BANKS = 5
+ACTION_BACK_TO_CARD_TYPE = 6
+ACTION_BACK_TO_CARDS = 7
+ACTION_ALL_CARDS_PAGE = 8
+ACTION_TOP_CARDS = 9
+ACTION_BANK = 10
+ACTION_CARD_TYPE = 11
+ACTION_CARD = 12
+
+ACTION_NAMES = (
+    "unknown", "age", "main_menu", "show_all_cards", "show_top_cards", "back_to_banks",
+    "back_to_card_type", "back_to_cards", "all_cards_page", "top_cards", "bank", "card_type", "card",
+)
+
+_SEPARATOR = ":"
+
+
+def _page(argument: str) -> Optional[int]:
+    return int(argument) if argument.isdecimal() else None
+
+
+# Префикс (с разделителем) -> действие и разбор аргумента; None — аргумент неверный
+_PREFIXED: Dict[str, Tuple[int, Callable[[str], object]]] = {
+    ALL_CARDS_PAGE_PREFIX: (ACTION_ALL_CARDS_PAGE, _page),
+    TOP_CARDS_PREFIX: (ACTION_TOP_CARDS, str),
+}
+
+# Вид сущности каталога -> действие; аргумент — callback_data целиком,
+# её расшифровывает снимок каталога нужного поколения
+_KIND_ACTIONS = {KIND_BANK: ACTION_BANK, KIND_TYPE: ACTION_CARD_TYPE, KIND_CARD: ACTION_CARD}
+
+
+class Callback(NamedTuple):
+    action: int
+    argument: object
+
+
+_UNKNOWN = Callback(ACTION_UNKNOWN, None)
+
+# Кнопки без параметров; разобранные значения готовы заранее, возраст
+# передаётся числом
+_STATIC: Dict[str, Callback] = {
+    "age_14_17": Callback(ACTION_AGE, 14),
+    "age_18_plus": Callback(ACTION_AGE, 18),
+    "main_menu": Callback(ACTION_MAIN_MENU, None),
+    "show_all_cards": Callback(ACTION_SHOW_ALL_CARDS, None),
+    "show_top_cards": Callback(ACTION_SHOW_TOP_CARDS, None),
+    "back_to_banks": Callback(ACTION_BACK_TO_BANKS, None),
+    "back_to_card_type": Callback(ACTION_BACK_TO_CARD_TYPE, None),
+    "back_to_cards": Callback(ACTION_BACK_TO_CARDS, None),
+}
+
+
+def parse_callback(data: Optional[str]) -> Callback:
+    if not data:
+        return _UNKNOWN
+    if data[0] == PREFIX:
+        action = _KIND_ACTIONS.get(payload_kind(data))
+        return Callback(action, data) if action is not None else _UNKNOWN
+    callback = _STATIC.get(data)
+    if callback is not None:
+        return callback
+    position = data.find(_SEPARATOR)
+    if position < 0:
+        return _UNKNOWN
+    prefixed = _PREFIXED.get(data[:position + 1])
+    if prefixed is None:
+        return _UNKNOWN
+    action, convert = prefixed
+    argument = convert(data[position + 1:])
+    return Callback(action, argument) if argument is not None else _UNKNOWN
+
+
+# Обработчик действия: (query, context, аргумент) -> следующее состояние
+Route = Callable[..., Awaitable[object]]
+# Обработчик неизвестного действия: (query, context, состояние)
+UnknownRoute = Callable[..., Awaitable[object]]
+
+
+class CallbackRouter:
+    def __init__(self, states: Iterable[int], on_unknown: UnknownRoute):
+        self.states = tuple(states)
+        self.on_unknown = on_unknown
+        self._routes: Dict[Tuple[int, int], Route] = {}
+        self._table: Optional[List[Tuple[Optional[Route], ...]]] = None
+
+    # Действие в перечисленных состояниях; без states — во всех
+    def add(self, action: int, route: Route, *states: int) -> None:
+        if self._table is not None:
+            raise RuntimeError("Маршруты уже построены")
+        for state in states or self.states:
+            key = (state, action)
+            if key in self._routes:
+                raise ValueError(f"Действие {ACTION_NAMES[action]} уже объявлено в состоянии {state}")
+            self._routes[key] = route
+
+    # Таблица строится при первом запросе обработчика; пустые ячейки — None
+    def table(self) -> List[Tuple[Optional[Route], ...]]:
+        if self._table is None:
+            size = max(self.states) + 1
+            self._table = [
+                tuple(self._routes.get((state, action)) for action in range(len(ACTION_NAMES)))
+                for state in range(size)
+            ]
+        return self._table
+
+    def resolve(self, state: int, data: Optional[str]) -> Tuple[Optional[Route], object]:
+        action, argument = parse_callback(data)
+        return self.table()[state][action], argument
+
+    # Обработчик CallbackQueryHandler для состояния диалога
+    def handler(self, state: int):
+        row = self.table()[state]
+        on_unknown = self.on_unknown
+
+        async def dispatch(update, context):
+            query = update.callback_query
+            action, argument = parse_callback(query.data)
+            route = row[action]
+            if route is None:
+                return await on_unknown(query, context, state)
+            return await route(query, context, argument)
+
+        return dispatch
+
+    # Фильтр callback_data для pattern= у CallbackQueryHandler; для кнопок
+    # без параметров — проверка по множеству строк
+    def accepts(self, action: int) -> Callable[[object], bool]:
+        static = frozenset(data for data, callback in _STATIC.items() if callback.action == action)
+        if static:
+            return static.__contains__
+        return lambda data: isinstance(data, str) and parse_callback(data).action == action
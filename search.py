@@ -0,0 +1,170 @@
+import functools
+import heapq
+import itertools
+import re
+from bisect import bisect_left
+from typing import AbstractSet, Dict, Iterator, List, Sequence, Tuple
+
+# Поиск карт для inline-режима.
+# Индекс строится вместе со снимком каталога: названия банков, типов и
+# карт и тексты преимуществ разбиваются на слова, слова приводятся к
+# нижнему регистру (ё и э → е, чтобы «кэшбэк» совпадал с «кешбэк») и
+# усекаются до основы простым отсечением окончаний. Слово запроса совпадает с любой основой, начинающейся с его
+# основы, поэтому «кэшб» находит «кэшбэк», а «кредитная» — «кредитный».
+# Для каждой основы карты заранее упорядочены по весу поля, так что
+# выдача первых результатов не требует обхода всех карт.
+
+_NORMALIZE = str.maketrans("ёэ", "ее")
+_WORD_RE = re.compile(r"[0-9a-zа-я]+")
+
+# Окончания, отсекаемые от слова, по длине; сначала пробуются длинные
+_ENDINGS = (
+    (4, frozenset(("иями",))),
+    (3, frozenset(("ями", "ами", "ыми", "ими", "ого", "его", "ому", "ему"))),
+    (2, frozenset((
+        "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ую", "юю", "ам", "ям", "ах", "ях",
+        "ов", "ев", "ом", "ем", "ию", "ия", "ии", "ей",
+    ))),
+    (1, frozenset("аяыиуюеоьй")),
+)
+MIN_STEM = 3
+
+# Вес совпадения в зависимости от поля карты
+NAME_WEIGHT = 4
+BANK_WEIGHT = 3
+TYPE_WEIGHT = 2
+ADVANTAGE_WEIGHT = 1
+
+# Сколько основ может раскрыть одно слово запроса как префикс
+MAX_EXPANSIONS = 64
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def stem(word: str) -> str:
+    for size, endings in _ENDINGS:
+        if len(word) - size >= MIN_STEM and word[-size:] in endings:
+            return word[:-size]
+    return word
+
+
+def terms(text: str) -> List[str]:
+    return [stem(word) for word in _WORD_RE.findall(text.lower().translate(_NORMALIZE))]
+
+
+class SearchIndex:
+    # cards — кортеж карт снимка, индекс в нём совпадает с Card.id;
+    # скрытые карты в индекс не попадают
+    def __init__(self, cards: Sequence, hidden: AbstractSet[int] = frozenset()):
+        self.cards = cards
+        self.hidden = hidden
+        postings: Dict[str, Dict[int, int]] = {}
+        # Банки, типы и многие преимущества повторяются от карты к карте
+        text_terms: Dict[str, List[str]] = {}
+        for card in cards:
+            if card.id in hidden:
+                continue
+            fields = [(card.name, NAME_WEIGHT), (card.bank, BANK_WEIGHT), (card.card_type, TYPE_WEIGHT)]
+            fields.extend((advantage, ADVANTAGE_WEIGHT) for advantage in card.advantages)
+            for text, weight in fields:
+                field_terms = text_terms.get(text)
+                if field_terms is None:
+                    field_terms = text_terms[text] = terms(text)
+                for term in field_terms:
+                    card_weights = postings.setdefault(term, {})
+                    if card_weights.get(card.id, 0) < weight:
+                        card_weights[card.id] = weight
+        self._postings = postings
+        self._stems = sorted(postings)
+        # Основа -> id карт по убыванию веса, при равенстве — по порядку каталога
+        self._ranked: Dict[str, Tuple[int, ...]] = {
+            term: tuple(sorted(card_weights, key=lambda card_id, weights=card_weights: (-weights[card_id], card_id)))
+            for term, card_weights in postings.items()
+        }
+
+    # Состояние индекса для файла снимка каталога (snapshot.py): словари,
+    # списки и кортежи, которые сериализует marshal
+    def state(self) -> tuple:
+        return self._postings, self._stems, self._ranked
+
+    # Индекс из сохранённого состояния, без разбора текстов карт
+    @classmethod
+    def restore(cls, cards: Sequence, hidden: AbstractSet[int], state: tuple) -> "SearchIndex":
+        index = cls.__new__(cls)
+        index.cards = cards
+        index.hidden = hidden
+        index._postings, index._stems, index._ranked = state
+        return index
+
+    # Основы, подходящие под слово запроса. Числа и уже дописанные слова
+    # (все, кроме последнего) ищутся точно, с префиксом — если точной
+    # основы нет; последнее слово, которое ещё набирается, — по префиксу
+    def _expand(self, term: str, partial: bool) -> List[str]:
+        if term.isdigit() or not partial and term in self._postings:
+            return [term] if term in self._postings else []
+        stems = self._stems
+        start = bisect_left(stems, term)
+        end = start
+        while end < len(stems) and end - start < MAX_EXPANSIONS and stems[end].startswith(term):
+            end += 1
+        return stems[start:end]
+
+    def _weight(self, expansion: List[str], card_id: int) -> int:
+        postings = self._postings
+        return max(postings[term].get(card_id, 0) for term in expansion)
+
+    # Карты слова запроса по убыванию веса, без повторов
+    def _candidates(self, expansion: List[str]) -> Iterator[int]:
+        if len(expansion) == 1:
+            return iter(self._ranked[expansion[0]])
+        postings = self._postings
+        ranked = self._ranked
+
+        # Поток основы строится функцией: генератор в выражении читал бы
+        # term лениво, уже после перехода цикла к следующей основе
+        def stream(term: str) -> Iterator[Tuple[int, int]]:
+            weights = postings[term]
+            return ((-weights[card_id], card_id) for card_id in ranked[term])
+
+        seen = set()
+        merged = heapq.merge(*map(stream, expansion))
+        return (card_id for _, card_id in merged if not (card_id in seen or seen.add(card_id)))
+
+    # Карты, подходящие под все слова запроса и возраст, лучшие первыми.
+    # Кандидаты берутся из самого редкого слова в порядке его веса и
+    # перебираются, пока не наберётся limit совпадений.
+    def search(self, query: str, age: int, limit: int = 50) -> List:
+        cards = self.cards
+        query_terms = list(dict.fromkeys(terms(query)))
+        if not query_terms:
+            hidden = self.hidden
+            return list(itertools.islice(
+                (card for card in cards if card.age_limit <= age and card.id not in hidden), limit
+            ))
+
+        expansions = []
+        last = len(query_terms) - 1
+        for position, term in enumerate(query_terms):
+            expansion = self._expand(term, position == last)
+            if not expansion:
+                return []
+            expansions.append(expansion)
+        expansions.sort(key=lambda expansion: sum(len(self._postings[term]) for term in expansion))
+        rarest, others = expansions[0], expansions[1:]
+
+        scored = []
+        for card_id in self._candidates(rarest):
+            card = cards[card_id]
+            if card.age_limit > age:
+                continue
+            score = self._weight(rarest, card_id)
+            for expansion in others:
+                weight = self._weight(expansion, card_id)
+                if not weight:
+                    break
+                score += weight
+            else:
+                scored.append((-score, card_id))
+                if len(scored) >= limit:
+                    break
+        scored.sort()
+        return [cards[card_id] for _, card_id in scored]
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сессии пользователей в памяти для режима без SESSION_STORE.
+# Вместо словаря на пользователя — объект со слотами под известные ключи
+# user_data; строки банка и типа карты — ссылки на строки каталога, а не
+# копии. Сессии лежат в OrderedDict в порядке последнего обращения:
+# превышение лимита вытесняет самую давнюю, фоновая задача раз в
+# sweep_interval секунд снимает с начала очереди простаивающие дольше ttl.
+
+# Оценка памяти на сессию вместе с записью в OrderedDict и состоянием
+# диалога в ConversationHandler, байты, с учётом того, что таблицы
+# словарей после вытеснений не сжимаются (benchmarks/bench_sessions.py)
+SESSION_BYTES = 450
+
+
+class Session:
+    __slots__ = ("age", "current_bank", "card_type", "chat_id", "last_seen")
+
+    # Ключи user_data, которые можно хранить в сессии
+    KEYS = frozenset(("age", "current_bank", "card_type"))
+
+    def __init__(self, chat_id: Optional[int], now: float):
+        self.age = None
+        self.current_bank = None
+        self.card_type = None
+        self.chat_id = chat_id
+        self.last_seen = now
+
+    def _check(self, key: str) -> None:
+        if key not in self.KEYS:
+            raise KeyError(f"Ключ {key!r} не предусмотрен в сессии")
+
+    def get(self, key: str, default=None):
+        self._check(key)
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __getitem__(self, key: str):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value) -> None:
+        self._check(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self[key]
+        setattr(self, key, None)
+
+    def pop(self, key: str, default=None):
+        value = self.get(key, default)
+        setattr(self, key, None)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.KEYS and getattr(self, key) is not None
+
+    def __iter__(self):
+        return (key for key in sorted(self.KEYS) if getattr(self, key) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class SessionCache:
+    # on_evict(user_id, chat_id) вызывается для каждой вытесненной сессии
+    def __init__(
+        self,
+        ttl: float = 86400.0,
+        max_sessions: int = 100000,
+        sweep_interval: float = 60.0,
+        on_evict: Optional[Callable[[int, Optional[int]], None]] = None,
+    ):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self.on_evict = on_evict
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+        self._sessions: "OrderedDict[int, Session]" = OrderedDict()
+        # Время обновляется раз в sweep_interval; сессии ссылаются на один
+        # и тот же объект float вместо собственного
+        self._now = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, user_id: int, chat_id: Optional[int] = None) -> Session:
+        session = self._sessions.get(user_id)
+        if session is not None:
+            self._sessions.move_to_end(user_id)
+            session.last_seen = self._now
+            if chat_id is not None:
+                session.chat_id = chat_id
+            return session
+        session = self._sessions[user_id] = Session(chat_id, self._now)
+        if len(self._sessions) > self.max_sessions:
+            evicted_id, evicted = self._sessions.popitem(last=False)
+            self.evicted_lru += 1
+            self._evicted(evicted_id, evicted)
+        return session
+
+    def _evicted(self, user_id: int, session: Session) -> None:
+        if self.on_evict is not None:
+            self.on_evict(user_id, session.chat_id)
+
+    # Снятие простаивающих сессий; очередь упорядочена по последнему
+    # обращению, поэтому проверяется только её начало
+    def sweep(self, now: Optional[float] = None) -> int:
+        self._now = time.monotonic() if now is None else now
+        deadline = self._now - self.ttl
+        sessions = self._sessions
+        evicted = 0
+        while sessions:
+            user_id, session = next(iter(sessions.items()))
+            if session.last_seen > deadline:
+                break
+            del sessions[user_id]
+            self._evicted(user_id, session)
+            evicted += 1
+        self.evicted_idle += evicted
+        return evicted
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            evicted = self.sweep()
+            if evicted:
+                logger.info("Вытеснено простаивающих сессий: %s, осталось %s", evicted, len(self._sessions))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,100 @@
+import base64
+import hashlib
+import logging
+import time
+from collections import Counter
+from http import HTTPStatus
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import quote
+
+from catalog import Card, Catalog, CatalogStore
+from webserver import Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Короткие ссылки вида <base>/<slug> вместо реферальных ссылок в сообщениях.
+# Slug выводится из банка, типа и названия карты, поэтому не меняется при
+# правке ref_link: уже отправленные сообщения ведут на новый адрес после
+# перезагрузки каталога. Разрешение slug идёт из кэша в памяти, переходы
+# считаются без ожидания.
+
+SLUG_BYTES = 6
+
+# Символы, которые не нужно экранировать в заголовке Location
+_URL_SAFE = ":/?#[]@!$&'()*+,;=%~"
+
+
+def slug_for(card: Card) -> str:
+    key = f"{card.bank}\x00{card.card_type}\x00{card.name}".encode("utf-8")
+    digest = hashlib.blake2b(key, digest_size=SLUG_BYTES).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii")
+
+
+# Функция построения короткой ссылки карты для render.build_screens
+def link_builder(base_url: str) -> Callable[[Card], str]:
+    base = base_url.rstrip("/") + "/"
+    return lambda card: base + slug_for(card)
+
+
+def build_index(catalog: Catalog) -> Dict[str, Tuple[Card, str]]:
+    index: Dict[str, Tuple[Card, str]] = {}
+    for card in catalog.cards:
+        slug = slug_for(card)
+        if slug in index:
+            logger.error("Совпадение коротких ссылок: %s и %s", index[slug][0], card)
+            continue
+        index[slug] = (card, quote(card.ref_link, safe=_URL_SAFE))
+    return index
+
+
+class ShortLinks:
+    def __init__(self, catalog_store: CatalogStore, ttl: float = 60.0, max_entries: int = 100000):
+        self.catalog_store = catalog_store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clicks: Counter = Counter()
+        # slug -> (карта и адрес перехода либо None, срок годности)
+        self._cache: Dict[str, Tuple[Optional[Tuple[Card, str]], float]] = {}
+        self._index: Dict[str, Tuple[Card, str]] = {}
+        # Снимок, по которому построен индекс; поколение не годится,
+        # оно не меняется при правке одной лишь ссылки
+        self._index_catalog: Optional[Catalog] = None
+        catalog_store.add_listener(self._on_reload)
+
+    def _on_reload(self, catalog: Catalog) -> None:
+        self._cache.clear()
+
+    def _lookup(self, slug: str) -> Optional[Tuple[Card, str]]:
+        catalog = self.catalog_store.current
+        if catalog is not self._index_catalog:
+            self._index = build_index(catalog)
+            self._index_catalog = catalog
+        return self._index.get(slug)
+
+    def resolve(self, slug: str) -> Optional[Tuple[Card, str]]:
+        now = time.monotonic()
+        entry = self._cache.get(slug)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        target = self._lookup(slug)
+        if len(self._cache) >= self.max_entries:
+            self._cache.clear()
+        # Неизвестные slug тоже кэшируются, до истечения ttl
+        self._cache[slug] = (target, now + self.ttl)
+        return target
+
+
+# on_click вызывается с картой после каждого перехода и не должен блокироваться
+def make_redirect_handler(links: ShortLinks, prefix: str, on_click: Optional[Callable[[Card], None]] = None):
+    async def handle_redirect(request: Request) -> Response:
+        slug = request.path[len(prefix):]
+        target = links.resolve(slug)
+        if target is None:
+            return Response(HTTPStatus.NOT_FOUND)
+        card, location = target
+        links.clicks[slug] += 1
+        if on_click is not None:
+            on_click(card)
+        return Response(HTTPStatus.FOUND, headers=(("Location", location), ("Cache-Control", "no-store")))
+
+    return handle_redirect
@@ -0,0 +1,130 @@
+import gc
+import hashlib
+import logging
+import marshal
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Optional
+
+import attributes
+import callback_codec
+import catalog as catalog_module
+import render
+import search
+import shortlinks
+from catalog import Catalog
+from render import pack_screens, unpack_screens
+
+logger = logging.getLogger(__name__)
+
+# Файл снимка каталога для быстрого запуска.
+# Каталог, состояние поиска и таблицы характеристик и готовые экраны
+# сохраняются одним двоичным файлом marshal; при запуске файл отображается
+# в память (mmap) и читается без разбора JSON, построения индексов и
+# рендеринга. Снимок действителен, пока совпадает ключ в заголовке:
+# SHA-256 содержимого файла каталога, кода модулей, строящих снимок, версии
+# Python и параметров рендеринга (key). Иначе каталог собирается из JSON,
+# а снимок перезаписывается через временный файл и rename, так что
+# соседние процессы читают либо старый, либо новый файл целиком.
+
+MAGIC = b"RBSNAP"
+FORMAT_VERSION = 1
+# magic, версия формата, ключ, длина тела
+_HEADER = struct.Struct(">6sH32sQ")
+# Модули, от кода которых зависит содержимое снимка; ссылки в тексте
+# карт, которые попадают в готовые экраны, строит shortlinks
+_SOURCE_MODULES = (attributes, callback_codec, catalog_module, render, search, shortlinks)
+
+
+def _code_digest() -> bytes:
+    digest = hashlib.sha256(f"{sys.version}\x00{sys.byteorder}".encode("utf-8"))
+    for path in sorted({module.__file__ for module in _SOURCE_MODULES} | {__file__}):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.digest()
+
+
+# Карты снимка в виде словаря банков, из которого их строит Catalog
+def _banks(catalog: Catalog) -> Dict[str, Dict[str, Dict[str, dict]]]:
+    banks: Dict[str, Dict[str, Dict[str, dict]]] = {}
+    for card in catalog.cards:
+        banks.setdefault(card.bank, {}).setdefault(card.card_type, {})[card.name] = {
+            "age_limit": card.age_limit,
+            "advantages": card.advantages,
+            "ref_link": card.ref_link,
+            "image": card.image,
+        }
+    return banks
+
+
+class CatalogSnapshot:
+    # key — параметры, от которых кроме файла каталога зависят экраны,
+    # например базовый адрес коротких ссылок
+    def __init__(self, path: str, key: str = ""):
+        self.path = path
+        self._key = _code_digest() + key.encode("utf-8")
+
+    def _digest(self, content: bytes) -> bytes:
+        digest = hashlib.sha256(self._key)
+        digest.update(content)
+        return digest.digest()
+
+    # Снимок для содержимого файла каталога content; None, если файла нет
+    # или он построен для другого каталога, кода или параметров
+    def load(self, content: bytes) -> Optional[Catalog]:
+        try:
+            with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, version, key, length = _HEADER.unpack_from(data)
+                if magic != MAGIC or version != FORMAT_VERSION or length != len(data) - _HEADER.size:
+                    logger.warning("Снимок каталога %s повреждён или другой версии формата", self.path)
+                    return None
+                if key != self._digest(content):
+                    logger.info("Снимок каталога %s устарел", self.path)
+                    return None
+                # Сборщик мусора на время чтения выключен: снимок — сотни
+                # тысяч новых объектов без циклов, и каждый его проход
+                # обходил бы их заново (до 40% времени загрузки)
+                gc_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    with memoryview(data) as view, view[_HEADER.size:] as body:
+                        version, banks, indexes, screens = marshal.loads(body)
+                    catalog = Catalog(banks, version, indexes=indexes)
+                    if screens is not None:
+                        catalog.screens = unpack_screens(screens)
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, TypeError, struct.error) as exc:
+            logger.warning("Снимок каталога %s не прочитан: %s", self.path, exc)
+            return None
+        return catalog
+
+    # Запись снимка каталога, собранного из content; ошибка записи не
+    # мешает работе, следующий запуск соберёт каталог из JSON
+    def save(self, catalog: Catalog, content: bytes) -> None:
+        body = marshal.dumps((
+            catalog.version,
+            _banks(catalog),
+            (catalog.search.state(), catalog.table.state()),
+            pack_screens(catalog.screens) if catalog.screens is not None else None,
+        ))
+        header = _HEADER.pack(MAGIC, FORMAT_VERSION, self._digest(content), len(body))
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "wb") as f:
+                f.write(header)
+                f.write(body)
+            os.replace(temporary, self.path)
+        except OSError as exc:
+            logger.warning("Снимок каталога %s не записан: %s", self.path, exc)
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+            return
+        logger.info("Снимок каталога записан: %s, %.1f МиБ", self.path, (len(header) + len(body)) / 2 ** 20)
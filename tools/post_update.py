@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+import urllib.error
+import urllib.request
+
+# Отправка записанных обновлений Telegram в локально запущенный вебхук:
+#   BOT_MODE=webhook python bot.py
+#   python tools/post_update.py samples/updates/start.json
+
+
+def post_update(url: str, path: str, secret: str) -> int:
+    with open(path, "rb") as f:
+        body = f.read()
+    request = urllib.request.Request(url, data=body, method="POST")
+    request.add_header("Content-Type", "application/json")
+    if secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as exc:
+        return exc.code
+
+
+def main() -> None:
+    port = os.getenv("PORT", "8443")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{port}{os.getenv('WEBHOOK_PATH', '/telegram')}")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.files:
+        status = post_update(args.url, path, args.secret)
+        print(f"{path}: {status}")
+        failed |= status != 200
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
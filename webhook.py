@@ -0,0 +1,137 @@
+import hmac
+import json
+import logging
+from http import HTTPStatus
+from typing import Callable, List, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from lifecycle import (
+    StartupTimer, UpdateJournal, acquire_journal, drain_and_shutdown, restore_pending, wait_for_stop_signal,
+)
+from webserver import HttpServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Режим вебхука: Telegram присылает обновления POST-запросами,
+# сервер отвечает 200 сразу после постановки обновления в очередь,
+# а обработчики выполняются уже вне HTTP-запроса.
+
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+
+
+# on_update получает разобранный JSON обновления и не должен блокироваться;
+# пока accepting() ложно (процесс останавливается), Telegram получает 503
+# и повторит доставку — уже новому процессу
+def make_webhook_handler(
+    on_update: Callable[[dict], None],
+    secret_token: Optional[str],
+    accepting: Optional[Callable[[], bool]] = None,
+):
+    expected = secret_token.encode("utf-8") if secret_token else None
+
+    async def handle_update(request: Request) -> Response:
+        if accepting is not None and not accepting():
+            return Response(HTTPStatus.SERVICE_UNAVAILABLE)
+        if expected is not None:
+            received = request.headers.get(SECRET_TOKEN_HEADER, "").encode("utf-8")
+            if not hmac.compare_digest(received, expected):
+                logger.warning("Отклонён запрос вебхука с неверным секретом")
+                return Response(HTTPStatus.FORBIDDEN)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return Response(HTTPStatus.BAD_REQUEST)
+        if not isinstance(data, dict) or "update_id" not in data:
+            return Response(HTTPStatus.BAD_REQUEST)
+
+        on_update(data)
+        return Response(HTTPStatus.OK)
+
+    return handle_update
+
+
+# Регистрация вебхука в Telegram
+async def register_webhook(
+    bot: Bot,
+    webhook_url: Optional[str],
+    path: str,
+    secret_token: Optional[str],
+    max_connections: int,
+) -> None:
+    if not webhook_url:
+        logger.warning("WEBHOOK_URL не задан, вебхук в Telegram не регистрируется")
+        return
+    url = webhook_url.rstrip("/") + path
+    await bot.set_webhook(
+        url=url,
+        secret_token=secret_token,
+        max_connections=max_connections,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    logger.info("Вебхук установлен: %s", url)
+
+
+# Регистрация дополнительных маршрутов на HTTP сервере бота
+RouteSetup = Callable[[HttpServer], None]
+
+
+# build(journal=...) строит приложение после передачи журнала; порт
+# открывается раньше, и пришедшие до этого обновления копятся в буфере
+async def run_webhook(
+    build: Callable[..., Application],
+    host: str,
+    port: int,
+    path: str,
+    webhook_url: Optional[str],
+    secret_token: Optional[str],
+    max_connections: int,
+    routes: Optional[RouteSetup] = None,
+    drain_timeout: float = 10.0,
+    journal: Optional[UpdateJournal] = None,
+    startup: Optional[StartupTimer] = None,
+) -> None:
+    accepting = True
+    # Пока предыдущий процесс не передал свои обновления, новые копятся
+    # здесь, чтобы встать в очередь после переданных
+    buffered: Optional[List[dict]] = []
+
+    def enqueue(data: dict) -> None:
+        if buffered is not None:
+            buffered.append(data)
+        else:
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    # SO_REUSEPORT: новый процесс слушает порт, пока старый дочитывает очередь
+    server = HttpServer(host, port, max_connections=max_connections, reuse_port=True)
+    server.route("POST", path, make_webhook_handler(enqueue, secret_token, lambda: accepting))
+    if routes is not None:
+        routes(server)
+
+    await server.start()
+    journal = await acquire_journal(journal, drain_timeout, startup)
+    application = build(journal=journal)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if startup is not None:
+        startup.mark("initialize")
+    await application.start()
+    if journal is not None:
+        await restore_pending(application, journal)
+    for data in buffered:
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+    buffered = None
+    await register_webhook(application.bot, webhook_url, path, secret_token, max_connections)
+    if startup is not None:
+        startup.mark("webhook")
+        startup.ready()
+    try:
+        await wait_for_stop_signal()
+    finally:
+        logger.info("Остановка: приём обновлений прекращён")
+        accepting = False
+        await drain_and_shutdown(application, drain_timeout, journal)
+        await server.stop()
+        logger.info("Приложение остановлено")
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, List, Mapping, NamedTuple, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Минимальный асинхронный HTTP/1.1 сервер на asyncio.
+# Используется для вебхука Telegram и служебных эндпоинтов; поддерживает
+# keep-alive, ограничение числа соединений и размера тела запроса.
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    query: Mapping[str, str]
+    headers: Mapping[str, str]
+    body: bytes
+
+
+class Response(NamedTuple):
+    status: int = 200
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+    headers: Tuple[Tuple[str, str], ...] = ()
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class HttpServer:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        max_connections: int = 100,
+        max_body_size: int = 1 << 20,
+        idle_timeout: float = 60.0,
+        reuse_port: bool = False,
+    ):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.max_body_size = max_body_size
+        self.idle_timeout = idle_timeout
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._prefix_routes: List[Tuple[str, str, Handler]] = []
+        self._connections = asyncio.Semaphore(max_connections)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._handlers: Set[asyncio.Task] = set()
+
+    def route(self, method: str, path: str, handler: Handler, prefix: bool = False) -> None:
+        if prefix:
+            self._prefix_routes.append((method, path, handler))
+        else:
+            self._routes[(method, path)] = handler
+
+    def _resolve(self, method: str, path: str) -> Optional[Handler]:
+        handler = self._routes.get((method, path))
+        if handler is not None:
+            return handler
+        for route_method, route_path, prefix_handler in self._prefix_routes:
+            if route_method == method and path.startswith(route_path):
+                return prefix_handler
+        return None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, reuse_port=self.reuse_port or None
+        )
+        sockets = self._server.sockets or ()
+        if sockets:
+            self.port = sockets[0].getsockname()[1]
+        logger.info("HTTP сервер слушает %s:%s", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            # Простаивающие keep-alive соединения закрываются сразу
+            for writer in list(self._writers):
+                writer.close()
+            # Обработчики соединений завершаются сами, получив конец потока
+            if self._handlers:
+                await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        async with self._connections:
+            task = asyncio.current_task()
+            self._handlers.add(task)
+            self._writers.add(writer)
+            try:
+                while True:
+                    request = await asyncio.wait_for(self._read_request(reader), self.idle_timeout)
+                    if request is None:
+                        break
+                    if isinstance(request, Response):
+                        await self._write_response(writer, request, keep_alive=False)
+                        break
+                    response = await self._dispatch(request)
+                    keep_alive = request.headers.get("connection", "").lower() != "close"
+                    await self._write_response(writer, response, keep_alive)
+                    if not keep_alive:
+                        break
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                self._writers.discard(writer)
+                self._handlers.discard(task)
+                writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return Response(HTTPStatus.BAD_REQUEST)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            return Response(HTTPStatus.BAD_REQUEST)
+        if length > self.max_body_size:
+            return Response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b""
+
+        url = urlsplit(target)
+        return Request(method.upper(), url.path, dict(parse_qsl(url.query)), headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self._resolve(request.method, request.path)
+        if handler is None:
+            return Response(HTTPStatus.NOT_FOUND)
+        try:
+            return await handler(request)
+        except Exception:
+            logger.exception("Ошибка обработки %s %s", request.method, request.path)
+            return Response(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    @staticmethod
+    async def _write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool) -> None:
+        status = HTTPStatus(response.status)
+        head = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Content-Length: {len(response.body)}",
+            f"Content-Type: {response.content_type}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        head.extend(f"{name}: {value}" for name, value in response.headers)
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + response.body)
+        await writer.drain()
@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.queues
+import signal
+from typing import Callable, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.ext import Application
+
+from lifecycle import TrackedApplication, drain_and_shutdown, wait_for_stop_signal
+from webhook import RouteSetup, make_webhook_handler, register_webhook
+from webserver import HttpServer
+
+logger = logging.getLogger(__name__)
+
+# Режим супервизора: один входной процесс получает обновления (вебхук или
+# polling) и раскладывает их по N рабочим процессам по user_id. Все
+# обновления одного пользователя попадают в один и тот же процесс и в
+# одну очередь, поэтому состояние диалога живёт в одном месте, а порядок
+# сохраняется. Упавшие рабочие процессы перезапускаются.
+# Рабочий процесс подтверждает по отдельному pipe каждое обновление, чья
+# обработка завершилась, передавая его update_id. Очередь создаётся заново при каждом запуске процесса:
+# процесс, убитый внутри queue.get, оставляет блокировку чтения очереди
+# занятой навсегда. Неподтверждённые обновления — ещё не взятые из очереди
+# и те, чья обработка не успела завершиться, — отправляются в новую в
+# прежнем порядке.
+
+# Поля обновления, в которых Telegram передаёт отправителя
+_SENDER_FIELDS = (
+    "message", "edited_message", "callback_query", "inline_query",
+    "chosen_inline_result", "shipping_query", "pre_checkout_query",
+    "my_chat_member", "chat_member", "chat_join_request", "poll_answer",
+)
+
+_STOP = None
+WORKER_CHECK_INTERVAL = 1.0
+# Запас сверх дедлайна дочитки очереди, после которого процесс завершается принудительно
+WORKER_STOP_TIMEOUT = 5.0
+
+
+# Ключ шардирования: id пользователя, иначе id чата, иначе update_id
+def shard_key(data: dict) -> int:
+    for field in _SENDER_FIELDS:
+        payload = data.get(field)
+        if payload is None:
+            continue
+        sender = payload.get("from") or payload.get("user")
+        if sender is not None:
+            return sender["id"]
+        chat = payload.get("chat")
+        if chat is not None:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+
+# Точка входа рабочего процесса
+def worker_main(
+    index: int, queue, acks, application_factory: Callable[[], Application], drain_timeout: float
+) -> None:
+    # Останавливает рабочий процесс только супервизор, через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, queue, acks, application_factory(), drain_timeout))
+
+
+async def _run_worker(index: int, queue, acks, application: Application, drain_timeout: float) -> None:
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    # Подтверждение отправляется после обработки: обновление, на котором
+    # процесс упал, супервизор передаст новому процессу
+    tracked = isinstance(application, TrackedApplication)
+    if tracked:
+        application.on_done = lambda update: acks.send(update.update_id)
+    await application.start()
+    logger.info("Рабочий процесс %s запущен", index)
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is _STOP:
+                break
+            update = Update.de_json(data, application.bot)
+            if update is not None:
+                await application.update_queue.put(update)
+            if update is None or not tracked:
+                acks.send(data.get("update_id"))
+    finally:
+        await drain_and_shutdown(application, drain_timeout)
+        logger.info("Рабочий процесс %s остановлен", index)
+
+
+class WorkerPool:
+    def __init__(self, size: int, application_factory: Callable[[], Application], drain_timeout: float = 10.0):
+        self.size = size
+        self._factory = application_factory
+        self.drain_timeout = drain_timeout
+        self._context = multiprocessing.get_context("spawn")
+        # Очередь и pipe подтверждений текущего процесса каждого шарда
+        self._queues: List[Optional[multiprocessing.queues.Queue]] = [None] * size
+        self._acks: List[Optional[multiprocessing.connection.Connection]] = [None] * size
+        # Отправленные в шард и ещё не подтверждённые обновления по
+        # update_id, в порядке отправки
+        self._pending: List[Dict[int, dict]] = [{} for _ in range(size)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * size
+        self._stopping = False
+        self.restarts = 0
+        self.redispatched = 0
+
+    def _spawn(self, index: int) -> None:
+        queue = self._context.Queue()
+        acks, worker_acks = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=worker_main,
+            args=(index, queue, worker_acks, self._factory, self.drain_timeout),
+            name=f"refbot-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        # Конец записи остаётся только у рабочего процесса: после его
+        # завершения чтение подтверждений получает EOF
+        worker_acks.close()
+        self._queues[index] = queue
+        self._acks[index] = acks
+        self._processes[index] = process
+        asyncio.get_running_loop().add_reader(acks.fileno(), self._read_acks, index)
+        for data in self._pending[index].values():
+            queue.put(data)
+
+    def _read_acks(self, index: int) -> None:
+        acks = self._acks[index]
+        pending = self._pending[index]
+        try:
+            while acks.poll():
+                pending.pop(acks.recv(), None)
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(acks.fileno())
+
+    # Замена упавшего процесса: его очередь закрывается, неподтверждённые
+    # обновления уходят новому процессу
+    def _respawn(self, index: int) -> None:
+        self._read_acks(index)
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self._acks[index].fileno())
+        self._acks[index].close()
+        queue = self._queues[index]
+        # Читать очередь больше некому: фоновый поток записи не ждём
+        queue.cancel_join_thread()
+        queue.close()
+        self.redispatched += len(self._pending[index])
+        if self._pending[index]:
+            logger.warning(
+                "Обновления упавшего процесса %s переданы новому: %s", index, len(self._pending[index])
+            )
+        self._spawn(index)
+
+    def start(self) -> None:
+        for index in range(self.size):
+            self._spawn(index)
+        logger.info("Запущено рабочих процессов: %s", self.size)
+
+    def dispatch(self, data: dict) -> None:
+        index = shard_key(data) % self.size
+        self._pending[index][data.get("update_id")] = data
+        self._queues[index].put(data)
+
+    # Перезапуск упавших рабочих процессов
+    async def supervise(self) -> None:
+        while not self._stopping:
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive() and not self._stopping:
+                    logger.error(
+                        "Рабочий процесс %s завершился с кодом %s, перезапуск",
+                        index, process.exitcode,
+                    )
+                    self.restarts += 1
+                    self._respawn(index)
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for queue in self._queues:
+            queue.put(_STOP)
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, self.drain_timeout + WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning("Рабочий процесс %s не остановился, завершение", process.name)
+                process.terminate()
+        for index, acks in enumerate(self._acks):
+            if acks is not None:
+                self._read_acks(index)
+                loop.remove_reader(acks.fileno())
+                acks.close()
+
+
+# Получение обновлений long polling'ом во входном процессе
+async def poll_updates(bot: Bot, pool: WorkerPool, timeout: int = 30) -> None:
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=Update.ALL_TYPES)
+        except TelegramError as exc:
+            logger.warning("Ошибка получения обновлений: %s", exc)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            pool.dispatch(update.to_dict())
+            offset = update.update_id + 1
+
+
+async def run_supervisor(
+    token: str,
+    application_factory: Callable[[], Application],
+    workers: int,
+    mode: str,
+    host: str,
+    port: int,
+    path: str,
+    webhook_url: Optional[str],
+    secret_token: Optional[str],
+    max_connections: int,
+    routes: Optional[RouteSetup] = None,
+    drain_timeout: float = 10.0,
+) -> None:
+    pool = WorkerPool(workers, application_factory, drain_timeout)
+    pool.start()
+    supervisor = asyncio.create_task(pool.supervise())
+
+    server = None
+    poller = None
+    async with Bot(token) as bot:
+        try:
+            # Служебные маршруты обслуживает входной процесс
+            if mode == "webhook" or routes is not None:
+                server = HttpServer(host, port, max_connections=max_connections, reuse_port=True)
+                if mode == "webhook":
+                    server.route("POST", path, make_webhook_handler(pool.dispatch, secret_token))
+                if routes is not None:
+                    routes(server)
+                await server.start()
+            if mode == "webhook":
+                await register_webhook(bot, webhook_url, path, secret_token, max_connections)
+            else:
+                poller = asyncio.create_task(poll_updates(bot, pool))
+            await wait_for_stop_signal()
+        finally:
+            if server is not None:
+                await server.stop()
+            if poller is not None:
+                poller.cancel()
+            supervisor.cancel()
+            await pool.stop()
+            logger.info("Супервизор остановлен")